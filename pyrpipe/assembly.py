@@ -50,6 +50,8 @@ class Stringtie(Assembly):
         self.valid_args_list=['-G','--version','--conservative','--rf','--fr','-o','-l',
                             '-f','-L','-m','-a','-j','-t','-c','-s','-v','-g','-M',
                             '-p','-A','-B','-b','-e','-x','-u','-h','--merge','-F','-T','-i']
+        #flags setting the number of threads; threads are taken from the thread budget if not set
+        self.thread_args=['-p']
         
         #keep the passed arguments
         self.passed_args_dict=kwargs
@@ -199,22 +201,40 @@ class Stringtie(Assembly):
         :rtype: bool
         """
             
-        #override existing arguments
-        merged_args_dict={**self.passed_args_dict,**kwargs}
-       
-        stie_cmd=['stringtie']
-        #add options
-        stie_cmd.extend(pu.parse_unix_args(self.valid_args_list,merged_args_dict))        
+        stie_cmd=self.get_stringtie_cmd(**kwargs)
         
                 
         #start ececution
-        status=pe.execute_command(stie_cmd,verbose=verbose,quiet=quiet,logs=logs,objectid=objectid)
+        status=pe.execute_command(stie_cmd,verbose=verbose,quiet=quiet,logs=logs,objectid=objectid,thread_flags=self.thread_args)
         if not status:
             pu.print_boldred("stringtie failed")
         
         #return status
         return status
     
+    async def run_stringtie_async(self,verbose=False,quiet=False,logs=True,objectid="NA",**kwargs):
+        """Coroutine version of run_stringtie. Parameters are same as run_stringtie.
+        
+        :return: Returns the status of stringtie command.
+        :rtype: bool
+        """
+        stie_cmd=self.get_stringtie_cmd(**kwargs)
+        status=await pe.execute_command_async(stie_cmd,verbose=verbose,quiet=quiet,logs=logs,objectid=objectid,thread_flags=self.thread_args)
+        if not status:
+            pu.print_boldred("stringtie failed")
+        return status
+    
+    def get_stringtie_cmd(self,**kwargs):
+        """Return the stringtie command with the stored arguments overridden by kwargs
+        """
+        #override existing arguments
+        merged_args_dict={**self.passed_args_dict,**kwargs}
+       
+        stie_cmd=['stringtie']
+        #add options
+        stie_cmd.extend(pu.parse_unix_args(self.valid_args_list,merged_args_dict))
+        return stie_cmd
+    
     
     
 class Cufflinks(Assembly):
@@ -251,6 +271,8 @@ class Cufflinks(Assembly):
         self.cuffmergeArgsList=['h','--help','-o','-g','–-ref-gtf','-p','–-num-threads','-s','-–ref-sequence']
         
         self.valid_args_list=pu.get_union(self.cufflinksArgsList,self.cuffcompareArgsList,self.cuffquantArgsList,self.cuffdiffArgsList,self.cuffnormArgsList,self.cuffmergeArgsList)
+        #flags setting the number of threads of each command; threads are taken from the thread budget if not set
+        self.thread_args={c:['-p','--num-threads'] for c in ['cufflinks','cuffdiff','cuffmerge','cuffnorm','cuffquant']}
         
         #keep the passed arguments
         self.passed_args_dict=kwargs
@@ -345,25 +367,49 @@ class Cufflinks(Assembly):
         :return: Returns the status of the command.
         :rtype: bool
         """
-        validCommands=['cuffcompare','cuffdiff', 'cufflinks', 'cuffmerge', 'cuffnorm', 'cuffquant']
-        if command in validCommands:
-            #override existing arguments
-            merged_args_dict={**self.passed_args_dict,**kwargs}
-       
-            cuff_cmd=[command]
-            #add options
-            cuff_cmd.extend(pu.parse_unix_args(self.valid_args_list,merged_args_dict))        
-                  
+        cuff_cmd=self.get_cuff_cmd(command,**kwargs)
+        if cuff_cmd:
             #start ececution
-            status=pe.execute_command(cuff_cmd,verbose=verbose,quiet=quiet,logs=logs,objectid=objectid)
+            status=pe.execute_command(cuff_cmd,verbose=verbose,quiet=quiet,logs=logs,objectid=objectid,thread_flags=self.thread_args.get(command))
             if not status:
                 pu.print_boldred("cufflinks failed")
                 #return status
             return status
         else:
-            pu.print_boldred("Unknown command {}"+command)
             return False
     
+    async def run_cuff_async(self,command,verbose=False,quiet=False,logs=True,objectid="NA",**kwargs):
+        """Coroutine version of run_cuff. Parameters are same as run_cuff.
+        
+        :return: Returns the status of the command.
+        :rtype: bool
+        """
+        cuff_cmd=self.get_cuff_cmd(command,**kwargs)
+        if not cuff_cmd:
+            return False
+        status=await pe.execute_command_async(cuff_cmd,verbose=verbose,quiet=quiet,logs=logs,objectid=objectid,thread_flags=self.thread_args.get(command))
+        if not status:
+            pu.print_boldred("cufflinks failed")
+        return status
+    
+    def get_cuff_cmd(self,command,**kwargs):
+        """Return the cuff* command with the stored arguments overridden by kwargs
+        
+        :return: the command or an empty list if command is not valid
+        :rtype: list
+        """
+        validCommands=['cuffcompare','cuffdiff', 'cufflinks', 'cuffmerge', 'cuffnorm', 'cuffquant']
+        if command not in validCommands:
+            pu.print_boldred("Unknown command {}"+command)
+            return []
+        #override existing arguments
+        merged_args_dict={**self.passed_args_dict,**kwargs}
+       
+        cuff_cmd=[command]
+        #add options
+        cuff_cmd.extend(pu.parse_unix_args(self.valid_args_list,merged_args_dict))
+        return cuff_cmd
+    
     
     def run_cufflinks(self,verbose=False,quiet=False,logs=True,objectid="NA",**kwargs):
         """Wrapper for running cufflinks
@@ -386,21 +432,39 @@ class Cufflinks(Assembly):
         :rtype: bool
         """
             
-        #override existing arguments
-        merged_args_dict={**self.passed_args_dict,**kwargs}
-       
-        cufflinks_cmd=['cufflinks']
-        #add options
-        cufflinks_cmd.extend(pu.parse_unix_args(self.valid_args_list,merged_args_dict))        
+        cufflinks_cmd=self.get_cufflinks_cmd(**kwargs)
         
         
         #start ececution
-        status=pe.execute_command(cufflinks_cmd,verbose=verbose,quiet=quiet,logs=logs,objectid=objectid)
+        status=pe.execute_command(cufflinks_cmd,verbose=verbose,quiet=quiet,logs=logs,objectid=objectid,thread_flags=self.thread_args['cufflinks'])
         if not status:
             pu.print_boldred("cufflinks failed")
         #return status
         return status
     
+    async def run_cufflinks_async(self,verbose=False,quiet=False,logs=True,objectid="NA",**kwargs):
+        """Coroutine version of run_cufflinks. Parameters are same as run_cufflinks.
+        
+        :return: Returns the status of cufflinks command.
+        :rtype: bool
+        """
+        cufflinks_cmd=self.get_cufflinks_cmd(**kwargs)
+        status=await pe.execute_command_async(cufflinks_cmd,verbose=verbose,quiet=quiet,logs=logs,objectid=objectid,thread_flags=self.thread_args['cufflinks'])
+        if not status:
+            pu.print_boldred("cufflinks failed")
+        return status
+    
+    def get_cufflinks_cmd(self,**kwargs):
+        """Return the cufflinks command with the stored arguments overridden by kwargs
+        """
+        #override existing arguments
+        merged_args_dict={**self.passed_args_dict,**kwargs}
+       
+        cufflinks_cmd=['cufflinks']
+        #add options
+        cufflinks_cmd.extend(pu.parse_unix_args(self.valid_args_list,merged_args_dict))
+        return cufflinks_cmd
+    
     
     
 class Trinity(Assembly):
@@ -428,6 +492,8 @@ class Trinity(Assembly):
                               '--bflyGCThreads','--bflyCPU','--bflyCalculateCPU','--bfly_jar','--quality_trimming_params','--normalize_max_read_cov',
                               '--normalize_by_read_set','--genome_guided_max_intron','--genome_guided_min_coverage','--genome_guided_min_reads_per_partition',
                               '--grid_conf','--grid_node_CPU','--grid_node_max_memory']
+        #flags setting the number of threads; threads are taken from the thread budget if not set
+        self.thread_args=['--CPU']
 
         
         #keep the passed arguments
@@ -526,21 +592,39 @@ class Trinity(Assembly):
         :rtype: bool
         """
             
-        #override existing arguments
-        merged_args_dict={**self.passed_args_dict,**kwargs}
-       
-        trinity_cmd=['Trinity']
-        #add options
-        trinity_cmd.extend(pu.parse_unix_args(self.valid_args_list,merged_args_dict))        
+        trinity_cmd=self.get_trinity_cmd(**kwargs)
         
         
         #start ececution
-        status=pe.execute_command(trinity_cmd,verbose=verbose,quiet=quiet,logs=logs,objectid=objectid)
+        status=pe.execute_command(trinity_cmd,verbose=verbose,quiet=quiet,logs=logs,objectid=objectid,thread_flags=self.thread_args)
         if not status:
             pu.print_boldred("trinity failed")
         #return status
         return status
     
+    async def run_trinity_async(self,verbose=False,quiet=False,logs=True,objectid="NA",**kwargs):
+        """Coroutine version of run_trinity. Parameters are same as run_trinity.
+        
+        :return: Return the status of trinity command.
+        :rtype: bool
+        """
+        trinity_cmd=self.get_trinity_cmd(**kwargs)
+        status=await pe.execute_command_async(trinity_cmd,verbose=verbose,quiet=quiet,logs=logs,objectid=objectid,thread_flags=self.thread_args)
+        if not status:
+            pu.print_boldred("trinity failed")
+        return status
+    
+    def get_trinity_cmd(self,**kwargs):
+        """Return the trinity command with the stored arguments overridden by kwargs
+        """
+        #override existing arguments
+        merged_args_dict={**self.passed_args_dict,**kwargs}
+       
+        trinity_cmd=['Trinity']
+        #add options
+        trinity_cmd.extend(pu.parse_unix_args(self.valid_args_list,merged_args_dict))
+        return trinity_cmd
+    
     
     
     
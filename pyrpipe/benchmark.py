@@ -7,15 +7,16 @@ Created on Sat Dec 21 16:58:13 2019
 """
 
 from pyrpipe import pyrpipe_utils as pu
-import datetime as dt
-import json
+from pyrpipe import log_reader
 import seaborn as sns
 import pandas as pd
-import copy 
 import matplotlib.pyplot as plt
 
 import os
 
+#resource usage fields in the logs
+RUSAGE_FIELDS=['utime','stime','maxrss','inblock','oublock','nvcsw','nivcsw']
+
 class Benchmark:
     """Class to generate benchmark reports from pyrpipe logs.
     
@@ -40,8 +41,6 @@ class Benchmark:
             out_dir=os.getcwd()
         self.log_file=log_file
         self.env_log=env_log
-        self.runtimes_by_prog={}
-        self.runtimes_by_object={}
         #init
         pu.print_blue("parsing log...")
         self.parse_logs()
@@ -56,112 +55,80 @@ class Benchmark:
         
     def parse_runtime(self,timestring):
         """
-        Parse runtime as string and return seconds.
+        Parse runtime from the log and return seconds.
         
         Returns: float
             runtime in sec
         """
-        try:
-            runtime= dt.datetime.strptime(timestring,"%H:%M:%S")
-            delta_time = dt.timedelta(days=0,hours=runtime.hour, minutes=runtime.minute, seconds=runtime.second)
-            return delta_time.seconds
-        except ValueError:
-            #try days format
-            temp=timestring.split(",")
-            days=int(temp[0].split(" ")[0].strip())
-            rest=temp[1].strip()
-            #hours=int(days)*24
-            runtime= dt.datetime.strptime(rest,"%H:%M:%S")
-            #one day less
-            #lastruntime=lastruntime+dt.timedelta(days=days-1)
-            delta_time = dt.timedelta(days=days,hours=runtime.hour, minutes=runtime.minute, seconds=runtime.second)
-            return delta_time.seconds+(86400*days)
+        return pu.parse_runtime(timestring)
         
     def parse_logs(self):
-        """Parse the input logs.
-        For each command create a dict with runtimes as list and program name as key
-        For each object id in input log create a dict.
-        The followind dicts are created:
-        
-        runtimes_by_prog contains runtimes for each program. program is the key and the runtimes are in a list in order as they apprear in the log file.
-        
-        runtimes_by_object is nested a dict containing runtimes for each object by each program. e.g. {'ob1':{'prog1':[1,2,3],'prog2':[1,2,3]}, 'ob2':{'prog1':[12,22,13],'prog2':[1,2,3]} }
+        """Parse the input logs in one pass and store the successful commands in a dataframe, self.records,
+        with columns program, objectid, runtime and the resource usage fields (NaN if not in the log).
+        Failed commands are ignored.
         """
-        
-        
-        
-        with open(self.log_file) as f:
-            data=f.read().splitlines()
+        programs=[]
+        objectids=[]
+        runtimes=[]
+        resources={k:[] for k in RUSAGE_FIELDS}
         num_commands=0
-
+        fields=['exitcode','commandname','cmd','objectid','runtime']+RUSAGE_FIELDS
+        for thisDict in log_reader.read_log(self.log_file,fields=fields):
+            num_commands+=1
+            #ignore failed commands
+            if thisDict['exitcode']!=0:
+                continue
+            try:
+                programname=thisDict['commandname']
+            except KeyError:
+                #for older logs
+                programname=thisDict['cmd'].split(" ")[0]
+            try:
+                objectid=thisDict['objectid']
+            except KeyError:
+                objectid='SRR'+str(num_commands%50)
+            programs.append(programname)
+            objectids.append(objectid)
+            runtimes.append(thisDict['runtime'])
+            for k in RUSAGE_FIELDS:
+                resources[k].append(thisDict.get(k))
+        
+        self.records=pd.DataFrame({'program':programs,'objectid':objectids,'runtime':runtimes,**resources})
+        for k in RUSAGE_FIELDS:
+            self.records[k]=pd.to_numeric(self.records[k])
+    
+    @property
+    def runtimes_by_prog(self):
+        """dict with runtimes of each program, in the order they appear in the log e.g. {'prog1':[1,2,3],'prog2':[1,2]}
+        """
+        return {k:list(v) for k,v in self.records.groupby('program',sort=False)['runtime']}
+    
+    @property
+    def runtimes_by_object(self):
+        """nested dict with runtimes of each program for each object e.g. {'ob1':{'prog1':[1,2,3]},'ob2':{'prog1':[12,22]}}
+        """
+        result={}
+        for (ob,prog),v in self.records.groupby(['objectid','program'],sort=False)['runtime']:
+            result.setdefault(ob,{})[prog]=list(v)
+        return result
     
-        for l in data:
-            if not l.startswith("#"):
-                thisDict=json.loads(l)
-                num_commands+=1
-                #ignore failed commands
-                if int(thisDict['exitcode'])!=0:
-                    continue
-                             
-                #store runtimes by programname
-                try:
-                    programname=thisDict['commandname']
-                except KeyError:
-                    #for older logs
-                    programname=thisDict['cmd'].split(" ")[0]
-                runtime=self.parse_runtime(thisDict['runtime'])
-                #add to dict
-                if programname in self.runtimes_by_prog:
-                    self.runtimes_by_prog[programname].append(runtime)
-                else:
-                    self.runtimes_by_prog[programname]=[runtime]
-                    
-                #store runtimes by object id
-                try:
-                    objectid=thisDict['objectid']
-                except KeyError:
-                    objectid='SRR'+str(num_commands%50)
-                
-                if objectid in self.runtimes_by_object:
-                    #if the object is used with same program extend the list
-                    if programname in self.runtimes_by_object[objectid]:
-                        self.runtimes_by_object[objectid][programname].append(runtime)
-                    else:
-                        self.runtimes_by_object[objectid][programname]=[runtime]
-                else:
-                    self.runtimes_by_object[objectid]={programname:[runtime]}
-                
-        #print(self.runtimes_by_prog)
-        #print(self.runtimes_by_object)
-                                   
     def get_time_perobject(self,func="sum"):
         """Returns a dataframe containing total execution time for each object in a pyrpipe log.
         An object is identified by the objectid e.g. SRR accession.
+        There is one column per program with the sum (or mean if func is "mean") of its runtimes for the object,
+        a column id and a column total with sum of the program columns.
         """
-        result=pd.DataFrame()
-        for k in self.runtimes_by_object:
-            
-            v=copy.deepcopy(self.runtimes_by_object[k]) #don't change the self.runtimes_by_object
-            
-            totaltime=0
-            for prog in v:
-                runtimes=v[prog]                
-                if func == "mean":
-                    valtoput=sum(runtimes)/len(runtimes)
-                    totaltime+=valtoput
-                    v[prog]=[valtoput]
-                else:                    
-                    valtoput=sum(runtimes)
-                    totaltime+=valtoput
-                    v[prog]=[valtoput]
-                    
-            #add current id
-            v['id']=k
-            v['total']=totaltime
-            
-            result=result.append(pd.DataFrame.from_dict(v),sort=False)
-            
-        return result
+        if func!="mean":
+            func="sum"
+        result=self.records.pivot_table(index='objectid',columns='program',values='runtime',aggfunc=func)
+        #keep objects and programs in the order they appear in the log
+        result=result.reindex(index=self.records['objectid'].unique(),columns=self.records['program'].unique())
+        result.columns.name=None
+        result['total']=result.sum(axis=1)
+        result=result.rename_axis('id').reset_index()
+        #put id after the programs
+        cols=[c for c in result.columns if c not in ['id','total']]
+        return result[cols+['id','total']]
         
     def plot_time_perobject(self):
         """Function to plot charts summarizing runtimes for each object in the pipeline.
@@ -222,32 +189,63 @@ class Benchmark:
     def get_time_perprogram(self):
         """Returns a dataframe with program execution times.
         """
-        result=pd.DataFrame()
-        for k in self.runtimes_by_prog:
-            v=self.runtimes_by_prog[k]
-            total=sum(v)
-            mean=sum(v)/len(v)
-            row={'program':k,'total':[total],'average':[mean]}
-            #add row to dataframe
-            result=result.append(pd.DataFrame.from_dict(row),sort=False)
-        return result
+        return self.records.groupby('program',sort=False)['runtime'].agg(total='sum',average='mean').reset_index()
     
-    def get_programtime_boxdata(self):
-        """Return dataframe to make box plot of program times
+    def get_resources_perprogram(self):
+        """Returns a dataframe with resource usage of each program: cpu time, cpu utilization (average number of cores used),
+        peak memory, disk i/o and context switches. Only commands with resource usage in the logs are included.
         """
-        box_data=pd.DataFrame({ key:pd.Series(value) for key, value in self.runtimes_by_prog.items() })
-        #return box_data
-        
+        data=self.records[self.records['utime'].notna()].copy()
+        data['cpu']=data['utime']+data['stime']
+        result=data.groupby('program',sort=False).agg(total_cpu=('cpu','sum'),
+                                                      average_cpu=('cpu','mean'),
+                                                      user_cpu=('utime','sum'),
+                                                      system_cpu=('stime','sum'),
+                                                      runtime=('runtime','sum'),
+                                                      max_rss_mb=('maxrss','max'),
+                                                      read_mb=('inblock','sum'),
+                                                      write_mb=('oublock','sum'),
+                                                      voluntary_cs=('nvcsw','sum'),
+                                                      involuntary_cs=('nivcsw','sum')).reset_index()
+        result['cpu_utilization']=(result['total_cpu']/result['runtime']).where(result['runtime']>0)
+        result['max_rss_mb']=result['max_rss_mb']/1024
+        #blocks are 512 bytes
+        result['read_mb']=result['read_mb']*512/1024**2
+        result['write_mb']=result['write_mb']*512/1024**2
+        return result[['program','total_cpu','average_cpu','user_cpu','system_cpu','cpu_utilization',
+                       'max_rss_mb','read_mb','write_mb','voluntary_cs','involuntary_cs']]
+    
+    def plot_resources_perprogram(self):
+        """Function to plot cpu utilization and peak memory of each program.
+        The charts and data are saved to the out_dir path.
+        """
+        data=self.get_resources_perprogram()
+        if data.shape[0]<1:
+            pu.print_yellow("No resource usage found in the log")
+            return
         
-        ndf=pd.DataFrame(columns=['data','name'])
-        for i in range(box_data.shape[1]):
-            to_append=list(box_data.iloc[:,i])
-            col_name=box_data.columns[i]
-            col_list=[col_name for x in to_append]
-            for j in range(len(to_append)):
-                ndf=ndf.append({'data':to_append[j],'name':col_list[j]},ignore_index=True )
+        sns.set_context('poster')
+        f, axes = plt.subplots(1,2,figsize=(20, data.shape[0]*2))
+        current_palette = sns.color_palette("colorblind")
+        sns.barplot(x = 'cpu_utilization', y = 'program', data = data, color = current_palette[0], ax=axes[0])
+        axes[0].set(xlabel='cpu utilization (cores)',ylabel='')
+        sns.barplot(x = 'max_rss_mb', y = 'program', data = data, color = current_palette[1], ax=axes[1])
+        axes[1].set(xlabel='peak memory (MB)',ylabel='')
+        sns.despine(left = True, bottom = True)
+        plotfile=os.path.join(self.benchmark_dir,'resources_per_program.png')
+        plt.savefig(plotfile,bbox_inches='tight')
+        plt.clf()
         
-        return ndf
+        outfile=os.path.join(self.benchmark_dir,'resources_per_program.csv')
+        data.to_csv(outfile, index=False)
+    
+    def get_programtime_boxdata(self):
+        """Return dataframe to make box plot of program times.
+        Columns are data (runtime) and name (program); rows are grouped by program.
+        """
+        ndf=self.records[['runtime','program']].rename(columns={'runtime':'data','program':'name'})
+        codes,uniques=pd.factorize(ndf['name'])
+        return ndf.iloc[codes.argsort(kind='stable')].reset_index(drop=True)
         
         
     def plot_time_perprogram(self):
@@ -284,7 +282,7 @@ class Benchmark:
         #convert data to floats for boxplot
         box_data['data']=box_data['data'].astype(float)
         #print(box_data)
-        numprog=len(self.runtimes_by_prog.keys())
+        numprog=self.records['program'].nunique()
         #sns.set(style="ticks")
         # Initialize the figure with a logarithmic x axis
         f, ax = plt.subplots(figsize=(20, numprog*2))
@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Shared registry of indexes built by Hisat2, Star, Bowtie2, Kallisto and Salmon.
+
+Indexes are saved under the registry directory in <tool>/<key>, where key is a hash of the tool, the version of the
+index builder, the contents of the reference files and the build parameters. build_index() of each tool looks up
+the registry first and only builds the index if no matching index exists. The files of the index are then
+linked into the index path requested by the user, so every project shares one copy of each index.
+Builds of the same index by concurrent pipelines are serialized with a lock file; the second build waits and reuses
+the index built by the first.
+
+The registry is off by default and indexes are built in the index path, as before.
+Enable it with set_registry_dir(path) or by setting the PYRPIPE_INDEX_REGISTRY environment variable to a directory.
+Indexes can take many GB, so choose a directory with enough space.
+"""
+
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import threading
+from pyrpipe import pyrpipe_utils as pu
+from pyrpipe import pyrpipe_engine as pe
+
+#name of the index inside a registry entry
+ENTRY_INDEX_NAME="index"
+HASH_CHUNK_BYTES=4*1024*1024
+
+registry_dir_path=None
+file_hash_lock=threading.Lock()
+
+
+def set_registry_dir(registry_dir):
+    """Set the directory of the index registry.
+
+    Parameters
+    ----------
+
+    registry_dir: str
+        path to the registry. None to use $PYRPIPE_INDEX_REGISTRY and False to disable the registry.
+    """
+    global registry_dir_path
+    registry_dir_path=registry_dir
+
+def get_registry_dir():
+    """Return path to the index registry
+
+    :return: path or None if the registry is disabled
+    :rtype: string
+    """
+    if registry_dir_path is False:
+        return None
+    if registry_dir_path:
+        return registry_dir_path
+    env_dir=os.environ.get('PYRPIPE_INDEX_REGISTRY')
+    if env_dir and env_dir.lower()!="off":
+        return env_dir
+    return None
+
+def get_file_hash(path):
+    """Return sha256 of the contents of a file.
+    Hashes are saved in the registry with the size and modification time of the file so each file is read only once.
+    """
+    st=os.stat(path)
+    key="{}:{}:{}".format(os.path.realpath(path),st.st_size,st.st_mtime_ns)
+    cache_file=os.path.join(get_registry_dir(),"file_hashes.json")
+    with file_hash_lock:
+        cache=read_json(cache_file) or {}
+    if key in cache:
+        return cache[key]
+
+    sha=hashlib.sha256()
+    with open(path,'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_BYTES),b''):
+            sha.update(chunk)
+    file_hash=sha.hexdigest()
+    with file_hash_lock:
+        #keep entries added by other processes
+        cache=read_json(cache_file) or {}
+        cache[key]=file_hash
+        write_json(cache_file,cache)
+    return file_hash
+
+def read_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError,ValueError):
+        return None
+
+def write_json(path,data):
+    """Write data as JSON; the file is replaced atomically
+    """
+    temp_file=path+"."+str(os.getpid())+"."+str(threading.get_ident())+".tmp"
+    with open(temp_file,'w') as f:
+        json.dump(data,f,indent=1)
+    os.replace(temp_file,path)
+
+def get_index_key(tool,programs,references,params):
+    """Return the registry key of an index and the description it is computed from
+
+    Parameters
+    ----------
+
+    tool: str
+        name of the tool e.g. hisat2
+    programs: list
+        programs used to build the index. Their versions are part of the key.
+    references: list
+        reference files. Their contents are part of the key, not their paths.
+    params: dict
+        build parameters. Values that are paths to existing files (e.g. a GTF) are replaced by the hash of the file.
+
+    :return: key and description
+    :rtype: tuple
+    """
+    def normalize(value):
+        value=str(value)
+        if os.path.isfile(value):
+            return "sha256:"+get_file_hash(value)
+        return value
+
+    description={'tool':tool,
+                 'version':pe.get_versions(programs),
+                 'references':[get_file_hash(r) for r in references],
+                 'params':sorted([k,normalize(v)] for k,v in params.items())
+                 }
+    key=hashlib.sha256(json.dumps(description,sort_keys=True).encode('utf-8')).hexdigest()
+    return key,description
+
+def link_path(source,link):
+    """Symlink source as link, replacing an existing file or link.
+    If link is an existing directory, e.g. an index built before the registry was used, the files of source are linked into it.
+
+    :return: True if linked
+    :rtype: bool
+    """
+    if os.path.isdir(link) and not os.path.islink(link):
+        if not os.path.isdir(source):
+            pu.print_boldred("Can not link index. Directory exists: "+link)
+            return False
+        return all(link_path(os.path.join(source,name),os.path.join(link,name)) for name in os.listdir(source))
+    temp_link=link+"."+str(os.getpid())+".tmp"
+    try:
+        os.symlink(source,temp_link)
+        os.replace(temp_link,link)
+    except OSError as e:
+        pu.print_boldred("Failed to link index {}: {}".format(link,str(e)))
+        return False
+    return True
+
+def link_index(entry_dir,index_path,index_name=None):
+    """Link the index files of a registry entry into index_path.
+    Files named <ENTRY_INDEX_NAME><suffix> are linked as index_path/<index_name><suffix>.
+    If index_name is None all the files in the entry are linked into index_path.
+    Existing directories in index_path, e.g. a salmon index directory, are kept and the index files are linked into them.
+
+    :return: True if linked
+    :rtype: bool
+    """
+    if not pu.check_paths_exist(index_path):
+        if not pu.mkdir(index_path):
+            pu.print_boldred("Failed to create index directory "+index_path)
+            return False
+    for name in os.listdir(entry_dir):
+        if index_name is None:
+            link_name=name
+        elif name==ENTRY_INDEX_NAME or name.startswith(ENTRY_INDEX_NAME+"."):
+            link_name=index_name+name[len(ENTRY_INDEX_NAME):]
+        else:
+            continue
+        if not link_path(os.path.join(entry_dir,name),os.path.join(index_path,link_name)):
+            return False
+    return True
+
+def get_index(tool,programs,references,params,index_path,index_name,build,overwrite=False):
+    """Return an index from the registry, building it only if the registry has no matching index.
+
+    Parameters
+    ----------
+
+    tool: str
+        name of the tool e.g. hisat2
+    programs: list
+        programs used to build the index
+    references: list
+        reference files
+    params: dict
+        parameters that change the index. Parameters that only change the speed of the build (e.g. threads) should be left out.
+    index_path: str
+        directory where the index is linked
+    index_name: str
+        name of the index files in index_path. If None, the files are linked directly into index_path (e.g. STAR).
+    build: function
+        called as build(path,name) to build the index in directory path with name name. Must return True on success.
+        If index_name is None name is None.
+    overwrite: bool
+        rebuild the index even if it is in the registry
+
+    :return: True if the index is available in index_path
+    :rtype: bool
+    """
+    registry_dir=get_registry_dir()
+    if registry_dir is None:
+        return build(index_path,index_name)
+
+    tool_dir=os.path.join(registry_dir,tool)
+    if not pu.check_paths_exist(tool_dir) and not pu.mkdir(tool_dir) and not pu.check_paths_exist(tool_dir):
+        pu.print_boldred("Failed to create index registry {}. Building index in {}".format(tool_dir,index_path))
+        return build(index_path,index_name)
+
+    key,description=get_index_key(tool,programs,references,params)
+    entry_dir=os.path.join(tool_dir,key)
+    manifest_file=entry_dir+".json"
+    entry_name=None if index_name is None else ENTRY_INDEX_NAME
+
+    with open(entry_dir+".lock",'w') as lock_file:
+        #wait for a build of the same index by another pipeline
+        fcntl.flock(lock_file,fcntl.LOCK_EX)
+        try:
+            if not overwrite and read_json(manifest_file) is not None and os.path.isdir(entry_dir):
+                pu.print_green("Using {} index from registry: {}".format(tool,entry_dir))
+            else:
+                if os.path.exists(manifest_file):
+                    os.remove(manifest_file)
+                #remove a partial build
+                shutil.rmtree(entry_dir,ignore_errors=True)
+                os.makedirs(entry_dir)
+                if not build(entry_dir,entry_name):
+                    shutil.rmtree(entry_dir,ignore_errors=True)
+                    return False
+                description['references_paths']=[os.path.abspath(r) for r in references]
+                description['time']=pu.get_iso_time()
+                #the manifest marks a complete index
+                write_json(manifest_file,description)
+        finally:
+            fcntl.flock(lock_file,fcntl.LOCK_UN)
+
+    return link_index(entry_dir,index_path,index_name)
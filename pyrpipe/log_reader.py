@@ -0,0 +1,325 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Streaming reader for pyrpipe logs.
+
+Records are read one line at a time so that memory use does not depend on the size of the log.
+With field projection, values of fields that are not requested (e.g. stdout) are skipped without being decoded.
+When a log has an index (<log>.idx, written by pyrpipe_engine.IndexedFileHandler) records can be looked up by
+objectid, commandname or status without reading the rest of the log.
+Logs rotated by size are saved as numbered segments <log>.1, <log>.2, ... (optionally compressed to .gz or .zst)
+followed by the active segment <log>; readers go through all the segments in order.
+"""
+
+import gzip
+import io
+import json
+import os
+import re
+import struct
+import zlib
+from pyrpipe import pyrpipe_utils as pu
+
+json_decoder=json.JSONDecoder()
+#a JSON string; used to match field names
+STRING_RE=re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"',re.DOTALL)
+WHITESPACE_RE=re.compile(r'[ \t\n\r]*')
+#index entry: offset and length of the record in the log, exitcode, crc32 of objectid and crc32 of commandname
+INDEX_RECORD=struct.Struct('<QIiII')
+#extensions of compressed log segments
+COMPRESSION_EXT={'gzip':'.gz','zstd':'.zst'}
+#suffix of a rotated log segment
+SEGMENT_RE=re.compile(r'\.(\d+)(\.gz|\.zst)?')
+#chunk size used to skip records in segments that can not seek
+SKIP_CHUNK_BYTES=1024*1024
+
+
+def get_crc(value):
+    """Return crc32 of a string, used to index objectid and commandname
+    """
+    return zlib.crc32(str(value).encode('utf-8'))
+
+
+def skip_whitespace(line,idx):
+    return WHITESPACE_RE.match(line,idx).end()
+
+def skip_string(line,idx):
+    """Return the index after the JSON string starting at idx, without decoding it.
+    """
+    end=idx
+    while True:
+        end=line.find('"',end+1)
+        if end<0:
+            raise ValueError("Unterminated string at {}".format(idx))
+        #the quote is escaped if preceded by an odd number of backslashes
+        backslashes=0
+        while line[end-1-backslashes]=='\\':
+            backslashes+=1
+        if backslashes%2==0:
+            return end+1
+
+def parse_fields(line,fields):
+    """Parse the requested fields from a JSON object in line.
+
+    Parameters
+    ----------
+
+    line: string
+        a JSON object
+    fields: set
+        names of the fields to decode
+
+    :return: dict with the requested fields present in line
+    :rtype: dict
+    """
+    record={}
+    idx=skip_whitespace(line,0)
+    if line[idx]!='{':
+        raise ValueError("Expected a JSON object")
+    idx=skip_whitespace(line,idx+1)
+    if line[idx]=='}':
+        return record
+    while True:
+        match=STRING_RE.match(line,idx)
+        if not match:
+            raise ValueError("Expected a field name at {}".format(idx))
+        key=json.loads(match.group())
+        idx=skip_whitespace(line,match.end())
+        if line[idx]!=':':
+            raise ValueError("Expected : at {}".format(idx))
+        idx=skip_whitespace(line,idx+1)
+        if key in fields:
+            record[key],idx=json_decoder.raw_decode(line,idx)
+        elif line[idx]=='"':
+            idx=skip_string(line,idx)
+        else:
+            value,idx=json_decoder.raw_decode(line,idx)
+        idx=skip_whitespace(line,idx)
+        if line[idx]==',':
+            idx=skip_whitespace(line,idx+1)
+        elif line[idx]=='}':
+            return record
+        else:
+            raise ValueError("Expected , or }} at {}".format(idx))
+
+def normalize_record(record):
+    """Convert exitcode to int and runtime to float seconds. Older logs save these as strings.
+    """
+    if 'exitcode' in record:
+        record['exitcode']=int(record['exitcode'])
+    if 'runtime' in record:
+        record['runtime']=pu.parse_runtime(record['runtime'])
+    return record
+
+def get_log_base(log_file):
+    """Return the path of the active segment of a log, given the path to any of its segments
+    """
+    dirname,name=os.path.split(log_file)
+    root,ext=os.path.splitext(name)
+    #e.g. x.log.2.gz
+    while ext and (ext in COMPRESSION_EXT.values() or ext[1:].isdigit()):
+        name=root
+        root,ext=os.path.splitext(name)
+    return os.path.join(dirname,name)
+
+def get_env_log(log_file):
+    """Return path to the ENV log of a log
+    """
+    base=get_log_base(log_file)
+    return os.path.join(os.path.dirname(base),os.path.splitext(os.path.basename(base))[0]+"ENV.log")
+
+def list_segments(log_file):
+    """Return the rotated segments of a log as a sorted list of (number, path).
+    If the compression of a segment was interrupted the uncompressed segment is used.
+    """
+    base=get_log_base(log_file)
+    dirname,name=os.path.split(base)
+    segments={}
+    for entry in os.listdir(dirname or '.'):
+        if not entry.startswith(name):
+            continue
+        match=SEGMENT_RE.fullmatch(entry,len(name))
+        if not match:
+            continue
+        n=int(match.group(1))
+        if n not in segments or not match.group(2):
+            segments[n]=os.path.join(dirname,entry)
+    return sorted(segments.items())
+
+def get_log_segments(log_file):
+    """Return paths to all segments of a log, in the order they were written
+    """
+    base=get_log_base(log_file)
+    segments=[path for n,path in list_segments(base)]
+    if os.path.isfile(base):
+        segments.append(base)
+    return segments
+
+def get_segment_index(segment):
+    """Return path to the index of a log segment
+    """
+    for ext in COMPRESSION_EXT.values():
+        if segment.endswith(ext):
+            return segment[:-len(ext)]+".idx"
+    return segment+".idx"
+
+def open_segment(segment):
+    """Open a log segment for reading in binary mode, decompressing it if needed.
+    
+    :return: file object or None if the segment can not be read
+    """
+    if segment.endswith(COMPRESSION_EXT['gzip']):
+        return gzip.open(segment,'rb')
+    if segment.endswith(COMPRESSION_EXT['zstd']):
+        try:
+            import zstandard
+        except ImportError:
+            pu.print_boldred("zstandard is required to read {}".format(segment))
+            return None
+        return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(open(segment,'rb'),closefd=True))
+    return open(segment,'rb')
+
+def read_lines(f):
+    """Iterate over the lines in a segment opened with open_segment.
+    A truncated compressed segment is read up to the truncation.
+    """
+    try:
+        for line in f:
+            yield line.decode('utf-8',errors='replace')
+    except EOFError:
+        pu.print_boldred("Log segment {} is truncated".format(getattr(f,'name',"")))
+
+def seek_forward(f,position,offset):
+    """Move from position to offset in a segment. Segments that can not seek (zstd) are read up to offset.
+    """
+    if f.seekable():
+        f.seek(offset)
+        return
+    while position<offset:
+        chunk=f.read(min(offset-position,SKIP_CHUNK_BYTES))
+        if not chunk:
+            return
+        position+=len(chunk)
+
+def parse_record(line,fields):
+    """Parse a log line. Return None for comments and incomplete records.
+    """
+    if line.startswith("#") or not line.strip():
+        return None
+    try:
+        if fields is None:
+            record=json.loads(line)
+        else:
+            record=parse_fields(line,fields)
+    except (ValueError,IndexError):
+        return None
+    return normalize_record(record)
+
+def read_index(index_file):
+    """Read the entries of a log index
+
+    :return: list of tuples (offset, length, exitcode, objectid crc32, commandname crc32)
+    :rtype: list
+    """
+    with open(index_file,'rb') as f:
+        data=f.read()
+    #ignore a partially written last entry
+    data=data[:len(data)-len(data)%INDEX_RECORD.size]
+    return list(INDEX_RECORD.iter_unpack(data))
+
+def read_log(log_file,fields=None,objectid=None,commandname=None,passed=None):
+    """Read records from a pyrpipe command log one at a time.
+    Comment lines and incomplete records (e.g. the last line of a log from a crashed run) are skipped.
+    If any filter is given and the log has an index, only the matching records are read from the log.
+
+    Parameters
+    ----------
+
+    log_file: string
+        path to the log file
+    fields: list
+        names of the fields to return. If None, all fields are returned.
+        Values of the other fields are not decoded.
+    objectid: string
+        return only records with this objectid
+    commandname: string
+        return only records with this commandname
+    passed: bool
+        if True return only records with exitcode 0, if False only records with nonzero exitcode
+
+    :return: generator of records as dict with exitcode as int and runtime as float seconds
+    :rtype: generator
+    """
+    filters={}
+    if objectid is not None:
+        filters['objectid']=str(objectid)
+    if commandname is not None:
+        filters['commandname']=str(commandname)
+    extra=set()
+    if fields is not None:
+        fields=set(fields)
+        extra=(set(filters)|({'exitcode'} if passed is not None else set()))-fields
+        fields|=extra
+    
+    def select(record):
+        for k,v in filters.items():
+            if str(record.get(k))!=v:
+                return None
+        if passed is not None and (record.get('exitcode')==0)!=passed:
+            return None
+        for k in extra:
+            record.pop(k,None)
+        return record
+    
+    for segment in get_log_segments(log_file):
+        f=open_segment(segment)
+        if f is None:
+            continue
+        with f:
+            index_file=get_segment_index(segment)
+            if (filters or passed is not None) and os.path.isfile(index_file):
+                yield from read_indexed(f,index_file,fields,filters,passed,select)
+                continue
+            for line in read_lines(f):
+                record=parse_record(line,fields)
+                if record is None:
+                    continue
+                record=select(record)
+                if record is not None:
+                    yield record
+
+def read_indexed(f,index_file,fields,filters,passed,select):
+    """Read the records matching filters from a log segment using its index.
+    Records appended after the last indexed record (e.g. if the index write was interrupted) are scanned.
+    """
+    objectid_crc=get_crc(filters['objectid']) if 'objectid' in filters else None
+    commandname_crc=get_crc(filters['commandname']) if 'commandname' in filters else None
+    end=0
+    position=0
+    try:
+        for offset,length,exitcode,objectid_hash,commandname_hash in read_index(index_file):
+            end=max(end,offset+length)
+            if objectid_crc is not None and objectid_hash!=objectid_crc:
+                continue
+            if commandname_crc is not None and commandname_hash!=commandname_crc:
+                continue
+            if passed is not None and (exitcode==0)!=passed:
+                continue
+            seek_forward(f,position,offset)
+            record=parse_record(f.read(length).decode('utf-8',errors='replace'),fields)
+            position=offset+length
+            #crc32 may collide; verify the record
+            if record is not None:
+                record=select(record)
+            if record is not None:
+                yield record
+        seek_forward(f,position,end)
+    except EOFError:
+        pu.print_boldred("Log segment {} is truncated".format(getattr(f,'name',"")))
+        return
+    for line in read_lines(f):
+        record=parse_record(line,fields)
+        if record is not None:
+            record=select(record)
+        if record is not None:
+            yield record
@@ -9,7 +9,12 @@ contains classes of RNA-Seq alignment programs
 
 from pyrpipe import pyrpipe_utils as pu
 from pyrpipe import pyrpipe_engine as pe
+from pyrpipe import index_registry
+from pyrpipe import tools
 import os
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 
 class Aligner:
     """This is an abstract class for alignment programs.
@@ -17,6 +22,8 @@ class Aligner:
     def __init__(self,index=""):
         self.category="Aligner"
         self.passedArgumentDict={}
+        #flags setting the number of threads of the aligner
+        self.thread_args=[]
         self.index=index
         
     def build_index(self):
@@ -33,6 +40,94 @@ class Aligner:
         
         """
         pass
+    
+    def close_sra_stream(self,sra_object,status):
+        """If the fastq of sra_object is streamed through FIFOs, wait for the stream to finish.
+        
+        :return: status if the stream finished successfully else False
+        :rtype: bool
+        """
+        if hasattr(sra_object,'is_streaming') and sra_object.is_streaming():
+            if not sra_object.close_stream():
+                return False
+        return status
+    
+    def run_piped_to_bam(self,aligner_cmd,out_bam,verbose=False,quiet=False,logs=True,objectid="NA",inputs=None,force=False):
+        """Run an aligner writing SAM to stdout and pipe it through samtools view and samtools sort.
+        No intermediate SAM or unsorted BAM is written to disk. Threads are taken from the thread budget (or the Scheduler job)
+        and split between the aligner and samtools sort; memory and temporary files of samtools sort are set as in get_piped_to_bam_cmds.
+        
+        Parameters
+        ----------
+        
+        aligner_cmd: list
+            the aligner command. It must write SAM records to stdout.
+        out_bam: string
+            path to the output sorted bam file
+        inputs: list
+            input files of the aligner. The pipeline is skipped if out_bam is up to date with these.
+        force: bool
+            Run even if out_bam is up to date
+        
+        :return: Returns the status of the pipeline. True is passed, False if failed.
+        :rtype: bool
+        """
+        threads,granted=pe.acquire_threads(aligner_cmd,self.thread_args)
+        tools.start_sort()
+        try:
+            cmds=self.get_piped_to_bam_cmds(aligner_cmd,out_bam,threads)
+            checkpoint=" | ".join([" ".join(c) for c in self.get_piped_to_bam_cmds(aligner_cmd,out_bam)])
+            return pe.execute_pipeline(cmds,verbose=verbose,quiet=quiet,logs=logs,objectid=objectid,command_name=aligner_cmd[0]+"|samtools",inputs=inputs,outputs=[out_bam],force=force,
+                                       checkpoint_message=checkpoint)
+        finally:
+            tools.end_sort()
+            pe.thread_budget.release(granted)
+    
+    async def run_piped_to_bam_async(self,aligner_cmd,out_bam,verbose=False,quiet=False,logs=True,objectid="NA",inputs=None,force=False):
+        """Coroutine version of run_piped_to_bam
+        """
+        threads,granted=await pe.acquire_threads_async(aligner_cmd,self.thread_args)
+        tools.start_sort()
+        try:
+            cmds=self.get_piped_to_bam_cmds(aligner_cmd,out_bam,threads)
+            checkpoint=" | ".join([" ".join(c) for c in self.get_piped_to_bam_cmds(aligner_cmd,out_bam)])
+            return await pe.execute_pipeline_async(cmds,verbose=verbose,quiet=quiet,logs=logs,objectid=objectid,command_name=aligner_cmd[0]+"|samtools",inputs=inputs,outputs=[out_bam],force=force,
+                                                   checkpoint_message=checkpoint)
+        finally:
+            tools.end_sort()
+            pe.thread_budget.release(granted)
+    
+    def get_piped_to_bam_cmds(self,aligner_cmd,out_bam,threads=None):
+        """Return the commands of the aligner | samtools view | samtools sort pipeline.
+        
+        Parameters
+        ----------
+        
+        aligner_cmd: list
+            the aligner command
+        out_bam: string
+            path to the output sorted bam file
+        threads: int
+            threads granted to the pipeline by the thread budget or the Scheduler job. They are split between the aligner and
+            samtools sort (see tools.split_pipeline_threads), so the pipeline does not use more than threads.
+            0 if the aligner command sets its threads; sort then gets its share of that number on top of them.
+            samtools sort is also given memory per thread and the scratch directory (see tools.get_sort_cmds).
+            If None, the commands are returned without these options, as used for checkpoints.
+        
+        :return: list of commands
+        :rtype: list
+        """
+        if not pe.check_dependencies(['samtools']):
+            raise Exception("ERROR: samtools not found. samtools is required to write sorted bam files.")
+        if threads is None:
+            return [aligner_cmd]+tools.get_sort_cmds('-',out_bam,view_args=[])
+        if threads:
+            aligner_threads,sort_threads=tools.split_pipeline_threads(threads)
+            aligner_cmd=pe.add_thread_arg(aligner_cmd,self.thread_args[0],aligner_threads)
+        else:
+            sort_threads=tools.split_pipeline_threads(pe.get_thread_arg(aligner_cmd,self.thread_args) or 1)[1]
+        return [aligner_cmd]+tools.get_sort_cmds('-',out_bam,view_args=[],threads=sort_threads,memory_per_thread=tools.get_sort_memory(max(1,sort_threads)),
+                                                 scratch_dir=tools.get_scratch_dir())
 
 class Hisat2(Aligner):
     """This class represents hisat2 program.
@@ -74,6 +169,8 @@ class Hisat2(Aligner):
                             '--remove-chrname','--add-chrname','--version']
         
         
+        #flags setting the number of threads; threads are taken from the thread budget if not set
+        self.thread_args=['-p','--threads']
         #initialize the passed arguments
         self.passedArgumentDict=kwargs
         
@@ -89,8 +186,10 @@ class Hisat2(Aligner):
         
         
             
-    def build_index(self,index_path,index_name,*args,verbose=False,quiet=False,logs=True,objectid="NA",**kwargs):
+    def build_index(self,index_path,index_name,*args,overwrite=False,verbose=False,quiet=False,logs=True,objectid="NA",**kwargs):
         """Build a hisat index with given parameters and saves the new index to self.hisat2_index.
+        The index is not rebuilt if it was built before from the same references and is unchanged, unless overwrite is True.
+        If the index registry is enabled (see index_registry), the index is saved there and linked into index_path.
         
         Parameters
         ----------
@@ -104,6 +203,9 @@ class Hisat2(Aligner):
         args: tuple
             Path to reference input files
             
+        overwrite : bool
+            Rebuild the index even if it is up to date
+            
         verbose : bool
             Print stdout and std error
             
@@ -134,7 +236,6 @@ class Hisat2(Aligner):
             pu.print_boldred("Please check input reference sequences provided to hisat2-build. Exiting")
             return False
             
-        overwrite=True
         print("Building hisat index...")
         
         hisat2Buildvalid_args=['-c','--large-index','-a','-p','--bmax','--bmaxdivn','--dcv','--nodc','-r','-3','-o',
@@ -146,30 +247,30 @@ class Hisat2(Aligner):
                 print("ERROR in building hisat2 index. Failed to create index directory.")
                 return False
         
-        if not overwrite:
-            #check if files exists
-            if pu.check_hisatindex(os.path.join(index_path,index_name)):
-                print("Hisat2 index with same name already exists. Exiting...")
-                return True
-        
-        hisat2Build_Cmd=['hisat2-build']
-        #add options
-        hisat2Build_Cmd.extend(pu.parse_unix_args(hisat2Buildvalid_args,kwargs))
-        #add input files
-        hisat2Build_Cmd.append(str(",".join(args)))
-        #add dir/basenae
-        hisat2Build_Cmd.append(os.path.join(index_path,index_name))
-        #print("Executing:"+str(" ".join(hisat2Build_Cmd)))
-        
-        #start ececution
-        status=pe.execute_command(hisat2Build_Cmd,verbose=verbose,quiet=quiet,logs=logs,objectid=objectid)
-        if not status:
-            pu.print_boldred("hisatBuild failed")
-            return False
+        def build(build_path,build_name):
+            hisat2Build_Cmd=['hisat2-build']
+            #add options
+            hisat2Build_Cmd.extend(pu.parse_unix_args(hisat2Buildvalid_args,kwargs))
+            #add input files
+            hisat2Build_Cmd.append(str(",".join(args)))
+            #add dir/basenae
+            hisat2Build_Cmd.append(os.path.join(build_path,build_name))
+            
+            #start ececution
+            status=pe.execute_command(hisat2Build_Cmd,verbose=verbose,quiet=quiet,logs=logs,objectid=objectid,inputs=list(args),outputs=[build_path],force=overwrite,thread_flags=['-p'])
+            if not status:
+                pu.print_boldred("hisatBuild failed")
+                return False
+            
+            #check index files
+            if not pu.write_index_manifest('hisat2',os.path.join(build_path,build_name)) or not pu.check_hisatindex(os.path.join(build_path,build_name)):
+                pu.print_boldred("hisatBuild failed")
+                return False
+            return True
         
-        #check index files
-        if not pu.check_hisatindex(os.path.join(index_path,index_name)):
-            pu.print_boldred("hisatBuild failed")
+        #threads do not change the index
+        params={k:v for k,v in kwargs.items() if k not in ['-p','-q']}
+        if not index_registry.get_index("hisat2",['hisat2-build'],args,params,index_path,index_name,build,overwrite=overwrite):
             return False
         
         #set the index path
@@ -180,7 +281,7 @@ class Hisat2(Aligner):
         return True
         
         
-    def perform_alignment(self,sra_object,out_suffix="_hisat2",verbose=False,quiet=False,logs=True,objectid="NA",**kwargs):
+    def perform_alignment(self,sra_object,out_suffix="_hisat2",sorted_bam=False,overwrite=False,verbose=False,quiet=False,logs=True,objectid="NA",**kwargs):
         """Function to perform alignment using sra_object.
         
         Parameters
@@ -190,6 +291,11 @@ class Hisat2(Aligner):
             An object of type SRA. The path to fastq files will be obtained from this object.
         out_suffix: string
             Suffix for the output sam file
+        sorted_bam: bool
+            Pipe hisat2 output directly to samtools sort and return a sorted bam file <srr><out_suffix>_sorted.bam.
+            No sam file is written.
+        overwrite: bool
+            Run hisat2 even if the output is up to date with the fastq files and the index
         verbose: bool
             Print stdout and std error
         quiet: bool
@@ -205,16 +311,8 @@ class Hisat2(Aligner):
         
         #create path to output sam file
         outSamFile=os.path.join(sra_object.location,sra_object.srr_accession+out_suffix+".sam")
-        
-        """
-        Handle overwrite
-        """
-        overwrite=True
-        if not overwrite:
-            #check if file exists. return if yes
-            if os.path.isfile(outSamFile):
-                print("The file "+outSamFile+" already exists. Exiting..")
-                return outSamFile
+        if sorted_bam:
+            outSamFile=os.path.join(sra_object.location,sra_object.srr_accession+out_suffix+"_sorted.bam")
         
         #find layout and fq file paths
         if sra_object.layout == 'PAIRED':
@@ -225,8 +323,16 @@ class Hisat2(Aligner):
         #add input files to kwargs, overwrite kwargs with newOpts
         mergedOpts={**kwargs,**newOpts}
         
+        out_bam=""
+        if sorted_bam:
+            #hisat2 writes to stdout
+            mergedOpts.pop("-S")
+            out_bam=outSamFile
+        
         #call run_hisat2
-        status=self.run_hisat2(verbose=verbose,quiet=quiet,logs=logs,objectid=sra_object.srr_accession,**mergedOpts)
+        inputs=[v for k,v in newOpts.items() if k!="-S"]
+        status=self.run_hisat2(verbose=verbose,quiet=quiet,logs=logs,objectid=sra_object.srr_accession,out_bam=out_bam,inputs=inputs,outputs=[outSamFile],force=overwrite,**mergedOpts)
+        status=self.close_sra_stream(sra_object,status)
         
         if status:
             #check if sam file is present in the location directory of sra_object
@@ -236,12 +342,20 @@ class Hisat2(Aligner):
             return ""
             
         
-    def run_hisat2(self,verbose=False,quiet=False,logs=True,objectid="NA",**kwargs):
+    def run_hisat2(self,verbose=False,quiet=False,logs=True,objectid="NA",out_bam="",inputs=None,outputs=None,force=False,**kwargs):
         """Wrapper for running hisat2.
         
         Parameters
         ----------
         
+        out_bam: string
+            If provided, hisat2 output is piped to samtools sort and saved to this sorted bam file
+        inputs: list
+            input files used for checkpointing. The index is added to these.
+        outputs: list
+            output files. If provided, hisat2 is skipped when these are up to date (see pyrpipe_engine.execute_command).
+        force: bool
+            Run hisat2 even if the outputs are up to date
         verbose: bool
             Print stdout and std error
         quiet: bool
@@ -258,6 +372,44 @@ class Hisat2(Aligner):
         :rtype: bool
         """
         
+        hisat2_Cmd=self.get_hisat2_cmd(**kwargs)
+        
+        if inputs is not None:
+            inputs=inputs+pu.get_index_inputs('hisat2',self.hisat2_index)
+        
+        #execute command
+        if out_bam:
+            cmd_status=self.run_piped_to_bam(hisat2_Cmd,out_bam,verbose=verbose,quiet=quiet,logs=logs,objectid=objectid,inputs=inputs,force=force)
+        else:
+            cmd_status=pe.execute_command(hisat2_Cmd,verbose=verbose,quiet=quiet,logs=logs,objectid=objectid,inputs=inputs,outputs=outputs,force=force,thread_flags=self.thread_args)
+        if not cmd_status:
+            print("hisat2 failed:"+" ".join(hisat2_Cmd))
+     
+        #return status
+        return cmd_status
+    
+    async def run_hisat2_async(self,verbose=False,quiet=False,logs=True,objectid="NA",out_bam="",inputs=None,outputs=None,force=False,**kwargs):
+        """Coroutine version of run_hisat2. Parameters are same as run_hisat2.
+        
+        :return: Returns the status of hisat2. True is passed, False if failed.
+        :rtype: bool
+        """
+        hisat2_Cmd=self.get_hisat2_cmd(**kwargs)
+        
+        if inputs is not None:
+            inputs=inputs+pu.get_index_inputs('hisat2',self.hisat2_index)
+        
+        if out_bam:
+            cmd_status=await self.run_piped_to_bam_async(hisat2_Cmd,out_bam,verbose=verbose,quiet=quiet,logs=logs,objectid=objectid,inputs=inputs,force=force)
+        else:
+            cmd_status=await pe.execute_command_async(hisat2_Cmd,verbose=verbose,quiet=quiet,logs=logs,objectid=objectid,inputs=inputs,outputs=outputs,force=force,thread_flags=self.thread_args)
+        if not cmd_status:
+            print("hisat2 failed:"+" ".join(hisat2_Cmd))
+        return cmd_status
+    
+    def get_hisat2_cmd(self,**kwargs):
+        """Return the hisat2 command with arguments in self.passedArgumentDict overridden by kwargs
+        """
         #check for a valid index
         if not self.check_index():
             raise Exception("ERROR: Invalid HISAT2 index. Please run build index to generate an index.")
@@ -267,15 +419,8 @@ class Hisat2(Aligner):
        
         hisat2_Cmd=['hisat2']
         #add options
-        hisat2_Cmd.extend(pu.parse_unix_args(self.valid_args,mergedArgsDict))        
-        
-        #execute command
-        cmd_status=pe.execute_command(hisat2_Cmd,verbose=verbose,quiet=quiet,logs=logs,objectid=objectid)
-        if not cmd_status:
-            print("hisat2 failed:"+" ".join(hisat2_Cmd))
-     
-        #return status
-        return cmd_status
+        hisat2_Cmd.extend(pu.parse_unix_args(self.valid_args,mergedArgsDict))
+        return hisat2_Cmd
         
         
     
@@ -317,19 +462,21 @@ class Star(Aligner):
                             '--genomeDir','--genomeLoad','--genomeFastaFiles','--genomeChrBinNbits','--genomeSAindexNbases','--genomeSAsparseD','--genomeSuffixLengthMax','--genomeChainFiles','--genomeFileSizes',
                             '--sjdbFileChrStartEnd','--sjdbGTFfile','--sjdbGTFchrPrefix','--sjdbGTFfeatureExon','--sjdbGTFtagExonParentTranscript','--sjdbGTFtagExonParentGene','--sjdbOverhang','--sjdbScore','--sjdbInsertSave',
                             '--inputBAMfile','--readFilesIn','--readFilesCommand','--readMapNumber','--readMatesLengthsIn','--readNameSeparator','--clip3pNbases','--clip5pNbases','--clip3pAdapterSeq','--clip3pAdapterMMp','--clip3pAfterAdapterNbases',
-                            '--limitGenomeGenerateRAM','--limitIObufferSize','--limitOutSAMoneReadBytes','--limitOutSJoneRead','--limitOutSJcollapsed','--limitBAMsortRAM ','--limitSjdbInsertNsj','--outFileNamePrefix','--outTmpDir','--outTmpKeep',
+                            '--limitGenomeGenerateRAM','--limitIObufferSize','--limitOutSAMoneReadBytes','--limitOutSJoneRead','--limitOutSJcollapsed','--limitBAMsortRAM','--limitSjdbInsertNsj','--outFileNamePrefix','--outTmpDir','--outTmpKeep',
                             '--outStd','--outReadsUnmapped','--outQSconversionAdd','--outMultimapperOrder','--outSAMtype','--outSAMmode','--outSAMstrandField','--outSAMattributes','--outSAMattrIHstart','--outSAMunmapped','--outSAMorder',
                             '--outSAMprimaryFlag','--outSAMreadID','--outSAMmapqUnique','--outSAMflagOR','--outSAMflagAND','--outSAMattrRGline','--outSAMheaderHD','--outSAMheaderPG','--outSAMheaderCommentFile','--outSAMfilter','--outSAMmultNmax',
                             '--outBAMcompression','--outBAMsortingThreadN','--bamRemoveDuplicatesType','--bamRemoveDuplicatesMate2basesN','--outWigType','--outWigStrand','--outWigReferencesPrefix','--outWigNorm','--outFilterType',
                             '--outFilterMultimapScoreRange','--outFilterMultimapNmax','--outFilterMismatchNmax','--outFilterMismatchNoverLmax','--outFilterMismatchNoverReadLmax','--outFilterScoreMin','--outFilterScoreMinOverLread',
                             '--outFilterMatchNmin','--outFilterMatchNminOverLread','--outFilterIntronMotifs','--outSJfilterReads','--outSJfilterOverhangMin','--outSJfilterCountUniqueMin','--outSJfilterCountTotalMin','--outSJfilterDistToOtherSJmin',
-                            '--outSJfilterIntronMaxVsReadN','--scoreGap','--scoreGapNoncan','--scoreGapGCAG ','--scoreGapATAC','--scoreGenomicLengthLog2scale','--scoreDelOpen','--scoreDelBase','--scoreInsOpen','--scoreInsBase','--scoreStitchSJshift',
+                            '--outSJfilterIntronMaxVsReadN','--scoreGap','--scoreGapNoncan','--scoreGapGCAG','--scoreGapATAC','--scoreGenomicLengthLog2scale','--scoreDelOpen','--scoreDelBase','--scoreInsOpen','--scoreInsBase','--scoreStitchSJshift',
                             '--seedSearchStartLmax','--seedSearchStartLmaxOverLread','--seedSearchLmax','--seedMultimapNmax','--seedPerReadNmax','--seedPerWindowNmax','--seedNoneLociPerWindow','--alignIntronMin','--alignIntronMax','--alignMatesGapMax',
                             '--alignSJoverhangMin','--alignSJstitchMismatchNmax','--alignSJDBoverhangMin','--alignSplicedMateMapLmin','--alignSplicedMateMapLminOverLmate','--alignWindowsPerReadNmax','--alignTranscriptsPerWindowNmax','--alignTranscriptsPerReadNmax',
                             '--alignEndsType','--alignEndsProtrude','--alignSoftClipAtReferenceEnds','--winAnchorMultimapNmax','--winBinNbits','--winAnchorDistNbins','--winFlankNbins','--winReadCoverageRelativeMin','--winReadCoverageBasesMin',
                             '--chimOutType','--chimSegmentMin','--chimScoreMin','--chimScoreDropMax','--chimScoreSeparation','--chimScoreJunctionNonGTAG','--chimJunctionOverhangMin','--chimSegmentReadGapMax','--chimFilter','--chimMainSegmentMultNmax']
                 
        
+        #flags setting the number of threads; threads are taken from the thread budget if not set
+        self.thread_args=['--runThreadN']
         #initialize the passed arguments
         self.passedArgumentDict=kwargs
         
@@ -345,6 +492,7 @@ class Star(Aligner):
     
     def build_index(self,index_path,*args,verbose=False,quiet=False,logs=True,objectid="NA",**kwargs):
         """Build a star index with given parameters and saves the new index to self.star_index.
+        If the index registry is enabled (see index_registry), the index is saved there and its files are linked into index_path.
         
         Parameters
         ----------
@@ -393,28 +541,29 @@ class Star(Aligner):
                 raise Exception("Error creating STAR index. Exiting.")
                 return False
         
-        #add runMode
-        newOpts={"--runMode":"genomeGenerate","--genomeDir":index_path,"--genomeFastaFiles":" ".join(args)}
-        
-        mergedOpts={**kwargs,**newOpts}
-        
-        starbuild_Cmd=['STAR']
-        starbuild_Cmd.extend(pu.parse_unix_args(self.valid_args,mergedOpts))
-        
-        #execute command
-        status=pe.execute_command(starbuild_Cmd,verbose=verbose,quiet=quiet,logs=logs,objectid=objectid)
-        
+        def build(build_path,build_name):
+            #add runMode
+            newOpts={"--runMode":"genomeGenerate","--genomeDir":build_path,"--genomeFastaFiles":" ".join(args)}
+            
+            mergedOpts={**kwargs,**newOpts}
+            
+            starbuild_Cmd=['STAR']
+            starbuild_Cmd.extend(pu.parse_unix_args(self.valid_args,mergedOpts))
+            
+            #execute command
+            status=pe.execute_command(starbuild_Cmd,verbose=verbose,quiet=quiet,logs=logs,objectid=objectid,thread_flags=self.thread_args)
+            return status and pu.write_index_manifest('star',build_path) and pu.check_starindex(build_path)
         
-        if status:
-            if pu.check_paths_exist(index_path):
-                #update object's index
-                self.star_index=index_path
-                self.passedArgumentDict['--genomeDir']=self.star_index
-                if self.check_index():
-                    return True
-        else:
+        #threads do not change the index
+        params={k:v for k,v in kwargs.items() if k not in ['--runThreadN']}
+        if not index_registry.get_index("star",[self.programName],args,params,index_path,None,build):
             return False
         
+        #update object's index
+        self.star_index=index_path
+        self.passedArgumentDict['--genomeDir']=self.star_index
+        return self.check_index()
+        
  
             
     def perform_alignment(self,sra_object,out_suffix="_star",out_dir="",verbose=False,quiet=False,logs=True,objectid="NA",**kwargs):
@@ -468,6 +617,7 @@ class Star(Aligner):
         
         #call star
         status=self.run_star(verbose=verbose,quiet=quiet,logs=logs,objectid=sra_object.srr_accession,**mergedOpts)
+        status=self.close_sra_stream(sra_object,status)
                 
         
         if status:
@@ -476,6 +626,98 @@ class Star(Aligner):
                 return out_dir
         else:
             return ""
+    
+    def run_genome_load(self,genome_load,verbose=False,quiet=False,logs=True,objectid="NA"):
+        """Run STAR with --genomeLoad genome_load (LoadAndExit or Remove) to load the genome of self.star_index
+        into shared memory or remove it. STAR log files are written to a temporary directory which is then deleted.
+        
+        :return: Returns the status of star. True is passed, False if failed.
+        :rtype: bool
+        """
+        if not self.check_index():
+            raise Exception("ERROR: Invalid star index. Please run build index to generate an index.")
+        tmp_dir=tempfile.mkdtemp(prefix="star_genome_")
+        try:
+            star_cmd=['STAR','--genomeDir',self.star_index,'--genomeLoad',genome_load,'--outFileNamePrefix',tmp_dir+"/"]
+            cmd_status=pe.execute_command(star_cmd,verbose=verbose,quiet=quiet,logs=logs,objectid=objectid)
+        finally:
+            shutil.rmtree(tmp_dir,ignore_errors=True)
+        if not cmd_status:
+            print("STAR failed:"+" ".join(star_cmd))
+        return cmd_status
+    
+    def load_genome(self,verbose=False,quiet=False,logs=True,objectid="NA"):
+        """Load the genome of self.star_index into shared memory. Alignments run with --genomeLoad LoadAndKeep use the
+        loaded genome instead of reading the index. The genome stays in memory until remove_genome() is called.
+        
+        :return: Returns the status of star. True is passed, False if failed.
+        :rtype: bool
+        """
+        return self.run_genome_load("LoadAndExit",verbose=verbose,quiet=quiet,logs=logs,objectid=objectid)
+    
+    def remove_genome(self,verbose=False,quiet=False,logs=True,objectid="NA"):
+        """Remove the genome of self.star_index from shared memory
+        
+        :return: Returns the status of star. True is passed, False if failed.
+        :rtype: bool
+        """
+        return self.run_genome_load("Remove",verbose=verbose,quiet=quiet,logs=logs,objectid=objectid)
+    
+    def perform_batch_alignment(self,sra_objects,out_suffix="_star",out_dir="",jobs=1,verbose=False,quiet=False,logs=True,objectid="NA",**kwargs):
+        """Align many SRA objects with the genome loaded once into shared memory.
+        The genome is loaded with load_genome(), each sample is aligned with perform_alignment() and --genomeLoad LoadAndKeep,
+        and the genome is removed from shared memory when all samples finish, or if an alignment fails.
+        
+        Parameters
+        ----------
+        
+        sra_objects: list
+            SRA objects to align
+        out_suffix: string
+            Suffix for the output file
+        out_dir: str
+            output directory. Output of each sample is written to out_dir/<srr_accession>. default: sra_object.location
+        jobs: int
+            number of samples aligned at the same time. All the jobs share the loaded genome.
+        verbose: bool
+            Print stdout and std error
+        quiet: bool
+            Print nothing
+        logs: bool
+            Log this command to pyrpipe logs
+        objectid: str
+            id attached to the commands loading and removing the genome.
+        kwargs: dict
+            Options to pass to STAR. Sorted BAM output (--outSAMtype BAM SortedByCoordinate) requires --limitBAMsortRAM
+            when the genome is shared.
+        
+        :return: Return dict with accessions as keys and the path to the output dir as values; "" if alignment failed
+        :rtype: dict
+        """
+        sra_objects=list(sra_objects)
+        mergedOpts={**self.passedArgumentDict,**kwargs}
+        if "SortedByCoordinate" in str(mergedOpts.get("--outSAMtype","")) and not mergedOpts.get("--limitBAMsortRAM"):
+            pu.print_boldred("--limitBAMsortRAM is required for sorted BAM output with a shared genome")
+            return {sra_object.srr_accession:"" for sra_object in sra_objects}
+        
+        def align(sra_object):
+            sample_dir=os.path.join(out_dir,sra_object.srr_accession) if out_dir else ""
+            return self.perform_alignment(sra_object,out_suffix=out_suffix,out_dir=sample_dir,verbose=verbose,quiet=quiet,logs=logs,
+                                          **{**kwargs,"--genomeLoad":"LoadAndKeep"})
+        
+        if not self.load_genome(verbose=verbose,quiet=quiet,logs=logs,objectid=objectid):
+            pu.print_boldred("Failed to load STAR genome "+self.star_index)
+            return {sra_object.srr_accession:"" for sra_object in sra_objects}
+        results={}
+        try:
+            #the alignments split the threads of the budget
+            with pe.thread_budget.share(max(1,min(jobs,len(sra_objects)))), ThreadPoolExecutor(max_workers=max(1,jobs)) as pool:
+                for sra_object,result in zip(sra_objects,pool.map(pe.bind_job_context(align),sra_objects)):
+                    results[sra_object.srr_accession]=result
+        finally:
+            if not self.remove_genome(verbose=verbose,quiet=quiet,logs=logs,objectid=objectid):
+                pu.print_boldred("Failed to remove STAR genome "+self.star_index+" from shared memory")
+        return results
         
     
     def run_star(self,verbose=False,quiet=False,logs=True,objectid="NA",**kwargs):
@@ -502,6 +744,32 @@ class Star(Aligner):
         :rtype: bool
         """
         
+        star_cmd=self.get_star_cmd(**kwargs)
+        
+        #execute command
+        cmd_status=pe.execute_command(star_cmd,verbose=verbose,quiet=quiet,logs=logs,objectid=objectid,thread_flags=self.thread_args)
+        
+        if not cmd_status:
+            print("STAR failed:"+" ".join(star_cmd))
+     
+        #return status
+        return cmd_status
+    
+    async def run_star_async(self,verbose=False,quiet=False,logs=True,objectid="NA",**kwargs):
+        """Coroutine version of run_star. Parameters are same as run_star.
+        
+        :return: Returns the status of star. True is passed, False if failed.
+        :rtype: bool
+        """
+        star_cmd=self.get_star_cmd(**kwargs)
+        cmd_status=await pe.execute_command_async(star_cmd,verbose=verbose,quiet=quiet,logs=logs,objectid=objectid,thread_flags=self.thread_args)
+        if not cmd_status:
+            print("STAR failed:"+" ".join(star_cmd))
+        return cmd_status
+    
+    def get_star_cmd(self,**kwargs):
+        """Return the STAR command with arguments in self.passedArgumentDict overridden by kwargs
+        """
         #check for a valid index
         if not self.check_index():
             raise Exception("ERROR: Invalid star index. Please run build index to generate an index.")
@@ -511,16 +779,8 @@ class Star(Aligner):
        
         star_cmd=['STAR']
         #add options
-        star_cmd.extend(pu.parse_unix_args(self.valid_args,mergedArgsDict))        
-        
-        #execute command
-        cmd_status=pe.execute_command(star_cmd,verbose=verbose,quiet=quiet,logs=logs,objectid=objectid)
-        
-        if not cmd_status:
-            print("STAR failed:"+" ".join(star_cmd))
-     
-        #return status
-        return cmd_status
+        star_cmd.extend(pu.parse_unix_args(self.valid_args,mergedArgsDict))
+        return star_cmd
     
     
     def check_index(self):
@@ -570,6 +830,8 @@ class Bowtie2(Aligner):
                             '-p','--threads','--reorder','--mm','--qc-filter','--seed','--non-deterministic',
                             '--version','-h','--help']
         
+        #flags setting the number of threads; threads are taken from the thread budget if not set
+        self.thread_args=['-p','--threads']
         #initialize the passed arguments
         self.passedArgumentDict=kwargs
         
@@ -582,8 +844,10 @@ class Bowtie2(Aligner):
             print("No Bowtie2 index provided. Please build index now to generate an index...")
         
         
-    def build_index(self,index_path,index_name,*args,verbose=False,quiet=False,logs=True,objectid="NA",**kwargs):
+    def build_index(self,index_path,index_name,*args,overwrite=False,verbose=False,quiet=False,logs=True,objectid="NA",**kwargs):
         """Build a bowtie2 index with given parameters and saves the new index to self.bowtie2_index.
+        The index is not rebuilt if it was built before from the same references and is unchanged, unless overwrite is True.
+        If the index registry is enabled (see index_registry), the index is saved there and linked into index_path.
         
         Parameters
         ----------
@@ -594,6 +858,8 @@ class Bowtie2(Aligner):
             A name for the index
         arg3: tuple
             Path to reference input files
+        overwrite: bool
+            Rebuild the index even if it is up to date
         verbose: bool
             Print stdout and std error
         quiet: bool
@@ -620,9 +886,6 @@ class Bowtie2(Aligner):
             pu.print_boldred("Please check input reference sequences provided to bowtie2-build. Exiting")
             return False
             
-        overwrite=True
-        
-        
         bowtie2_build_args=['-f','-c','--large-index','--debug','--sanitized','--verbose','-a',
                             '--noauto','-p','--packed','--bmax','--bmaxdivn','--dcv','--nodc',
                             '-r','--noref','-3','--justref','-o','--offrate','-t','--ftabchars',
@@ -633,30 +896,30 @@ class Bowtie2(Aligner):
                 print("ERROR in building bowtie2 index. Failed to create index directory.")
                 return False
         
-        if not overwrite:
-            #check if files exists
-            if pu.check_bowtie2index(os.path.join(index_path,index_name)):
-                print("bowtie2 index with same name already exists. Exiting...")
-                return True
+        def build(build_path,build_name):
+            bowtie2Build_Cmd=['bowtie2-build']
+            #add options
+            bowtie2Build_Cmd.extend(pu.parse_unix_args(bowtie2_build_args,kwargs))
+            #add input files
+            bowtie2Build_Cmd.append(str(",".join(args)))
+            #add dir/basenae
+            bowtie2Build_Cmd.append(os.path.join(build_path,build_name))
             
-        bowtie2Build_Cmd=['bowtie2-build']
-        #add options
-        bowtie2Build_Cmd.extend(pu.parse_unix_args(bowtie2_build_args,kwargs))
-        #add input files
-        bowtie2Build_Cmd.append(str(",".join(args)))
-        #add dir/basenae
-        bowtie2Build_Cmd.append(os.path.join(index_path,index_name))
-        #print("Executing:"+str(" ".join(hisat2Build_Cmd)))
-        
-        #start ececution
-        status=pe.execute_command(bowtie2Build_Cmd,verbose=verbose,quiet=quiet,logs=logs,objectid=objectid)
-        if not status:
-            pu.print_boldred("bowtie2-build failed")
-            return False
+            #start ececution
+            status=pe.execute_command(bowtie2Build_Cmd,verbose=verbose,quiet=quiet,logs=logs,objectid=objectid,inputs=list(args),outputs=[build_path],force=overwrite,thread_flags=['--threads'])
+            if not status:
+                pu.print_boldred("bowtie2-build failed")
+                return False
+            
+            #check index files
+            if not pu.write_index_manifest('bowtie2',os.path.join(build_path,build_name)) or not pu.check_bowtie2index(os.path.join(build_path,build_name)):
+                pu.print_boldred("bowtie2-build failed")
+                return False
+            return True
         
-        #check index files
-        if not pu.check_bowtie2index(os.path.join(index_path,index_name)):
-            pu.print_boldred("bowtie2-build failed")
+        #threads and messages do not change the index
+        params={k:v for k,v in kwargs.items() if k not in ['--threads','--verbose','-q','--quiet']}
+        if not index_registry.get_index("bowtie2",['bowtie2-build'],args,params,index_path,index_name,build,overwrite=overwrite):
             return False
         
         #set the index path
@@ -667,7 +930,7 @@ class Bowtie2(Aligner):
         return True
         
     
-    def perform_alignment(self,sra_object,out_suffix="_bt2",out_dir="",overwrite=True,verbose=False,quiet=False,logs=True,objectid="NA",**kwargs):
+    def perform_alignment(self,sra_object,out_suffix="_bt2",out_dir="",overwrite=False,sorted_bam=False,verbose=False,quiet=False,logs=True,objectid="NA",**kwargs):
         """Function to perform alignment using self object and the provided sra_object.
         
         Parameters
@@ -677,6 +940,11 @@ class Bowtie2(Aligner):
             An object of type SRA. The path to fastq files will be obtained from this object.
         out_suffix: string
             Suffix for the output sam file
+        overwrite: bool
+            Run bowtie2 even if the output is up to date with the fastq files and the index
+        sorted_bam: bool
+            Pipe bowtie2 output directly to samtools sort and return a sorted bam file <srr><out_suffix>_sorted.bam.
+            No sam file is written.
         verbose: bool
             Print stdout and std error
         quiet: bool
@@ -688,7 +956,7 @@ class Bowtie2(Aligner):
         kwargs: dict
             Options to pass to bowtie2. This will override the existing options in self.passed_args_dict (only replace existing arguments and not replace all the arguments).
         
-        :return: Returns the output sam file path
+        :return: Returns the output sam (or sorted bam) file path
         :rtype: string
         """
         if not out_dir:
@@ -699,16 +967,8 @@ class Bowtie2(Aligner):
                 
         #create path to output sam file
         outFile=os.path.join(out_dir,sra_object.srr_accession+out_suffix+".sam")
-                    
-        """
-        Handle overwrite
-        """
-        overwrite=True
-        if not overwrite:
-            #check if file exists. return if yes
-            if os.path.isfile(outFile):
-                print("The file "+outFile+" already exists. Exiting..")
-                return outFile
+        if sorted_bam:
+            outFile=os.path.join(out_dir,sra_object.srr_accession+out_suffix+"_sorted.bam")
         
         #find layout and fq file paths
         if sra_object.layout == 'PAIRED':
@@ -719,7 +979,15 @@ class Bowtie2(Aligner):
         #add input files to kwargs, overwrite kwargs with newOpts
         mergedOpts={**kwargs,**newOpts}
         
-        status=self.run_bowtie2(verbose=verbose,quiet=quiet,logs=logs,objectid=sra_object.srr_accession,**mergedOpts)
+        out_bam=""
+        if sorted_bam:
+            #bowtie2 writes to stdout
+            mergedOpts.pop("-S")
+            out_bam=outFile
+        
+        inputs=[v for k,v in newOpts.items() if k!="-S"]
+        status=self.run_bowtie2(verbose=verbose,quiet=quiet,logs=logs,objectid=sra_object.srr_accession,out_bam=out_bam,inputs=inputs,outputs=[outFile],force=overwrite,**mergedOpts)
+        status=self.close_sra_stream(sra_object,status)
         
         if status:
             #check if sam file is present in the location directory of sra_object
@@ -731,11 +999,18 @@ class Bowtie2(Aligner):
         
         
     
-    def run_bowtie2(self,verbose=False,quiet=False,logs=True,objectid="NA",**kwargs):
+    def run_bowtie2(self,verbose=False,quiet=False,logs=True,objectid="NA",out_bam="",inputs=None,outputs=None,force=False,**kwargs):
         """Wrapper for running bowtie2.
         
         
-        
+        out_bam: string
+            If provided, bowtie2 output is piped to samtools sort and saved to this sorted bam file
+        inputs: list
+            input files used for checkpointing. The index is added to these.
+        outputs: list
+            output files. If provided, bowtie2 is skipped when these are up to date (see pyrpipe_engine.execute_command).
+        force: bool
+            Run bowtie2 even if the outputs are up to date
         verbose: bool
             Print stdout and std error
         quiet: bool
@@ -752,6 +1027,41 @@ class Bowtie2(Aligner):
         :rtype: bool
         """
         
+        bowtie2_cmd=self.get_bowtie2_cmd(**kwargs)
+        
+        #start ececution
+        if inputs is not None:
+            inputs=inputs+pu.get_index_inputs('bowtie2',self.bowtie2_index)
+        
+        if out_bam:
+            status=self.run_piped_to_bam(bowtie2_cmd,out_bam,verbose=verbose,quiet=quiet,logs=logs,objectid=objectid,inputs=inputs,force=force)
+        else:
+            status=pe.execute_command(bowtie2_cmd,verbose=verbose,quiet=quiet,logs=logs,objectid=objectid,inputs=inputs,outputs=outputs,force=force,thread_flags=self.thread_args)
+        if not status:
+            pu.print_boldred("bowtie2 failed")
+        return status
+    
+    async def run_bowtie2_async(self,verbose=False,quiet=False,logs=True,objectid="NA",out_bam="",inputs=None,outputs=None,force=False,**kwargs):
+        """Coroutine version of run_bowtie2. Parameters are same as run_bowtie2.
+        
+        :return: Returns the status of bowtie2. True is passed, False if failed.
+        :rtype: bool
+        """
+        bowtie2_cmd=self.get_bowtie2_cmd(**kwargs)
+        if inputs is not None:
+            inputs=inputs+pu.get_index_inputs('bowtie2',self.bowtie2_index)
+        
+        if out_bam:
+            status=await self.run_piped_to_bam_async(bowtie2_cmd,out_bam,verbose=verbose,quiet=quiet,logs=logs,objectid=objectid,inputs=inputs,force=force)
+        else:
+            status=await pe.execute_command_async(bowtie2_cmd,verbose=verbose,quiet=quiet,logs=logs,objectid=objectid,inputs=inputs,outputs=outputs,force=force,thread_flags=self.thread_args)
+        if not status:
+            pu.print_boldred("bowtie2 failed")
+        return status
+    
+    def get_bowtie2_cmd(self,**kwargs):
+        """Return the bowtie2 command with arguments in self.passedArgumentDict overridden by kwargs
+        """
         #check for a valid index
         if not self.check_index():
             raise Exception("ERROR: Invalid Bowtie2 index. Please run build index to generate an index.")
@@ -761,14 +1071,7 @@ class Bowtie2(Aligner):
             
         bowtie2_cmd=['bowtie2']
         bowtie2_cmd.extend(pu.parse_unix_args(self.valid_args,mergedArgsDict))
-        
-        #print("Executing:"+" ".join(bowtie2_cmd))
-        
-        #start ececution
-        status=pe.execute_command(bowtie2_cmd,verbose=verbose,quiet=quiet,logs=logs,objectid=objectid)
-        if not status:
-            pu.print_boldred("bowtie2 failed")
-        return status
+        return bowtie2_cmd
     
     
     def check_index(self):
@@ -17,7 +17,16 @@ import logging
 import sys
 import platform
 from multiprocessing import cpu_count
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import shutil
+import tempfile
+import gzip
+import asyncio
+import fnmatch
+import contextlib
 from pyrpipe import pyrpipe_utils as pu
+from pyrpipe import log_reader
 import json
 
 class LogFormatter():
@@ -55,6 +64,130 @@ class LogFormatter():
         """
         
 
+def compress_file(path,compression):
+    """Compress a file to path.gz or path.zst and remove path
+    
+    Parameters
+    ----------
+    
+    path: str
+        path to the file
+    compression: str
+        gzip or zstd
+    """
+    out_file=path+log_reader.COMPRESSION_EXT[compression]
+    #a partially written file is never mistaken for a complete segment
+    temp_file=out_file+".tmp"
+    with open(path,'rb') as fin:
+        if compression=='zstd':
+            import zstandard
+            with open(temp_file,'wb') as fout:
+                zstandard.ZstdCompressor().copy_stream(fin,fout)
+        else:
+            with gzip.open(temp_file,'wb') as fout:
+                shutil.copyfileobj(fin,fout,LOG_COPY_CHUNK_BYTES)
+    os.replace(temp_file,out_file)
+    os.remove(path)
+
+
+class IndexedFileHandler(logging.Handler):
+    """A logging handler that appends records to logfile and, for records logged with PyrpipeLogger.log_command(),
+    writes the byte offset and length of the record along with its exitcode and crc32 of its objectid and commandname 
+    to an index file <logfile>.idx (see log_reader.INDEX_RECORD). The index lets readers seek directly to the records of a sample or program.
+    
+    If max_bytes is set, once logfile would exceed max_bytes it is moved, with its index, to the next numbered segment
+    <logfile>.1, <logfile>.2, ... which is compressed if compression is set. Records are never split across segments.
+    Segments are compressed in a background thread so logging commands do not wait for the compression; the uncompressed
+    segment is read until its compressed copy is complete. Segments left uncompressed by an interrupted process are
+    compressed when the log is opened again.
+    
+    Parameters
+    ----------
+    
+    logfile: str
+        path to the log file
+    max_bytes: int
+        size of the log after which it is rotated. 0 disables rotation.
+    compression: str
+        compress rotated segments with gzip or zstd. None to keep them uncompressed.
+    """
+    def __init__(self,logfile,max_bytes=0,compression=None):
+        super().__init__()
+        self.logfile=logfile
+        self.max_bytes=max_bytes
+        self.compression=compression
+        segments=log_reader.list_segments(logfile)
+        self.segment=max([n for n,path in segments],default=0)
+        self.compressors=[]
+        self.open_streams()
+        if compression:
+            for n,path in segments:
+                if not path.endswith(log_reader.COMPRESSION_EXT[compression]):
+                    self.compress_segment(path)
+    
+    def open_streams(self):
+        self.stream=open(self.logfile,'ab')
+        self.index_stream=open(self.logfile+".idx",'ab')
+    
+    def rotate(self):
+        """Move the log and its index to the next segment and start a new log
+        """
+        self.stream.close()
+        self.index_stream.close()
+        self.segment+=1
+        segment_path="{}.{}".format(self.logfile,self.segment)
+        os.replace(self.logfile+".idx",segment_path+".idx")
+        os.replace(self.logfile,segment_path)
+        self.open_streams()
+        if self.compression:
+            self.compress_segment(segment_path)
+    
+    def compress_segment(self,segment_path):
+        """Compress a rotated segment in a background thread
+        """
+        def compress():
+            try:
+                compress_file(segment_path,self.compression)
+            except (ImportError,OSError) as e:
+                pu.print_boldred("Failed to compress {}: {}".format(segment_path,e))
+        #drop finished compressions
+        self.compressors=[t for t in self.compressors if t.is_alive()]
+        thread=threading.Thread(target=compress,daemon=True)
+        self.compressors.append(thread)
+        thread.start()
+    
+    def emit(self,record):
+        try:
+            data=(self.format(record)+"\n").encode("utf-8")
+            offset=self.stream.tell()
+            if self.max_bytes and offset>0 and offset+len(data)>self.max_bytes:
+                self.rotate()
+                offset=0
+            self.stream.write(data)
+            self.stream.flush()
+            index=getattr(record,'pyrpipe_index',None)
+            if index is not None:
+                exitcode,objectid,commandname=index
+                self.index_stream.write(log_reader.INDEX_RECORD.pack(offset,len(data),exitcode,
+                                                                      log_reader.get_crc(objectid),log_reader.get_crc(commandname)))
+                self.index_stream.flush()
+        except Exception:
+            self.handleError(record)
+    
+    def close(self):
+        self.acquire()
+        try:
+            self.stream.close()
+            self.index_stream.close()
+            compressors=self.compressors
+        finally:
+            self.release()
+        #wait for the segments being compressed
+        for thread in compressors:
+            thread.join()
+        super().close()
+
+
 class PyrpipeLogger():
     """
     Class to manage pyrpipe logs
@@ -64,15 +197,27 @@ class PyrpipeLogger():
     
     env_logger: logger to log the current environment
     cmd_logger: logger to log the execution status, stdout, stderr and runtimes for each command run using execute_command()
+    
+    Parameters
+    -----------
+    
+    logs_dir: str
+        directory to save the logs. Default: ./pyrpipe_logs
+    max_bytes: int
+        rotate the command log into numbered segments of about max_bytes. 0 disables rotation.
+    compression: str
+        compress rotated segments of the command log with gzip or zstd
     """
-    def __init__(self):
+    def __init__(self,logs_dir=None,max_bytes=0,compression=None):
         self.__name__="pyrpipeLogger"
         #loggers
         timestamp=str(datetime.now()).split(".")[0].replace(" ","-").replace(":","_")
         self.logger_basename=timestamp+"_pyrpipe"
-        self.logs_dir=os.path.join(os.getcwd(),"pyrpipe_logs")
+        if not logs_dir:
+            logs_dir=os.path.join(os.getcwd(),"pyrpipe_logs")
+        self.logs_dir=os.path.abspath(logs_dir)
         if not os.path.isdir(self.logs_dir):
-            os.mkdir(self.logs_dir)
+            os.makedirs(self.logs_dir,exist_ok=True)
         """
         self.cmd_loggerPath=os.path.join(self.logs_dir,self.logger_basename+"CMD.log")
         self.stdoutLoggerPath=os.path.join(self.logs_dir,self.logger_basename+"OUT.log")
@@ -80,6 +225,11 @@ class PyrpipeLogger():
         """
         self.log_path=os.path.join(self.logs_dir,self.logger_basename+".log")
         self.envlog_path=os.path.join(self.logs_dir,self.logger_basename+"ENV.log")
+        #dir to spool stdout of commands executed with stream_output=True
+        self.stdout_dir=os.path.join(self.logs_dir,self.logger_basename+"_stdout")
+        self.stdout_counter=0
+        #commands may be logged from multiple threads e.g. by the Scheduler
+        self.lock=threading.Lock()
         
         """
         self.cmd_logger=self.create_logger("cmd",self.cmd_loggerPath,LogFormatter(),logging.DEBUG)
@@ -88,7 +238,8 @@ class PyrpipeLogger():
         """
         formatter=LogFormatter()
         self.env_logger=self.create_logger("env",self.envlog_path,formatter,logging.DEBUG)
-        self.cmd_logger=self.create_logger("cmd",self.log_path,formatter,logging.DEBUG)
+        self.cmd_logger=self.create_logger("cmd",self.log_path,formatter,logging.DEBUG,indexed=True,
+                                           max_bytes=max_bytes,compression=compression)
         
         #self.stdoutLogger=self.create_logger("out",self.log_path,formatter,logging.DEBUG)
         #self.stderrLogger=self.create_logger("err",self.log_path,formatter,logging.DEBUG)
@@ -100,7 +251,7 @@ class PyrpipeLogger():
  
         
     
-    def create_logger(self,name,logfile,formatter,level=logging.DEBUG):
+    def create_logger(self,name,logfile,formatter,level=logging.DEBUG,indexed=False,max_bytes=0,compression=None):
         """Creates a logger
         
         Parameters
@@ -112,15 +263,28 @@ class PyrpipeLogger():
             file name to save logs
         formatter: formatter object
             formatter for log
+        indexed: bool
+            maintain an index of the logged commands in <logfile>.idx
+        max_bytes: int
+            rotate an indexed log after max_bytes
+        compression: str
+            compression for rotated segments of an indexed log
         
         Returns: logger
             A logger object
         """
         #Get different loggers
-        handler = logging.FileHandler(logfile)        
+        if indexed:
+            handler = IndexedFileHandler(logfile,max_bytes,compression)
+        else:
+            handler = logging.FileHandler(logfile)        
         handler.setFormatter(formatter)
         
         logger = logging.getLogger(name)
+        #remove handlers of a previous PyrpipeLogger
+        for old_handler in list(logger.handlers):
+            logger.removeHandler(old_handler)
+            old_handler.close()
         logger.setLevel(level)
         logger.addHandler(handler)
         return logger
@@ -145,7 +309,7 @@ class PyrpipeLogger():
         #get cpu
         cpu=str(cpu_count())+' logical CPU cores'
         
-        envDesc={'now':str(datetime.now().strftime("%y-%m-%d %H:%M:%S")),
+        envDesc={'now':pu.get_iso_time(),
                  'python':pyver,
                  'os':osInfo,
                  'cpu':cpu,
@@ -167,11 +331,135 @@ class PyrpipeLogger():
         self.env_logger.debug("#PROGRAMS")
         #a list of logged programs
         self.logged_programs=[]
+    
+    def log_command(self,logDict):
+        """Write the record of an executed command to the log and the log index
         
+        Parameters
+        ----------
+        
+        logDict: dict
+            the record with keys cmd, exitcode, runtime, starttime, stdout, stderr, objectid and commandname
+        """
+        index=(int(logDict['exitcode']),str(logDict['objectid']),str(logDict['commandname']))
+        self.cmd_logger.debug(json.dumps(logDict),extra={'pyrpipe_index':index})
+    
+    def get_stdout_file(self,objectid,command_name):
+        """Return a new path to spool the stdout of a command.
+        Files are named <counter>_<objectid>_<command_name>.txt and saved under self.stdout_dir
+        
+        Parameters
+        ----------
+        
+        objectid: str
+            objectid of the command
+        command_name: str
+            name of the command
+        
+        :return: path to the stdout file
+        :rtype: string
+        """
+        if not os.path.isdir(self.stdout_dir):
+            os.makedirs(self.stdout_dir,exist_ok=True)
+        with self.lock:
+            self.stdout_counter+=1
+            counter=self.stdout_counter
+        #command name could be a path or contain subcommands
+        name=os.path.basename(command_name).replace(" ","_")
+        fname="{}_{}_{}.txt".format(counter,objectid,name)
+        return os.path.join(self.stdout_dir,fname)
+        
+
+###logger is created when the first command is logged. Use get_logger() to access it;
+#pyrpipeLoggerObject is None until then
+pyrpipeLoggerObject=None
+logs_dir_path=None
+logger_lock=threading.Lock()
+#size based rotation and compression of the command log
+log_max_bytes=None
+log_compression=None
+#chunk size used to compress rotated logs
+LOG_COPY_CHUNK_BYTES=1024*1024
+
+def set_logs_dir(logs_dir):
+    """Set the directory where pyrpipe logs are saved. Default is ./pyrpipe_logs
+    The PYRPIPE_LOGS_DIR environment variable can also be used.
+    If logs were already started, a new log is started in logs_dir.
+    
+    Parameters
+    ----------
+    
+    logs_dir: str
+        path to the logs directory
+    """
+    global logs_dir_path,pyrpipeLoggerObject
+    with logger_lock:
+        logs_dir_path=logs_dir
+        if pyrpipeLoggerObject is not None:
+            pyrpipeLoggerObject=None
+
+def set_log_rotation(max_bytes,compression=None):
+    """Rotate the command log into numbered segments <log>.1, <log>.2, ... once it exceeds max_bytes,
+    optionally compressing the segments. The ENV log is not rotated.
+    The PYRPIPE_LOG_MAX_BYTES and PYRPIPE_LOG_COMPRESSION environment variables can also be used.
+    If logs were already started, a new log is started.
+    
+    Parameters
+    ----------
+    
+    max_bytes: int
+        segment size in bytes. 0 disables rotation.
+    compression: str
+        gzip or zstd (requires zstandard). None to keep segments uncompressed.
+    
+    :return: True if the options were set
+    :rtype: bool
+    """
+    global log_max_bytes,log_compression,pyrpipeLoggerObject
+    if compression is not None and compression not in log_reader.COMPRESSION_EXT:
+        pu.print_boldred("Unknown log compression {}. Use one of {}".format(compression,list(log_reader.COMPRESSION_EXT)))
+        return False
+    if compression=='zstd':
+        try:
+            import zstandard
+        except ImportError:
+            pu.print_boldred("zstandard is required for zstd compressed logs")
+            return False
+    with logger_lock:
+        log_max_bytes=max_bytes
+        log_compression=compression
+        if pyrpipeLoggerObject is not None:
+            pyrpipeLoggerObject=None
+    return True
 
-###create logger
-pyrpipeLoggerObject=PyrpipeLogger()
-pu.print_yellow("Logs will be saved to {}.log".format(pyrpipeLoggerObject.logger_basename))
+def get_logger():
+    """Return the PyrpipeLogger object, creating the logs on first use.
+    
+    :return: the logger
+    :rtype: PyrpipeLogger
+    """
+    global pyrpipeLoggerObject
+    if pyrpipeLoggerObject is None:
+        with logger_lock:
+            if pyrpipeLoggerObject is None:
+                logs_dir=logs_dir_path or os.environ.get('PYRPIPE_LOGS_DIR')
+                max_bytes=log_max_bytes
+                if max_bytes is None:
+                    max_bytes=int(os.environ.get('PYRPIPE_LOG_MAX_BYTES',0))
+                compression=log_compression
+                if compression is None:
+                    compression=os.environ.get('PYRPIPE_LOG_COMPRESSION') or None
+                pyrpipeLoggerObject=PyrpipeLogger(logs_dir,max_bytes,compression)
+                pu.print_yellow("Logs will be saved to {}.log".format(pyrpipeLoggerObject.logger_basename))
+    return pyrpipeLoggerObject
+
+#per-thread information about the Scheduler job being executed
+job_context=threading.local()
+
+#max bytes of stdout kept in memory (and in the log) when stream_output=True
+STREAM_TAIL_BYTES=64*1024
+#chunk size used to read stdout
+STREAM_CHUNK_BYTES=64*1024
     
 """
 All functions that interact with shell are defined here. 
@@ -240,7 +528,228 @@ def execute_commandRealtime(cmd):
         raise subprocess.CalledProcessError(return_code, cmd)
 
 
-def execute_command(cmd,verbose=False,quiet=False,logs=True,dryrun=False,objectid="NA",command_name=""):
+#resource usage of each command saved in the logs. maxrss is in KB; inblock and oublock are in 512-byte blocks
+RUSAGE_FIELDS=['utime','stime','maxrss','inblock','oublock','nvcsw','nivcsw']
+#seconds between samples of memory and cpu usage of running commands. 0 to disable
+resource_sample_interval=0
+
+def set_resource_sampling(interval):
+    """Periodically sample rss, cpu time and threads of the process tree of each command.
+    The samples are saved in the logs as a list of [seconds, rss_kb, cpu_seconds, threads].
+    Requires psutil.
+    
+    Parameters
+    ----------
+    
+    interval: float
+        seconds between samples. 0 disables sampling.
+    """
+    global resource_sample_interval
+    resource_sample_interval=interval
+
+def wait_rusage(popen_ob):
+    """Wait for a process to exit and return its resource usage, including its waited-for descendants.
+    
+    Parameters
+    ----------
+    
+    popen_ob: Popen
+        the process
+    
+    :return: dict with the RUSAGE_FIELDS. Empty if the process was already waited for.
+    :rtype: dict
+    """
+    try:
+        pid,status,ru=os.wait4(popen_ob.pid,0)
+    except ChildProcessError:
+        popen_ob.wait()
+        return {}
+    if os.WIFSIGNALED(status):
+        popen_ob.returncode=-os.WTERMSIG(status)
+    else:
+        popen_ob.returncode=os.WEXITSTATUS(status)
+    return {'utime':round(ru.ru_utime,3),
+            'stime':round(ru.ru_stime,3),
+            'maxrss':ru.ru_maxrss,
+            'inblock':ru.ru_inblock,
+            'oublock':ru.ru_oublock,
+            'nvcsw':ru.ru_nvcsw,
+            'nivcsw':ru.ru_nivcsw
+            }
+
+def merge_rusage(rusages):
+    """Combine the resource usage of processes running together e.g. in a pipeline. 
+    maxrss is the max of all processes and other fields are summed.
+    """
+    merged={}
+    for ru in rusages:
+        for k,v in ru.items():
+            if k=='maxrss':
+                merged[k]=max(merged.get(k,0),v)
+            else:
+                merged[k]=round(merged.get(k,0)+v,3)
+    return merged
+
+class ResourceSampler(threading.Thread):
+    """Thread to sample the rss, cpu time and number of threads of running processes and their children.
+    
+    Parameters
+    ----------
+    
+    pids: list
+        process ids to sample
+    interval: float
+        seconds between samples
+    """
+    def __init__(self,pids,interval):
+        super().__init__(daemon=True)
+        self.pids=pids
+        self.interval=interval
+        self.samples=[]
+        self.stop_event=threading.Event()
+        
+    def run(self):
+        try:
+            import psutil
+        except ImportError:
+            pu.print_boldred("psutil is required for resource sampling")
+            return
+        procs=[]
+        for pid in self.pids:
+            try:
+                procs.append(psutil.Process(pid))
+            except psutil.Error:
+                pass
+        time_start=time.time()
+        while not self.stop_event.wait(self.interval):
+            rss=0
+            cpu=0
+            threads=0
+            alive=0
+            for proc in procs:
+                try:
+                    tree=[proc]+proc.children(recursive=True)
+                except psutil.Error:
+                    continue
+                alive+=1
+                for p in tree:
+                    try:
+                        with p.oneshot():
+                            rss+=p.memory_info().rss
+                            cpu_times=p.cpu_times()
+                            cpu+=cpu_times.user+cpu_times.system
+                            threads+=p.num_threads()
+                    except psutil.Error:
+                        pass
+            if not alive:
+                break
+            self.samples.append([round(time.time()-time_start,3),rss//1024,round(cpu,3),threads])
+            
+    def stop(self):
+        """Stop sampling
+        
+        :return: the samples
+        :rtype: list
+        """
+        self.stop_event.set()
+        self.join()
+        return self.samples
+
+def start_sampler(pids):
+    """Start a ResourceSampler if sampling is enabled by set_resource_sampling()
+    
+    :return: the sampler or None
+    :rtype: ResourceSampler
+    """
+    if resource_sample_interval<=0:
+        return None
+    sampler=ResourceSampler(pids,resource_sample_interval)
+    sampler.start()
+    return sampler
+
+
+class OutputSpool():
+    """Spool the output of a command to a file while keeping only its last tail_bytes in memory.
+    
+    Parameters
+    ----------
+    
+    out_file: str
+        path to write the full output. If None, output is not saved.
+    verbose: bool
+        print the output as it is written
+    tail_bytes: int
+        max number of bytes to keep in memory
+    """
+    def __init__(self,out_file=None,verbose=False,tail_bytes=STREAM_TAIL_BYTES):
+        self.tail=bytearray()
+        self.truncated=False
+        self.tail_bytes=tail_bytes
+        self.verbose=verbose
+        self.fh=None
+        if out_file:
+            self.fh=open(out_file,'wb')
+    
+    def write(self,chunk):
+        if self.fh:
+            self.fh.write(chunk)
+        if self.verbose:
+            sys.stdout.write(chunk.decode("utf-8",errors="replace"))
+            sys.stdout.flush()
+        self.tail.extend(chunk)
+        if len(self.tail)>self.tail_bytes:
+            del self.tail[:len(self.tail)-self.tail_bytes]
+            self.truncated=True
+    
+    def close(self):
+        """Close the output file
+        
+        :return: The last tail_bytes of the output
+        :rtype: string
+        """
+        if self.fh:
+            self.fh.close()
+        #start the tail at a line boundary
+        if self.truncated:
+            newline=self.tail.find(b"\n")
+            if newline>=0:
+                del self.tail[:newline+1]
+        return self.tail.decode("utf-8",errors="replace")
+
+
+def stream_stdout(popen_ob,out_file=None,verbose=False,tail_bytes=STREAM_TAIL_BYTES):
+    """Read stdout of a running process in chunks and spool it to out_file.
+    Only the last tail_bytes of the output are kept in memory.
+    
+    Parameters
+    ----------
+    
+    popen_ob: Popen
+        a Popen object created with stdout=subprocess.PIPE
+    out_file: str
+        path to write the full stdout. If None, output is not saved.
+    verbose: bool
+        print stdout as it is generated
+    tail_bytes: int
+        max number of bytes to keep in memory
+    
+    :return: The last tail_bytes of stdout
+    :rtype: string
+    """
+    spool=OutputSpool(out_file,verbose,tail_bytes)
+    try:
+        while True:
+            chunk=popen_ob.stdout.read1(STREAM_CHUNK_BYTES)
+            if not chunk:
+                break
+            spool.write(chunk)
+    finally:
+        stdout=spool.close()
+        popen_ob.stdout.close()
+    return stdout
+
+
+def execute_command(cmd,verbose=False,quiet=False,logs=True,dryrun=False,objectid="NA",command_name="",stream_output=False,stdout_consumer=None,inputs=None,outputs=None,force=False,thread_flags=None,checkpoint_message=None):
     """Function to execute commands using popen. 
     All commands executed by this function can be logged and saved to pyrpipe logs.
     
@@ -261,12 +770,36 @@ def execute_command(cmd,verbose=False,quiet=False,logs=True,dryrun=False,objecti
         An id to be attached with the command. This is useful fo storing logs for SRA objects where object id is the SRR id.
     command_name: string
         Name of command to be save in log. If empty it is determined as the first element of the cmd list.
+    stream_output: bool
+        Spool stdout/stderr to a file under the logs directory while the command runs, instead of holding it in memory.
+        Only the last STREAM_TAIL_BYTES are stored in the log along with the path to the file. Use this for tools with verbose output.
+    stdout_consumer: function
+        A function that is passed the binary stdout stream of the running command, e.g. to feed it to another program.
+        The stdout is not saved in the log; stderr is spooled to a temporary file and its last STREAM_TAIL_BYTES are logged.
+    inputs: list
+        Input files or directories of the command. Used with outputs for checkpointing.
+    outputs: list
+        Output files or directories of the command. If provided, a checkpoint is saved when the command succeeds and
+        the command is skipped (logged as a cache hit) if it was completed before with the same program version and inputs
+        and the outputs are unchanged.
+    force: bool
+        Execute the command even if its outputs are up to date.
+    thread_flags: list
+        flags that set the number of threads of the program e.g. ['-p','--threads'] or ['threads='].
+        If cmd does not set any of these, threads are taken from the thread budget (see ThreadBudget) while
+        the command runs and passed to the program with the first flag.
+    checkpoint_message: string
+        command used for the checkpoint instead of cmd, i.e. cmd without options that do not change the outputs
+        (e.g. threads or memory).
 
     :return: Return status.True is returncode is 0
     :rtype: bool
     """
     if not command_name:
         command_name=cmd[0]
+    #inside a Scheduler job use the job's objectid
+    if objectid=="NA":
+        objectid=get_job_objectid()
     log_message=" ".join(cmd)
     
     #dryrun: print and exit
@@ -276,36 +809,79 @@ def execute_command(cmd,verbose=False,quiet=False,logs=True,dryrun=False,objecti
         #create a dict and dump as json
         logDict={'cmd':log_message,
                  'exitcode':"0",
-                 'runtime':"0",
-                 'starttime':"0",
+                 'runtime':0,
+                 'starttime':pu.get_iso_time(),
                  'stdout':"dryrun",
                  'stderr':"",
                  'objectid':objectid,
                  'commandname':command_name
                 }
-        pyrpipeLoggerObject.cmd_logger.debug(json.dumps(logDict))
+        get_logger().log_command(logDict)
         return True
     
+    checkpoint_message=checkpoint_message or log_message
+    if is_up_to_date(checkpoint_message,[cmd[0]],inputs,outputs,force):
+        log_cache_hit(log_message,objectid,command_name,quiet,logs)
+        return True
+    
+    threads,granted=acquire_threads(cmd,thread_flags)
+    if threads:
+        try:
+            return execute_command(add_thread_arg(cmd,thread_flags[0],threads),verbose=verbose,quiet=quiet,logs=logs,objectid=objectid,
+                                   command_name=command_name,stream_output=stream_output,stdout_consumer=stdout_consumer,
+                                   inputs=inputs,outputs=outputs,force=True,checkpoint_message=checkpoint_message)
+        finally:
+            thread_budget.release(granted)
+    
     if not quiet:
         pu.print_blue("$ "+log_message)
-    time_start = time.time()
-    starttime_str=time.strftime("%y-%m-%d %H:%M:%S", time.localtime(time.time()))
+    time_start = time.monotonic()
+    starttime_str=pu.get_iso_time()
+    stdout_file=""
     try:
-        result = subprocess.Popen(cmd,stdout=subprocess.PIPE,stderr=subprocess.STDOUT)
-        stdout,stderr = result.communicate()
-        #convert to string
-        if stdout:
-            stdout=stdout.decode("utf-8")
-        else:
-            stdout=""
-        if stderr:
-            stderr=stderr.decode("utf-8")
-        else:
+        if stdout_consumer:
+            with tempfile.TemporaryFile() as err_file:
+                result = subprocess.Popen(cmd,stdout=subprocess.PIPE,stderr=err_file)
+                sampler=start_sampler([result.pid])
+                try:
+                    stdout_consumer(result.stdout)
+                finally:
+                    #the command gets SIGPIPE if the consumer stopped early
+                    result.stdout.close()
+                    rusage=wait_rusage(result)
+                stdout=""
+                stderr=read_tail(err_file)
+        elif stream_output:
+            result = subprocess.Popen(cmd,stdout=subprocess.PIPE,stderr=subprocess.STDOUT)
+            sampler=start_sampler([result.pid])
+            if logs:
+                stdout_file=get_logger().get_stdout_file(objectid,command_name)
+            stdout=stream_stdout(result,stdout_file,verbose=verbose)
             stderr=""
+            rusage=wait_rusage(result)
+        else:
+            result = subprocess.Popen(cmd,stdout=subprocess.PIPE,stderr=subprocess.STDOUT)
+            sampler=start_sampler([result.pid])
+            #stderr is redirected to stdout
+            with result.stdout:
+                stdout=result.stdout.read()
+            stderr=None
+            rusage=wait_rusage(result)
+            #convert to string
+            if stdout:
+                stdout=stdout.decode("utf-8")
+            else:
+                stdout=""
+            if stderr:
+                stderr=stderr.decode("utf-8")
+            else:
+                stderr=""
         
-        timeDiff = round(time.time() - time_start) #round to remove microsecond term
+        timeDiff = round(time.monotonic() - time_start,3)
+        samples=sampler.stop() if sampler else []
     
-        if verbose:
+        #streamed output is already printed
+        if verbose and not stream_output:
             if stdout:
                 pu.print_blue("STDOUT:\n"+stdout)
             if stderr:
@@ -319,81 +895,1051 @@ def execute_command(cmd,verbose=False,quiet=False,logs=True,dryrun=False,objecti
         ##Add to logs        
         if logs:
 
+            pyrpipeLoggerObject=get_logger()
             ##get the program used and log its path
-            if command_name not in pyrpipeLoggerObject.logged_programs:
-                ##get which thisProgram
-                #if subcommands are present use parent command
-                parent_command=cmd[0]
-                progDesc={'name':command_name,
-                          'version':getProgramVersion(parent_command).strip(),
-                          'path':getProgramPath(parent_command).strip()
-                          }
-                pyrpipeLoggerObject.env_logger.debug(json.dumps(progDesc))
-                pyrpipeLoggerObject.logged_programs.append(command_name)
+            #if subcommands are present use parent command
+            log_program(command_name,cmd[0])
             
             #create a dict and dump as json
             logDict={'cmd':log_message,
                  'exitcode':exitCode,
-                 'runtime':str(timedelta(seconds=timeDiff)),
-                 'starttime':str(starttime_str),
+                 'runtime':timeDiff,
+                 'starttime':starttime_str,
                  'stdout':stdout,
                  'stderr':stderr,
                  'objectid':objectid,
                  'commandname':command_name
                 }
-            pyrpipeLoggerObject.cmd_logger.debug(json.dumps(logDict))
+            if stream_output:
+                logDict['stdout_file']=stdout_file
+            logDict.update(rusage)
+            if samples:
+                logDict['samples']=samples
+            pyrpipeLoggerObject.log_command(logDict)
     
         if exitCode==0:
+            if outputs:
+                save_checkpoint(checkpoint_message,[cmd[0]],inputs,outputs)
             return True
         return False
     #handle exceptions
     except OSError as e:
         pu.print_boldred("OSError exception occured.\n"+str(e))
+        if not logs:
+            return False
         #log error
-        timeDiff = round(time.time() - time_start)
+        timeDiff = round(time.monotonic() - time_start,3)
         logDict={'cmd':log_message,
                  'exitcode':'-1',
-                 'runtime':str(timedelta(seconds=timeDiff)),
-                 'starttime':str(starttime_str),
+                 'runtime':timeDiff,
+                 'starttime':starttime_str,
                  'stdout':"",
                  'stderr':"OSError exception occured.\n"+str(e),
                  'objectid':objectid,
                  'commandname':command_name                 
                 }
-        pyrpipeLoggerObject.cmd_logger.debug(json.dumps(logDict))
+        get_logger().log_command(logDict)
         return False
     except subprocess.CalledProcessError as e:
         pu.print_boldred("CalledProcessError exception occured.\n"+str(e))
+        if not logs:
+            return False
         #log error
-        timeDiff = round(time.time() - time_start)
+        timeDiff = round(time.monotonic() - time_start,3)
         logDict={'cmd':log_message,
                  'exitcode':'-1',
-                 'runtime':str(timedelta(seconds=timeDiff)),
-                 'starttime':str(starttime_str),
+                 'runtime':timeDiff,
+                 'starttime':starttime_str,
                  'stdout':"",
                  'stderr':"CalledProcessError exception occured.\n"+str(e),
                  'objectid':objectid,
                  'commandname':command_name                 
                 }
-        pyrpipeLoggerObject.cmd_logger.debug(json.dumps(logDict))
+        get_logger().log_command(logDict)
         return False
     except:
         pu.print_boldred("Fatal error occured during execution.\n"+str(sys.exc_info()[0]))
+        if not logs:
+            return False
         #log error
-        timeDiff = round(time.time() - time_start)
+        timeDiff = round(time.monotonic() - time_start,3)
         logDict={'cmd':log_message,
                  'exitcode':'-1',
-                 'runtime':str(timedelta(seconds=timeDiff)),
-                 'starttime':str(starttime_str),
+                 'runtime':timeDiff,
+                 'starttime':starttime_str,
                  'stdout':"",
                  'stderr':str("Fatal error occured during execution.\n"+str(sys.exc_info()[0])),
                  'objectid':objectid,
                  'commandname':command_name
                 }
-        pyrpipeLoggerObject.cmd_logger.debug(json.dumps(logDict))
+        get_logger().log_command(logDict)
+        return False
+    
+
+
+
+def log_program(command_name,parent_command):
+    """Write the version and path of a program to the env log, once per program.
+    
+    Parameters
+    ----------
+    
+    command_name: string
+        name of the command as saved in the logs
+    parent_command: string
+        executable used to determine the version and path
+    """
+    pyrpipeLoggerObject=get_logger()
+    with pyrpipeLoggerObject.lock:
+        if command_name in pyrpipeLoggerObject.logged_programs:
+            return
+        progDesc={'name':command_name,
+                  'version':getProgramVersion(parent_command).strip(),
+                  'path':getProgramPath(parent_command).strip()
+                  }
+        pyrpipeLoggerObject.env_logger.debug(json.dumps(progDesc))
+        pyrpipeLoggerObject.logged_programs.append(command_name)
+
+
+def read_tail(file_ob,tail_bytes=STREAM_TAIL_BYTES):
+    """Return the last tail_bytes of an open binary file as a string.
+    """
+    file_ob.seek(0,os.SEEK_END)
+    size=file_ob.tell()
+    file_ob.seek(max(0,size-tail_bytes))
+    return file_ob.read().decode("utf-8",errors="replace")
+
+
+def execute_pipeline(cmds,verbose=False,quiet=False,logs=True,dryrun=False,objectid="NA",command_name="",inputs=None,outputs=None,force=False,thread_flags=None,checkpoint_message=None):
+    """Execute a list of commands connected by pipes, i.e. cmds[0] | cmds[1] | ... 
+    The data passed between the commands never touches the disk. 
+    Stderr of each command (and stdout of the last command) is spooled to a temporary file
+    and the last STREAM_TAIL_BYTES of each are saved in the log.
+    The pipeline is logged as one command and the exitcode of each command is saved under exitcodes.
+    
+    Parameters
+    ----------
+    
+    cmds: list
+        list of commands; each command is a list as in execute_command
+    verbose: bool
+        Whether to print stdout and stderr. Default: False.
+    quiet: bool
+        Absolutely no output on screen
+    logs: bool
+        Log the execution 
+    dryrun: bool
+        If True, perform a dry run i.e. print commands to screen and log and exit
+    objectid: string
+        An id to be attached with the command.
+    command_name: string
+        Name of command to be save in log. If empty the names of all programs joined by "|" are used.
+    inputs: list
+        Input files or directories of the pipeline. See execute_command.
+    outputs: list
+        Output files or directories of the pipeline. See execute_command.
+    force: bool
+        Execute the pipeline even if its outputs are up to date.
+    thread_flags: list
+        thread flags of the first command. See execute_command.
+    checkpoint_message: string
+        command used for the checkpoint. See execute_command.
+
+    :return: Return status. True if returncode of all the commands is 0
+    :rtype: bool
+    """
+    if not command_name:
+        command_name="|".join([c[0] for c in cmds])
+    if objectid=="NA":
+        objectid=get_job_objectid()
+    log_message=" | ".join([" ".join(c) for c in cmds])
+    
+    if dryrun:
+        pu.print_blue("$ "+log_message)
+        logDict={'cmd':log_message,
+                 'exitcode':"0",
+                 'exitcodes':["0"]*len(cmds),
+                 'runtime':0,
+                 'starttime':pu.get_iso_time(),
+                 'stdout':"dryrun",
+                 'stderr':"",
+                 'objectid':objectid,
+                 'commandname':command_name
+                }
+        get_logger().log_command(logDict)
+        return True
+    
+    programs=[c[0] for c in cmds]
+    checkpoint_message=checkpoint_message or log_message
+    if is_up_to_date(checkpoint_message,programs,inputs,outputs,force):
+        log_cache_hit(log_message,objectid,command_name,quiet,logs)
+        return True
+    
+    threads,granted=acquire_threads(cmds[0],thread_flags)
+    if threads:
+        try:
+            return execute_pipeline([add_thread_arg(cmds[0],thread_flags[0],threads)]+cmds[1:],verbose=verbose,quiet=quiet,logs=logs,
+                                    objectid=objectid,command_name=command_name,inputs=inputs,outputs=outputs,force=True,checkpoint_message=checkpoint_message)
+        finally:
+            thread_budget.release(granted)
+    
+    if not quiet:
+        pu.print_blue("$ "+log_message)
+    time_start = time.monotonic()
+    starttime_str=pu.get_iso_time()
+    procs=[]
+    err_files=[tempfile.TemporaryFile() for c in cmds]
+    try:
+        prev_stdout=None
+        for i,c in enumerate(cmds):
+            last=i==len(cmds)-1
+            proc=subprocess.Popen(c,stdin=prev_stdout,
+                                  stdout=err_files[i] if last else subprocess.PIPE,
+                                  stderr=err_files[i])
+            #close the parent's copy so that the producer gets SIGPIPE if the consumer exits
+            if prev_stdout is not None:
+                prev_stdout.close()
+            prev_stdout=proc.stdout
+            procs.append(proc)
+        sampler=start_sampler([p.pid for p in procs])
+        rusage=merge_rusage([wait_rusage(p) for p in procs])
+        samples=sampler.stop() if sampler else []
+        exitcodes=[p.returncode for p in procs]
+        stderr_message=""
+        failed=[e for e in exitcodes if e!=0]
+        exitCode=failed[0] if failed else 0
+    except OSError as e:
+        #a command could not be started; stop the ones already running
+        for p in procs:
+            p.kill()
+            p.wait()
+        exitcodes=[p.returncode for p in procs]+[-1]*(len(cmds)-len(procs))
+        exitCode=-1
+        rusage={}
+        samples=[]
+        stderr_message="OSError exception occured.\n"+str(e)
+        pu.print_boldred(stderr_message)
+    
+    timeDiff = round(time.monotonic() - time_start,3)
+    log_pipeline(cmds,log_message,err_files,exitcodes,exitCode,stderr_message,rusage,samples,
+                 timeDiff,starttime_str,verbose,quiet,logs,objectid,command_name)
+    
+    if exitCode==0:
+        if outputs:
+            save_checkpoint(checkpoint_message,programs,inputs,outputs)
+        return True
+    return False
+    
+
+
+def log_pipeline(cmds,log_message,err_files,exitcodes,exitCode,stderr_message,rusage,samples,timeDiff,starttime_str,verbose,quiet,logs,objectid,command_name):
+    """Print and log the result of a pipeline executed by execute_pipeline or execute_pipeline_async.
+    err_files are read and closed.
+    """
+    outputs=[read_tail(f) for f in err_files]
+    for f in err_files:
+        f.close()
+    stdout=outputs[-1]
+    stderr="\n".join(["["+c[0]+"]\n"+o for c,o in zip(cmds[:-1],outputs[:-1]) if o])
+    if stderr_message:
+        stderr=stderr+"\n"+stderr_message if stderr else stderr_message
+    
+    if verbose:
+        if stdout:
+            pu.print_blue("STDOUT:\n"+stdout)
+        if stderr:
+            pu.print_boldred("STDERR:\n"+stderr)
+    if not quiet:
+        pu.print_green("Time taken:"+str(timedelta(seconds=timeDiff)))
+    
+    if logs:
+        for c in cmds:
+            log_program(c[0],c[0])
+        logDict={'cmd':log_message,
+                 'exitcode':exitCode,
+                 'exitcodes':exitcodes,
+                 'runtime':timeDiff,
+                 'starttime':starttime_str,
+                 'stdout':stdout,
+                 'stderr':stderr,
+                 'objectid':objectid,
+                 'commandname':command_name
+                }
+        logDict.update(rusage)
+        if samples:
+            logDict['samples']=samples
+        get_logger().log_command(logDict)
+
+
+###asyncio backend: run commands as coroutines so that many commands can be supervised from one event loop
+"""
+The async functions follow the logging contract of execute_command and execute_pipeline.
+Processes are reaped by the event loop, so their resource usage is not logged; use set_resource_sampling() to sample it.
+"""
+
+async def execute_command_async(cmd,verbose=False,quiet=False,logs=True,dryrun=False,objectid="NA",command_name="",stream_output=False,inputs=None,outputs=None,force=False,thread_flags=None,checkpoint_message=None):
+    """Coroutine to execute a command with asyncio. 
+    Parameters are same as execute_command. Checking versions for checkpoints and for the env log, and waiting for threads
+    from the thread budget, are done in the default executor.
+    If the coroutine is cancelled the command is killed, logged as failed and the cancellation is propagated.
+
+    :return: Return status.True is returncode is 0
+    :rtype: bool
+    """
+    if not command_name:
+        command_name=cmd[0]
+    if objectid=="NA":
+        objectid=get_job_objectid()
+    log_message=" ".join(cmd)
+    
+    if dryrun:
+        return execute_command(cmd,verbose=verbose,quiet=quiet,logs=logs,dryrun=dryrun,objectid=objectid,command_name=command_name)
+    
+    loop=asyncio.get_event_loop()
+    checkpoint_message=checkpoint_message or log_message
+    if await loop.run_in_executor(None,is_up_to_date,checkpoint_message,[cmd[0]],inputs,outputs,force):
+        log_cache_hit(log_message,objectid,command_name,quiet,logs)
+        return True
+    
+    threads,granted=await acquire_threads_async(cmd,thread_flags)
+    if threads:
+        try:
+            return await execute_command_async(add_thread_arg(cmd,thread_flags[0],threads),verbose=verbose,quiet=quiet,logs=logs,objectid=objectid,
+                                               command_name=command_name,stream_output=stream_output,inputs=inputs,outputs=outputs,force=True,
+                                               checkpoint_message=checkpoint_message)
+        finally:
+            thread_budget.release(granted)
+    
+    if not quiet:
+        pu.print_blue("$ "+log_message)
+    time_start = time.monotonic()
+    starttime_str=pu.get_iso_time()
+    stdout_file=""
+    proc=None
+    try:
+        proc=await asyncio.create_subprocess_exec(*cmd,stdout=subprocess.PIPE,stderr=subprocess.STDOUT)
+        sampler=start_sampler([proc.pid])
+        if stream_output:
+            if logs:
+                stdout_file=get_logger().get_stdout_file(objectid,command_name)
+            spool=OutputSpool(stdout_file,verbose)
+            try:
+                while True:
+                    chunk=await proc.stdout.read(STREAM_CHUNK_BYTES)
+                    if not chunk:
+                        break
+                    spool.write(chunk)
+            finally:
+                stdout=spool.close()
+        else:
+            stdout=(await proc.stdout.read()).decode("utf-8",errors="replace")
+        exitCode=await proc.wait()
+    except asyncio.CancelledError:
+        if proc is not None and proc.returncode is None:
+            proc.kill()
+            await proc.wait()
+        log_command_error(log_message,"Cancelled",time_start,starttime_str,objectid,command_name,quiet=True,logs=logs)
+        raise
+    except OSError as e:
+        return log_command_error(log_message,"OSError exception occured.\n"+str(e),time_start,starttime_str,objectid,command_name,logs=logs)
+    except:
+        return log_command_error(log_message,"Fatal error occured during execution.\n"+str(sys.exc_info()[0]),time_start,starttime_str,objectid,command_name,logs=logs)
+    
+    timeDiff = round(time.monotonic() - time_start,3)
+    samples=sampler.stop() if sampler else []
+    
+    if verbose and not stream_output and stdout:
+        pu.print_blue("STDOUT:\n"+stdout)
+    if not quiet:
+        pu.print_green("Time taken:"+str(timedelta(seconds=timeDiff)))
+    
+    if logs:
+        await loop.run_in_executor(None,log_program,command_name,cmd[0])
+        logDict={'cmd':log_message,
+                 'exitcode':exitCode,
+                 'runtime':timeDiff,
+                 'starttime':starttime_str,
+                 'stdout':stdout,
+                 'stderr':"",
+                 'objectid':objectid,
+                 'commandname':command_name
+                }
+        if stream_output:
+            logDict['stdout_file']=stdout_file
+        if samples:
+            logDict['samples']=samples
+        get_logger().log_command(logDict)
+    
+    if exitCode==0:
+        if outputs:
+            await loop.run_in_executor(None,save_checkpoint,checkpoint_message,[cmd[0]],inputs,outputs)
+        return True
+    return False
+
+def log_command_error(log_message,message,time_start,starttime_str,objectid,command_name,quiet=False,logs=True):
+    """Print and log a command that failed to execute
+    
+    :return: False
+    :rtype: bool
+    """
+    if not quiet:
+        pu.print_boldred(message)
+    if logs:
+        logDict={'cmd':log_message,
+                 'exitcode':'-1',
+                 'runtime':round(time.monotonic() - time_start,3),
+                 'starttime':starttime_str,
+                 'stdout':"",
+                 'stderr':message,
+                 'objectid':objectid,
+                 'commandname':command_name
+                }
+        get_logger().log_command(logDict)
+    return False
+
+async def execute_pipeline_async(cmds,verbose=False,quiet=False,logs=True,dryrun=False,objectid="NA",command_name="",inputs=None,outputs=None,force=False,thread_flags=None,checkpoint_message=None):
+    """Coroutine to execute a list of commands connected by pipes with asyncio. 
+    Parameters are same as execute_pipeline.
+    If the coroutine is cancelled the commands are killed, the pipeline is logged and the cancellation is propagated.
+
+    :return: Return status. True if returncode of all the commands is 0
+    :rtype: bool
+    """
+    if not command_name:
+        command_name="|".join([c[0] for c in cmds])
+    if objectid=="NA":
+        objectid=get_job_objectid()
+    log_message=" | ".join([" ".join(c) for c in cmds])
+    
+    if dryrun:
+        return execute_pipeline(cmds,verbose=verbose,quiet=quiet,logs=logs,dryrun=dryrun,objectid=objectid,command_name=command_name)
+    
+    loop=asyncio.get_event_loop()
+    programs=[c[0] for c in cmds]
+    checkpoint_message=checkpoint_message or log_message
+    if await loop.run_in_executor(None,is_up_to_date,checkpoint_message,programs,inputs,outputs,force):
+        log_cache_hit(log_message,objectid,command_name,quiet,logs)
+        return True
+    
+    threads,granted=await acquire_threads_async(cmds[0],thread_flags)
+    if threads:
+        try:
+            return await execute_pipeline_async([add_thread_arg(cmds[0],thread_flags[0],threads)]+cmds[1:],verbose=verbose,quiet=quiet,logs=logs,
+                                                objectid=objectid,command_name=command_name,inputs=inputs,outputs=outputs,force=True,
+                                                checkpoint_message=checkpoint_message)
+        finally:
+            thread_budget.release(granted)
+    
+    if not quiet:
+        pu.print_blue("$ "+log_message)
+    time_start = time.monotonic()
+    starttime_str=pu.get_iso_time()
+    procs=[]
+    err_files=[tempfile.TemporaryFile() for c in cmds]
+    stderr_message=""
+    rusage={}
+    samples=[]
+    cancelled=False
+    prev_read=None
+    try:
+        for i,c in enumerate(cmds):
+            last=i==len(cmds)-1
+            if last:
+                stdout=err_files[i]
+            else:
+                next_read,stdout=os.pipe()
+            try:
+                proc=await asyncio.create_subprocess_exec(*c,stdin=prev_read,stdout=stdout,stderr=err_files[i])
+            finally:
+                #close the parent's copies so that the producer gets SIGPIPE if the consumer exits
+                if prev_read is not None:
+                    os.close(prev_read)
+                    prev_read=None
+                if not last:
+                    os.close(stdout)
+                    prev_read=next_read
+            procs.append(proc)
+        sampler=start_sampler([p.pid for p in procs])
+        exitcodes=list(await asyncio.gather(*[p.wait() for p in procs]))
+        samples=sampler.stop() if sampler else []
+        failed=[e for e in exitcodes if e!=0]
+        exitCode=failed[0] if failed else 0
+    except (OSError,asyncio.CancelledError) as e:
+        if prev_read is not None:
+            os.close(prev_read)
+        #a command could not be started or the pipeline was cancelled; stop the commands already running
+        for p in procs:
+            if p.returncode is None:
+                p.kill()
+        for p in procs:
+            await p.wait()
+        exitcodes=[p.returncode for p in procs]+[-1]*(len(cmds)-len(procs))
+        exitCode=-1
+        if isinstance(e,asyncio.CancelledError):
+            cancelled=True
+            stderr_message="Cancelled"
+        else:
+            stderr_message="OSError exception occured.\n"+str(e)
+            pu.print_boldred(stderr_message)
+    
+    timeDiff = round(time.monotonic() - time_start,3)
+    if logs:
+        await asyncio.shield(loop.run_in_executor(None,log_programs,programs))
+    log_pipeline(cmds,log_message,err_files,exitcodes,exitCode,stderr_message,rusage,samples,
+                 timeDiff,starttime_str,verbose,quiet or cancelled,logs,objectid,command_name)
+    if cancelled:
+        raise asyncio.CancelledError()
+    
+    if exitCode==0:
+        if outputs:
+            await loop.run_in_executor(None,save_checkpoint,checkpoint_message,programs,inputs,outputs)
+        return True
+    return False
+
+def log_programs(programs):
+    """Write the version and path of programs to the env log
+    """
+    for program in programs:
+        log_program(program,program)
+
+
+###checkpoints: skip commands whose outputs are up to date
+checkpoint_file_path=None
+checkpoint_records=None
+checkpoint_lock=threading.Lock()
+
+def set_checkpoint_file(checkpoint_file):
+    """Set the file used to store checkpoints. Default is pyrpipe_checkpoints.jsonl in the logs directory.
+    The PYRPIPE_CHECKPOINT_FILE environment variable can also be used.
+    
+    Parameters
+    ----------
+    
+    checkpoint_file: str
+        path to the checkpoint file
+    """
+    global checkpoint_file_path,checkpoint_records
+    with checkpoint_lock:
+        checkpoint_file_path=checkpoint_file
+        checkpoint_records=None
+
+def get_checkpoint_file():
+    """Return path to the checkpoint file
+    """
+    if checkpoint_file_path:
+        return checkpoint_file_path
+    if os.environ.get('PYRPIPE_CHECKPOINT_FILE'):
+        return os.environ['PYRPIPE_CHECKPOINT_FILE']
+    logs_dir=logs_dir_path or os.environ.get('PYRPIPE_LOGS_DIR') or os.path.join(os.getcwd(),"pyrpipe_logs")
+    return os.path.join(logs_dir,"pyrpipe_checkpoints.jsonl")
+
+def read_checkpoints():
+    """Read checkpoints from the checkpoint file. Must be called with checkpoint_lock held.
+    
+    :return: dict of checkpoints with command as key
+    :rtype: dict
+    """
+    global checkpoint_records
+    if checkpoint_records is None:
+        checkpoint_records={}
+        checkpoint_file=get_checkpoint_file()
+        if os.path.isfile(checkpoint_file):
+            with open(checkpoint_file) as f:
+                for line in f:
+                    try:
+                        record=json.loads(line)
+                    except ValueError:
+                        #incomplete line from a crashed run
+                        continue
+                    checkpoint_records[record['cmd']]=record
+    return checkpoint_records
+
+def get_fingerprint(path):
+    """Return size and modification time of a file. For a directory these are returned for all files under it.
+    Index manifests (see pyrpipe_utils.write_index_manifest) are left out, since they are written after the index build is checkpointed.
+    
+    :return: fingerprint of the path or None if it does not exist
+    :rtype: list
+    """
+    if os.path.isfile(path):
+        st=os.stat(path)
+        return [st.st_size,st.st_mtime_ns]
+    if os.path.isdir(path):
+        entries=[]
+        for root,dirs,files in os.walk(path):
+            for f in files:
+                if f.endswith(pu.INDEX_MANIFEST_NAME):
+                    continue
+                fpath=os.path.join(root,f)
+                st=os.stat(fpath)
+                entries.append([os.path.relpath(fpath,path),st.st_size,st.st_mtime_ns])
+        return sorted(entries)
+    return None
+
+def get_versions(programs):
+    """Return versions of a list of programs
+    """
+    return [getProgramVersion(p).strip() for p in programs]
+
+def is_up_to_date(cmd_str,programs,inputs,outputs,force=False):
+    """Check if a command with outputs can be skipped. Used by execute_command, execute_pipeline and their coroutines.
+    
+    :return: True if the outputs are up to date and force is False
+    :rtype: bool
+    """
+    if not outputs or force:
         return False
+    return checkpoint_valid(cmd_str,programs,inputs,outputs)
+
+def checkpoint_valid(cmd_str,programs,inputs,outputs):
+    """Check if a command was completed before with the same program versions and inputs, 
+    and its outputs are unchanged since then.
+    
+    Parameters
+    ----------
+    
+    cmd_str: string
+        the command
+    programs: list
+        programs used by the command
+    inputs: list
+        input files or directories of the command
+    outputs: list
+        output files or directories of the command
+    
+    :return: True if the outputs are up to date
+    :rtype: bool
+    """
+    with checkpoint_lock:
+        record=read_checkpoints().get(cmd_str)
+    if record is None:
+        return False
+    if record['version']!=get_versions(programs):
+        return False
+    for path in outputs:
+        fingerprint=get_fingerprint(path)
+        if fingerprint is None or record['outputs'].get(path)!=fingerprint:
+            return False
+    for path in inputs or []:
+        if record['inputs'].get(path)!=get_fingerprint(path):
+            return False
+    return True
+
+def save_checkpoint(cmd_str,programs,inputs,outputs):
+    """Save a checkpoint for a successfully completed command.
+    
+    Parameters
+    ----------
     
+    cmd_str: string
+        the command
+    programs: list
+        programs used by the command
+    inputs: list
+        input files or directories of the command
+    outputs: list
+        output files or directories of the command
+    """
+    record={'cmd':cmd_str,
+            'version':get_versions(programs),
+            'inputs':{path:get_fingerprint(path) for path in inputs or []},
+            'outputs':{path:get_fingerprint(path) for path in outputs},
+            'time':pu.get_iso_time()
+            }
+    #outputs are missing; nothing to resume from
+    if None in record['outputs'].values():
+        return
+    with checkpoint_lock:
+        checkpoints=read_checkpoints()
+        checkpoint_file=get_checkpoint_file()
+        pu.mkdir(os.path.dirname(os.path.abspath(checkpoint_file)))
+        with open(checkpoint_file,'a') as f:
+            f.write(json.dumps(record)+"\n")
+        checkpoints[cmd_str]=record
+
+def log_cache_hit(cmd_str,objectid,command_name,quiet=False,logs=True):
+    """Log a command skipped because its outputs are up to date
+    """
+    if not quiet:
+        pu.print_green("Outputs up to date. Skipping: "+cmd_str)
+    if not logs:
+        return
+    logDict={'cmd':cmd_str,
+             'exitcode':0,
+             'runtime':0,
+             'starttime':pu.get_iso_time(),
+             'stdout':"",
+             'stderr':"",
+             'objectid':objectid,
+             'commandname':command_name,
+             'cache':"hit"
+            }
+    get_logger().log_command(logDict)
+
 
+def get_job_objectid():
+    """Return the objectid of the Scheduler job running in the current thread.
+    
+    :return: objectid of current job or "NA" if not running inside a job
+    :rtype: string
+    """
+    return getattr(job_context,'objectid',"NA")
+
+def get_job_threads(default=1):
+    """Return the number of threads allocated to the Scheduler job running in the current thread.
+    This can be used to set the thread parameter of a tool e.g. hisat2 -p or samtools -@
+    
+    Parameters
+    ----------
+    
+    default: int
+        value to return if not running inside a job
+    
+    :return: number of threads
+    :rtype: int
+    """
+    return getattr(job_context,'threads',default)
+
+#attributes of job_context set by the Scheduler
+JOB_CONTEXT_FIELDS=('objectid','threads')
+
+def get_job_context():
+    """Return the objectid and threads of the Scheduler job running in the current thread
+    
+    :return: dict; empty if not running inside a job
+    :rtype: dict
+    """
+    return {k:getattr(job_context,k) for k in JOB_CONTEXT_FIELDS if hasattr(job_context,k)}
+
+def set_job_context(context):
+    """Set the Scheduler job of the current thread to context (see get_job_context). An empty dict clears it.
+    """
+    for k in JOB_CONTEXT_FIELDS:
+        if k in context:
+            setattr(job_context,k,context[k])
+        elif hasattr(job_context,k):
+            delattr(job_context,k)
+
+def bind_job_context(function):
+    """Return a wrapper of function that runs it in the Scheduler job of the calling thread.
+    job_context is local to a thread; use this for functions a job runs in worker threads, e.g. with ThreadPoolExecutor,
+    so that their commands are tagged with the objectid of the job and use its threads.
+    
+    :return: function or a wrapper of function
+    :rtype: function
+    """
+    context=get_job_context()
+    if not context:
+        return function
+    def run_in_job(*args,**kwargs):
+        #pool threads are reused, restore their context
+        saved=get_job_context()
+        set_job_context(context)
+        try:
+            return function(*args,**kwargs)
+        finally:
+            set_job_context(saved)
+    return run_in_job
+
+
+class ThreadBudget():
+    """Threads shared by all the tools run by pyrpipe in this process.
+    A wrapper that does not set the thread flag of its tool takes threads from the budget while the tool runs
+    (see thread_flags in execute_command). Unless default_threads is set, a tool asks for an equal share of max_threads
+    among the tools holding or waiting for threads, so a tool running alone gets all the threads. Code starting
+    several tools at once declares them with share() so that the first tool does not take all the threads.
+    The grant shrinks to the free threads when the budget is nearly used up, and tools wait when no thread is free,
+    so concurrent tools never use more than max_threads together.
+    Use set_thread_budget() to change the budget of pyrpipe.
+    
+    Parameters
+    ----------
+    
+    max_threads: int
+        Total number of threads. Default: all CPUs.
+    default_threads: int
+        Number of threads requested by each tool. Default: an equal share of max_threads, as above.
+    """
+    def __init__(self,max_threads=None,default_threads=None):
+        self.max_threads=max(1,int(max_threads or cpu_count()))
+        self.default_threads=default_threads
+        self.free=self.max_threads
+        #number of grants not yet released, requests waiting for threads and tools declared with share()
+        self.holders=0
+        self.waiting=0
+        self.planned=0
+        self.condition=threading.Condition()
+    
+    def resize(self,max_threads=None,default_threads=None):
+        """Change the total and default number of threads. Threads granted before are released to the new budget.
+        """
+        with self.condition:
+            new_max=max(1,int(max_threads or cpu_count()))
+            self.free+=new_max-self.max_threads
+            self.max_threads=new_max
+            self.default_threads=default_threads
+            self.condition.notify_all()
+    
+    @contextlib.contextmanager
+    def share(self,tools):
+        """Context manager declaring that tools will run at the same time, e.g. the workers of a pool.
+        Default requests made inside are at most max_threads/tools.
+        """
+        with self.condition:
+            self.planned+=tools
+        try:
+            yield self
+        finally:
+            with self.condition:
+                self.planned-=tools
+    
+    def get_default_request(self):
+        """Return the number of threads requested by a tool that does not ask for a number. Called with the lock held.
+        """
+        if self.default_threads:
+            return self.default_threads
+        demand=max(self.holders+self.waiting+1,self.planned)
+        return max(1,self.max_threads//demand)
+    
+    def acquire(self,requested=None,minimum=1):
+        """Wait until at least minimum threads are free and take up to requested threads.
+        
+        Parameters
+        ----------
+        
+        requested: int
+            number of threads wanted. Default: default_threads or a share of max_threads (see get_default_request)
+        minimum: int
+            number of threads needed to start
+        
+        :return: number of threads granted
+        :rtype: int
+        """
+        with self.condition:
+            if requested is not None:
+                minimum=min(int(minimum),int(requested))
+            minimum=max(1,min(int(minimum),self.max_threads))
+            self.waiting+=1
+            try:
+                while self.free<minimum:
+                    self.condition.wait()
+            finally:
+                self.waiting-=1
+            #the share is computed when the threads are granted, so requests that waited split the released threads
+            if requested is None:
+                requested=self.get_default_request()
+            requested=max(minimum,min(int(requested),self.max_threads))
+            granted=min(requested,self.free)
+            self.free-=granted
+            self.holders+=1
+        return granted
+    
+    def release(self,threads):
+        """Return threads to the budget
+        """
+        if threads<=0:
+            return
+        with self.condition:
+            self.free+=threads
+            self.holders=max(0,self.holders-1)
+            self.condition.notify_all()
+
+thread_budget=ThreadBudget()
+
+def set_thread_budget(max_threads=None,default_threads=None):
+    """Set the number of threads shared by the tools run by pyrpipe.
+    
+    Parameters
+    ----------
+    
+    max_threads: int
+        Total number of threads. Default: all CPUs.
+    default_threads: int
+        Number of threads requested by each tool. Default: an equal share of max_threads among the running tools (see ThreadBudget).
+    """
+    thread_budget.resize(max_threads,default_threads)
+
+def has_thread_arg(cmd,thread_flags):
+    """Check if cmd sets one of thread_flags
+    """
+    for flag in thread_flags:
+        if flag.endswith("="):
+            if any(c.startswith(flag) for c in cmd[1:]):
+                return True
+        elif flag in cmd[1:]:
+            return True
+    return False
+
+def get_thread_arg(cmd,thread_flags):
+    """Return the number of threads set in cmd by one of thread_flags
+    
+    :return: number of threads or None if cmd does not set them
+    :rtype: int
+    """
+    for i in range(1,len(cmd)):
+        for flag in thread_flags:
+            if flag.endswith("=") and cmd[i].startswith(flag):
+                value=cmd[i][len(flag):]
+            elif cmd[i]==flag and i+1<len(cmd):
+                value=cmd[i+1]
+            else:
+                continue
+            try:
+                return int(value)
+            except ValueError:
+                return None
+    return None
+
+def add_thread_arg(cmd,flag,threads):
+    """Return a copy of cmd with flag set to threads.
+    The flag is added after the program and its subcommand (the arguments before the first option).
+    If cmd has no options, e.g. samtools index x.bam, the flag is added after the second argument.
+    Java style flags ending with = are added as flag<threads> after the program.
+    """
+    if flag.endswith("="):
+        return [cmd[0],flag+str(threads)]+cmd[1:]
+    position=1
+    while position<len(cmd) and not cmd[position].startswith("-"):
+        position+=1
+    if position==len(cmd):
+        position=min(2,len(cmd))
+    return cmd[:position]+[flag,str(threads)]+cmd[position:]
+
+def get_job_thread_request(cmd,thread_flags):
+    """Return the threads to pass to cmd that do not come from the thread budget.
+    
+    :return: 0 if cmd sets its threads (or has no thread flags), the threads of the Scheduler job running cmd,
+        or None if threads must be taken from the thread budget
+    :rtype: int
+    """
+    if not thread_flags or has_thread_arg(cmd,thread_flags):
+        return 0
+    if hasattr(job_context,'threads'):
+        return job_context.threads
+    return None
+
+def acquire_threads(cmd,thread_flags):
+    """Return the number of threads to pass to cmd and the number taken from the thread budget.
+    No threads are passed if cmd sets its threads. Inside a Scheduler job the threads of the job are used.
+    
+    :return: threads for cmd and threads to release to the budget when cmd finishes
+    :rtype: tuple
+    """
+    threads=get_job_thread_request(cmd,thread_flags)
+    if threads is not None:
+        return threads,0
+    granted=thread_budget.acquire()
+    return granted,granted
+
+async def acquire_threads_async(cmd,thread_flags):
+    """Coroutine version of acquire_threads. The event loop is not blocked while waiting for the thread budget.
+    """
+    #job_context belongs to the thread running the event loop
+    threads=get_job_thread_request(cmd,thread_flags)
+    if threads is not None:
+        return threads,0
+    future=asyncio.get_event_loop().run_in_executor(None,thread_budget.acquire)
+    try:
+        granted=await asyncio.shield(future)
+    except asyncio.CancelledError:
+        #return the threads once the pending acquire completes
+        future.add_done_callback(lambda f: thread_budget.release(f.result()))
+        raise
+    return granted,granted
+
+
+class Scheduler():
+    """Run many independent pipelines (e.g. one per SRA sample) concurrently.
+    Each job declares the number of threads it uses and jobs are started only when
+    enough CPUs are free in the budget of the Scheduler.
+    Tools run by a job use the threads of the job. The Scheduler does not take CPUs from the thread budget of pyrpipe,
+    so threads started by a job, which do not share its job_context (see bind_job_context), never wait for CPUs held by the job.
+    
+    Parameters
+    ----------
+    
+    max_cpus: int
+        Total number of CPUs the jobs can use. Default: max_threads of the thread budget of pyrpipe.
+    max_jobs: int
+        Max number of jobs to run at the same time. Default: max_cpus.
+    
+    Examples
+    --------
+    >>> def pipeline(srr):
+    ...     ob=sra.SRA(srr,workingDir)
+    ...     ob.download_fastq(procs=pe.get_job_threads())
+    ...     return hs.perform_alignment(ob,**{"-p":str(pe.get_job_threads())})
+    >>> sc=pe.Scheduler(max_cpus=64)
+    >>> for srr in srr_list:
+    ...     sc.add_job(pipeline,srr,threads=8,objectid=srr)
+    >>> sam_files=sc.run()
+    """
+    def __init__(self,max_cpus=None,max_jobs=None):
+        self.budget=ThreadBudget(max_cpus or thread_budget.max_threads)
+        self.max_cpus=self.budget.max_threads
+        if not max_jobs:
+            max_jobs=self.max_cpus
+        self.max_jobs=max_jobs
+        self.jobs=[]
+        
+    def add_job(self,function,*args,threads=1,objectid="NA",**kwargs):
+        """Add a job to the scheduler.
+        
+        Parameters
+        ----------
+        
+        function: callable
+            The pipeline to run e.g. a function performing qc, alignment and assembly for a sample.
+        args: tuple
+            arguments passed to function
+        threads: int
+            number of CPUs used by this job. Capped to max_cpus.
+        objectid: str
+            id to tag all commands executed by this job in the logs e.g. the SRR accession
+        kwargs: dict
+            keyword arguments passed to function
+        """
+        threads=max(1,min(int(threads),self.max_cpus))
+        self.jobs.append({'function':function,'args':args,'kwargs':kwargs,
+                          'threads':threads,'objectid':objectid,
+                          'result':None,'error':None})
+    
+    def acquire_cpus(self,threads):
+        self.budget.acquire(threads,minimum=threads)
+    
+    def release_cpus(self,threads):
+        self.budget.release(threads)
+        
+    def run_job(self,job):
+        self.acquire_cpus(job['threads'])
+        set_job_context({'objectid':job['objectid'],'threads':job['threads']})
+        try:
+            job['result']=job['function'](*job['args'],**job['kwargs'])
+        except Exception as e:
+            job['error']=e
+            pu.print_boldred("Job {} failed: {}".format(job['objectid'],str(e)))
+        finally:
+            set_job_context({})
+            self.release_cpus(job['threads'])
+        return job['result']
+        
+    def run(self):
+        """Run all the added jobs and wait for them to finish.
+        
+        :return: A list containing the value returned by each job, in the order jobs were added. Failed jobs return None.
+        :rtype: list
+        """
+        with ThreadPoolExecutor(max_workers=self.max_jobs) as executor:
+            results=list(executor.map(self.run_job,self.jobs))
+        return results
+    
+    def get_failed(self):
+        """Return objectids of jobs which raised an exception.
+        
+        :return: list of objectids
+        :rtype: list
+        """
+        return [job['objectid'] for job in self.jobs if job['error'] is not None]
 
 
 #modified from https://www.biostars.org/p/139422/
@@ -426,18 +1972,82 @@ def is_paired(sra_file):
         raise Exception("Error running fastq-dump: {}".format(str(e)));
 
 
+#cache of resolved program paths, keyed by (program, PATH)
+program_paths={}
+#cache of program versions, keyed by "path:mtime:size"
+program_versions={}
+program_versions_loaded=False
+tool_cache_lock=threading.Lock()
+
+def get_tool_cache_file():
+    """Return path to the on-disk cache of program versions.
+    The directory can be set using the PYRPIPE_CACHE_DIR environment variable.
+    Default: $XDG_CACHE_HOME/pyrpipe or ~/.cache/pyrpipe
+    
+    :return: path to the cache file
+    :rtype: string
+    """
+    cache_dir=os.environ.get('PYRPIPE_CACHE_DIR')
+    if not cache_dir:
+        cache_dir=os.path.join(os.environ.get('XDG_CACHE_HOME',os.path.join(os.path.expanduser("~"),".cache")),"pyrpipe")
+    return os.path.join(cache_dir,"program_versions.json")
+
+def read_tool_cache():
+    """Read the on-disk cache of program versions. Returns an empty dict if cache is missing or unreadable.
+    """
+    try:
+        with open(get_tool_cache_file()) as f:
+            return json.load(f)
+    except (OSError,ValueError):
+        return {}
+
+def write_tool_cache(key,version):
+    """Add an entry to the on-disk cache of program versions.
+    Entries written by other processes since the cache was read are kept.
+    """
+    cache_file=get_tool_cache_file()
+    try:
+        os.makedirs(os.path.dirname(cache_file),exist_ok=True)
+        cache=read_tool_cache()
+        cache[key]=version
+        temp_file=cache_file+"."+str(os.getpid())+".tmp"
+        with open(temp_file,'w') as f:
+            json.dump(cache,f)
+        os.replace(temp_file,cache_file)
+    except OSError:
+        #cache is an optimization only
+        pass
+
 def getProgramPath(programName):
     """
-    Get path of installed program
-    Returns the path as string    
+    Get path of installed program. Paths are resolved in-process and cached.
+    Returns the path as string. Returns empty string if program is not found.
     """
-    whichCmd=['which',programName]
-    out = subprocess.check_output(whichCmd,universal_newlines=True)
-    return out
+    key=(programName,os.environ.get('PATH',''))
+    if key not in program_paths:
+        path=shutil.which(programName)
+        if path is None:
+            #don't cache misses, program may be installed later
+            return ""
+        program_paths[key]=path
+    return program_paths[key]
 
-def getProgramVersion(programName):
+def get_program_key(programName):
+    """Return the key used to cache version of a program: "path:mtime:size" of the resolved binary.
+    Returns None if the program can not be found.
     """
-    Get version of installed program
+    path=getProgramPath(programName)
+    if not path:
+        return None
+    try:
+        st=os.stat(path)
+    except OSError:
+        return None
+    return "{}:{}:{}".format(os.path.realpath(path),st.st_mtime_ns,st.st_size)
+
+def probe_program_version(programName):
+    """
+    Get version of program by trying common version flags
     return version as string
     """
     versionCommands=['--version','-version','--ver','-ver','-v','--v']
@@ -448,10 +2058,36 @@ def getProgramVersion(programName):
             return out[1].decode("utf-8")
     
     return ""
+
+def getProgramVersion(programName):
+    """
+    Get version of installed program
+    return version as string
+    
+    Versions are cached in memory and on disk (see get_tool_cache_file) using the program's path, modification time and size.
+    Version commands are executed only once per installed binary.
+    """
+    global program_versions_loaded
+    key=get_program_key(programName)
+    if key is None:
+        return probe_program_version(programName)
+    
+    with tool_cache_lock:
+        if not program_versions_loaded:
+            program_versions.update(read_tool_cache())
+            program_versions_loaded=True
+        if key in program_versions:
+            return program_versions[key]
+    
+    version=probe_program_version(programName)
+    with tool_cache_lock:
+        program_versions[key]=version
+        write_tool_cache(key,version)
+    return version
     
 def check_dependencies(dependencies):
     """Check whether specified programs exist in the environment.
-    This uses the which command to test whether a program is present.
+    Programs are searched in PATH in-process (see getProgramPath).
     
     Parameters
     ----------
@@ -465,8 +2101,7 @@ def check_dependencies(dependencies):
     errorFlag=False
     for s in dependencies:
         #print_blue("Checking "+s+"...")
-        thisCmd=['which',s]
-        if(getReturnStatus(thisCmd)):
+        if getProgramPath(s):
             #print_green ("Found "+s)
             pass
         else:
@@ -482,39 +2117,27 @@ def deleteFileFromDisk(filePath):
     """Delete a given file from disk
     Returns true if file is deleted or doesn't exist
     """
-    if pu.check_files_exist(filePath):
-        rm_Cmd=['rm',filePath]
-        rv= getReturnStatus(rm_Cmd)
-        return rv
-    #if file doesn't exist return true
-    return True
+    return deleteMultipleFilesFromDisk(filePath)
 
 def deleteMultipleFilesFromDisk(*args):
     """Delete multiple files passed as argument.
+    Files that could not be deleted are reported.
     returns true is all files a re deleted
     """
-    errorFlag=False
-    for filePath in args:
-        status=deleteFileFromDisk(filePath)
-        if not status:
-            errorFlag=True
-    
-    return not(errorFlag)
+    errors=pu.delete_files(*args)
+    for path,error in errors.items():
+        pu.print_boldred("Failed to delete {}: {}".format(path,error))
+    return not errors
 
 def move_file(source,destination):
-    """perform mv command to move a file from sourc to destination
+    """Move a file from source to destination, see pyrpipe_utils.move_file
     Returns True if move is successful
     """
-    #print("MOV:"+source+"-->"+destination)
-    mv_cmd=['mv',source,destination]
-    if not getReturnStatus(mv_cmd):
-        return False
-    return True
+    return pu.move_file(source,destination)
 
 
-#TODO: use os.scandir
-def find_files(search_path,search_pattern,recursive=False,verbose=False):
-    """Function to find files using find command and return as list
+def find_files(search_path,search_pattern,recursive=False,verbose=False,snapshot=None):
+    """Function to find files and return as list
     Use global paths for safety
     
     Parameters
@@ -526,25 +2149,155 @@ def find_files(search_path,search_pattern,recursive=False,verbose=False):
         pattern to search e.g. "*.bam"
     recursive: bool
         search all subdirs if true
+    snapshot: DirectorySnapshot
+        use the cached directory listings of snapshot instead of reading the directories
 
     :return: list containing the found paths
     :rtype: list
     """
-    
-    if recursive:
-        find_cmd=['find', search_path,'-type', 'f','-name',search_pattern]   
-    else:
-        find_cmd=['find', search_path,'-maxdepth', '1','-type', 'f','-name',search_pattern] 
     if verbose:
-        print("$ "+" ".join(find_cmd))
-    st=getShellOutput(find_cmd)
-    output=[]
-    if st[0]==0:
-        output=st[1].decode("utf-8").split("\n")
-    #remove empty strings
-    if '' in output:
-        output.remove('')
-    return output
+        print("Searching {} for {}".format(search_path,search_pattern))
+    return list(iter_files(search_path,search_pattern,recursive=recursive,snapshot=snapshot))
+
+def iter_files(search_path,search_pattern="*",recursive=False,snapshot=None):
+    """Generator of the regular files under search_path with names matching search_pattern.
+    Matching is same as find -name: a case sensitive glob on the file name. Symbolic links are not followed.
+    
+    Parameters
+    ----------
+    
+    search_path: str
+        path to search under
+    search_pattern: str
+        pattern to search e.g. "*.bam"
+    recursive: bool
+        search all subdirs if true
+    snapshot: DirectorySnapshot
+        use the cached directory listings of snapshot instead of reading the directories
+
+    :return: generator of paths
+    :rtype: generator
+    """
+    listdir=snapshot.listdir if snapshot is not None else read_dir
+    dirs=[search_path]
+    while dirs:
+        this_dir=dirs.pop()
+        entries=listdir(this_dir)
+        if not entries:
+            continue
+        subdirs=[]
+        for name,kind in entries.items():
+            if kind=='f':
+                if fnmatch.fnmatchcase(name,search_pattern):
+                    yield os.path.join(this_dir,name)
+            elif kind=='d' and recursive:
+                subdirs.append(os.path.join(this_dir,name))
+        #visit subdirs in listing order
+        dirs.extend(reversed(subdirs))
+
+def read_dir(path):
+    """Read the entries of a directory with os.scandir
+    
+    :return: dict with names as keys and kind as values: f (file), d (directory) or o (other e.g. symlink). None if path can not be read.
+    :rtype: dict
+    """
+    entries={}
+    try:
+        #the iterator is exhausted here, which closes it; scandir is not a context manager before Python 3.6
+        scanned=list(os.scandir(path))
+    except OSError:
+        return None
+    for entry in scanned:
+        try:
+            if entry.is_file(follow_symlinks=False):
+                entries[entry.name]='f'
+            elif entry.is_dir(follow_symlinks=False):
+                entries[entry.name]='d'
+            else:
+                entries[entry.name]='o'
+        except OSError:
+            entries[entry.name]='o'
+    return entries
+
+
+class DirectorySnapshot():
+    """Cache of directory listings shared by many lookups, e.g. when creating SRA objects for
+    thousands of accessions under one directory. Each directory is read once with os.scandir.
+    The snapshot is not updated when files are created or deleted; call invalidate() or create a new snapshot.
+    
+    Parameters
+    ----------
+    
+    root: str
+        if provided, root and all directories under it are read immediately. Paths under root that were not found are
+        then known to be absent without reading the disk again.
+    """
+    def __init__(self,root=None):
+        #dict of dir path to its entries as returned by read_dir
+        self.listings={}
+        self.roots=[]
+        self.lock=threading.Lock()
+        if root is not None:
+            self.scan(root)
+    
+    def scan(self,root):
+        """Read root and all directories under it
+        """
+        root=os.path.abspath(root)
+        dirs=[root]
+        while dirs:
+            this_dir=dirs.pop()
+            entries=self.read_dir(this_dir)
+            if entries:
+                dirs.extend(os.path.join(this_dir,name) for name,kind in entries.items() if kind=='d')
+        with self.lock:
+            self.roots.append(root)
+    
+    def read_dir(self,path):
+        entries=read_dir(path)
+        with self.lock:
+            self.listings[os.path.abspath(path)]=entries
+        return entries
+    
+    def listdir(self,path):
+        """Return the entries of a directory
+        
+        :return: dict with names as keys and kind (f, d or o) as values. None if path is not a directory.
+        :rtype: dict
+        """
+        key=os.path.abspath(path)
+        with self.lock:
+            if key in self.listings:
+                return self.listings[key]
+            #not found during scan of a root
+            for root in self.roots:
+                if key.startswith(root+os.sep):
+                    return None
+        return self.read_dir(path)
+    
+    def is_file(self,path):
+        """Check if path is an existing file
+        """
+        parent,name=os.path.split(os.path.abspath(path))
+        entries=self.listdir(parent)
+        if not entries or name not in entries:
+            return False
+        if entries[name]=='o':
+            #e.g. a symlink
+            return os.path.isfile(path)
+        return entries[name]=='f'
+    
+    def invalidate(self,path=None):
+        """Remove cached listing of a directory, or all listings if path is None
+        """
+        with self.lock:
+            if path is None:
+                self.listings={}
+                self.roots=[]
+                return
+            key=os.path.abspath(path)
+            self.listings.pop(key,None)
+            self.roots=[r for r in self.roots if not (key==r or key.startswith(r+os.sep) or r.startswith(key+os.sep))]
     
 
 
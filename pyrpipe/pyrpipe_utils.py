@@ -7,6 +7,11 @@ Created on Mon Oct 21 12:04:28 2019
 """
 
 import os
+import errno
+import json
+import shutil
+import tempfile
+import threading
 import datetime as dt
 
 
@@ -126,6 +131,52 @@ def get_time_stamp(shorten=False):
     return timestamp
     
 
+def get_iso_time():
+    """Return the current local time in ISO 8601 format with millisecond precision.
+    
+    :return: timestamp as string e.g. 2020-01-22T18:14:47.123
+    :rtype: string
+    """
+    now=dt.datetime.now()
+    return now.strftime("%Y-%m-%dT%H:%M:%S")+".{:03d}".format(now.microsecond//1000)
+
+def parse_time(timestring):
+    """Parse a timestamp from pyrpipe logs. 
+    ISO 8601 timestamps and the "%y-%m-%d %H:%M:%S" format used by older logs are supported.
+    
+    :return: the time
+    :rtype: datetime
+    """
+    for time_format in ["%Y-%m-%dT%H:%M:%S.%f","%Y-%m-%dT%H:%M:%S"]:
+        try:
+            return dt.datetime.strptime(timestring,time_format)
+        except ValueError:
+            pass
+    return dt.datetime.strptime(timestring,"%y-%m-%d %H:%M:%S")
+
+def parse_runtime(runtime):
+    """Parse runtime of a command from pyrpipe logs and return seconds.
+    Runtime is saved as seconds. Older logs save it as a timedelta string e.g. "1 day, 2:03:04".
+    
+    :return: runtime in seconds or None if runtime is None
+    :rtype: float
+    """
+    if runtime is None:
+        return None
+    try:
+        return float(runtime)
+    except ValueError:
+        pass
+    #timedelta string
+    days=0
+    if "day" in runtime:
+        temp=runtime.split(",")
+        days=int(temp[0].split(" ")[0].strip())
+        runtime=temp[1].strip()
+    hours,minutes,seconds=runtime.split(":")
+    return days*86400+int(hours)*3600+int(minutes)*60+float(seconds)
+    
+
 def get_sra_ftppath(srrid):
     """Return an ftp address to download sra files
     """
@@ -182,6 +233,165 @@ def check_files_exist(*args):
         return False
     return True
 
+#files required in an index, as alternatives e.g. small or large index.
+#For hisat2, bowtie2 and kallisto these are suffixes of the index prefix; for star and salmon files in the index directory.
+INDEX_FILES={'hisat2':[[".{}.ht2".format(i) for i in range(1,9)],[".{}.ht2l".format(i) for i in range(1,9)]],
+             'bowtie2':[[".1.bt2",".2.bt2",".3.bt2",".4.bt2",".rev.1.bt2",".rev.2.bt2"],
+                        [".1.bt2l",".2.bt2l",".3.bt2l",".4.bt2l",".rev.1.bt2l",".rev.2.bt2l"]],
+             'kallisto':[[""]],
+             'star':[['chrLength.txt','chrNameLength.txt','chrName.txt','chrStart.txt','genomeParameters.txt','Genome','SA','SAindex']],
+             #salmon>=1.0 dense and sparse indexes, and the older quasi-mapping index
+             'salmon':[['versionInfo.json','info.json','ctable.bin','mphf.bin','seq.bin','pos.bin'],
+                       ['versionInfo.json','info.json','ctable.bin','mphf.bin','seq.bin','sample_pos.bin'],
+                       ['versionInfo.json','header.json','hash.bin','sa.bin','txpInfo.bin']]
+             }
+#tools whose index is a directory
+INDEX_DIR_TOOLS=['star','salmon']
+#name of the manifest written after an index is built
+INDEX_MANIFEST_NAME="pyrpipe_index.json"
+#valid indexes with the mtimes they were validated at
+index_verdicts={}
+index_verdicts_lock=threading.Lock()
+
+def get_index_manifest_path(tool,index):
+    """Return path to the manifest of an index: <index>/pyrpipe_index.json for star and salmon,
+    <index>.pyrpipe_index.json for the others
+    """
+    if tool in INDEX_DIR_TOOLS:
+        return os.path.join(index,INDEX_MANIFEST_NAME)
+    return index+"."+INDEX_MANIFEST_NAME
+
+def get_index_shards(tool,index):
+    """Return paths to the required files of an index, for the first alternative of INDEX_FILES that exists
+    
+    :return: dict with names as keys and paths as values. None if the required files are missing or empty.
+    :rtype: dict
+    """
+    for alternative in INDEX_FILES[tool]:
+        if tool in INDEX_DIR_TOOLS:
+            shards={f:os.path.join(index,f) for f in alternative}
+        else:
+            shards={f:index+f for f in alternative}
+        if all(os.path.isfile(p) and os.path.getsize(p)>0 for p in shards.values()):
+            return shards
+    return None
+
+def get_index_inputs(tool,index):
+    """Return paths to the required files of an index, to use as checkpoint inputs of the commands that read the index.
+    Other files next to the index, e.g. outputs written to the same directory, do not change the checkpoint.
+    
+    :return: list of paths. Empty if the index is incomplete.
+    :rtype: list
+    """
+    return sorted((get_index_shards(tool,index) or {}).values())
+
+def write_index_manifest(tool,index):
+    """Save the files of a newly built index and their sizes in the index manifest.
+    The manifest marks the build as complete; check_index_files then verifies all the files.
+    For star and salmon all files in the index directory are included.
+    
+    :return: True if the manifest was written
+    :rtype: bool
+    """
+    shards=get_index_shards(tool,index)
+    if shards is None:
+        print_boldred("Can not write manifest. Incomplete {} index: {}".format(tool,index))
+        return False
+    if tool in INDEX_DIR_TOOLS:
+        for root,dirs,files in os.walk(index):
+            for f in files:
+                name=os.path.relpath(os.path.join(root,f),index)
+                if name!=INDEX_MANIFEST_NAME:
+                    shards[name]=os.path.join(root,f)
+    manifest={'tool':tool,
+              'complete':True,
+              'files':{name:os.path.getsize(path) for name,path in shards.items()},
+              'time':get_iso_time()}
+    manifest_path=get_index_manifest_path(tool,index)
+    temp_path=manifest_path+".tmp"
+    try:
+        with open(temp_path,'w') as f:
+            json.dump(manifest,f,indent=1)
+        os.replace(temp_path,manifest_path)
+    except OSError as e:
+        print_boldred("Failed to write index manifest {}: {}".format(manifest_path,str(e)))
+        return False
+    return True
+
+def check_index_files(tool,index):
+    """Check all files of an index. If the index has a manifest, every file in the manifest must exist with the saved size.
+    Otherwise (e.g. index built outside pyrpipe) all the required files must exist and be non-empty.
+    
+    :return: Return true if index is valid
+    :rtype: bool
+    """
+    try:
+        with open(get_index_manifest_path(tool,index)) as f:
+            manifest=json.load(f)
+    except OSError:
+        return get_index_shards(tool,index) is not None
+    except ValueError:
+        #partially written manifest
+        return False
+    if not manifest.get('complete'):
+        return False
+    for name,size in manifest.get('files',{}).items():
+        path=os.path.join(index,name) if tool in INDEX_DIR_TOOLS else index+name
+        try:
+            if os.path.getsize(path)!=size:
+                return False
+        except OSError:
+            return False
+    return True
+
+def get_index_mtimes(tool,index):
+    """Return modification times of the index directory and the manifest; None if the index directory does not exist
+    """
+    index_dir=index if tool in INDEX_DIR_TOOLS else os.path.dirname(index) or "."
+    try:
+        dir_mtime=os.stat(index_dir).st_mtime_ns
+    except OSError:
+        return None
+    try:
+        manifest_mtime=os.stat(get_index_manifest_path(tool,index)).st_mtime_ns
+    except OSError:
+        manifest_mtime=None
+    return (dir_mtime,manifest_mtime)
+
+def validate_index(tool,index):
+    """Check if an index is valid (see check_index_files).
+    Valid verdicts are cached against the modification times of the index directory and manifest, so repeated checks of an
+    unchanged index only stat two paths. Adding, removing or replacing index files, or rebuilding the index, changes the
+    directory mtime and the index is checked again.
+    
+    Parameters
+    ----------
+    
+    tool: str
+        hisat2, bowtie2, kallisto, star or salmon
+    index: str
+        Path to the index 
+
+    :return: Return true if index is valid
+    :rtype: bool
+    """
+    if not index:
+        return False
+    mtimes=get_index_mtimes(tool,index)
+    if mtimes is None:
+        return False
+    key=(tool,os.path.abspath(index))
+    with index_verdicts_lock:
+        if index_verdicts.get(key)==mtimes:
+            return True
+    if not check_index_files(tool,index):
+        with index_verdicts_lock:
+            index_verdicts.pop(key,None)
+        return False
+    with index_verdicts_lock:
+        index_verdicts[key]=mtimes
+    return True
+
 def check_hisatindex(index):
     """Function to check if hisat2 index is valid and exists.
     
@@ -194,7 +404,7 @@ def check_hisatindex(index):
     :return: Return true if index is valid
     :rtype: bool
     """
-    return check_files_exist(index+".1.ht2")
+    return validate_index('hisat2',index)
 
 def check_salmonindex(index):
     """Function to check if salmon index is valid and exists.
@@ -208,9 +418,7 @@ def check_salmonindex(index):
     :return: Return true if index is valid
     :rtype: bool
     """
-    if not check_paths_exist(index):
-        return False
-    return True
+    return validate_index('salmon',index)
 
 def check_starindex(index):
     """Function to check if star index is valid and exists.
@@ -224,19 +432,7 @@ def check_starindex(index):
     :return: Return true if index is valid
     :rtype: bool
     """
-    if check_paths_exist(index):
-        files_to_check=['chrLength.txt',
-                      'chrNameLength.txt',
-                      'chrName.txt',
-                      'chrStart.txt',
-                      'genomeParameters.txt',
-                      'Genome']
-        for f in files_to_check:
-            if not check_files_exist(os.path.join(index,f)):
-                return False
-        return True
-    
-    return False
+    return validate_index('star',index)
 
 def check_bowtie2index(index):
     """Function to check if bowtie2 index is valid and exists.
@@ -250,7 +446,21 @@ def check_bowtie2index(index):
     :return: Return true if index is valid
     :rtype: bool
     """
-    return check_files_exist(index+".1.bt2")
+    return validate_index('bowtie2',index)
+
+def check_kallistoindex(index):
+    """Function to check if kallisto index is valid and exists.
+    
+    Parameters
+    ----------
+    
+    index: str
+        Path to the index 
+
+    :return: Return true if index is valid
+    :rtype: bool
+    """
+    return validate_index('kallisto',index)
     
 
 def byte_to_readable(size_bytes):
@@ -289,6 +499,25 @@ def get_file_size(file_path):
         file_info = os.stat(file_path)
         return byte_to_readable(file_info.st_size)
     
+def get_available_memory():
+    """Returns the memory available to start new processes, without swapping.
+    MemAvailable in /proc/meminfo is used if present, else the free physical memory.
+
+    :return: available memory in bytes. 0 if it can not be determined.
+    :rtype: int
+    """
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1])*1024
+    except (OSError,ValueError,IndexError):
+        pass
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES')*os.sysconf('SC_PAGE_SIZE')
+    except (OSError,ValueError,AttributeError):
+        return 0
+
 
 #TODO: override in case of empty list
 def parse_java_args(valid_args_list,passed_args):
@@ -475,6 +704,97 @@ def mkdir(dir_path):
     return True
 
 
+#chunk size used to copy files across filesystems
+COPY_CHUNK_BYTES=4*1024*1024
+
+def delete_files(*args):
+    """Delete files. Files that do not exist are ignored. 
+    Files in the same directory are deleted relative to one open directory descriptor.
+    
+    Parameters
+    ----------
+    
+    args: tuple
+        paths to delete
+
+    :return: dict of errors with paths that could not be deleted as keys. Empty if all files were deleted.
+    :rtype: dict
+    """
+    errors={}
+    by_dir={}
+    for path in args:
+        by_dir.setdefault(os.path.dirname(os.path.abspath(path)),[]).append(path)
+    use_dir_fd=os.unlink in os.supports_dir_fd
+    for dir_path,paths in by_dir.items():
+        dir_fd=None
+        if use_dir_fd:
+            try:
+                dir_fd=os.open(dir_path,os.O_RDONLY)
+            except OSError:
+                dir_fd=None
+        try:
+            for path in paths:
+                try:
+                    if dir_fd is not None:
+                        os.unlink(os.path.basename(path),dir_fd=dir_fd)
+                    else:
+                        os.unlink(path)
+                except FileNotFoundError:
+                    pass
+                except OSError as e:
+                    errors[path]=e.strerror or str(e)
+        finally:
+            if dir_fd is not None:
+                os.close(dir_fd)
+    return errors
+
+def move_file(source,destination):
+    """Move a file or directory. If destination is a directory, source is moved into it.
+    Within a filesystem the file is renamed atomically with os.replace. Across filesystems it is copied in chunks
+    to a temporary file next to destination, which is then renamed to destination, and source is deleted.
+    
+    Parameters
+    ----------
+    
+    source: str
+        path to move
+    destination: str
+        new path or an existing directory
+
+    :return: true if moved
+    :rtype: bool
+    """
+    if os.path.isdir(destination):
+        destination=os.path.join(destination,os.path.basename(source))
+    try:
+        os.replace(source,destination)
+        return True
+    except OSError as e:
+        if e.errno!=errno.EXDEV:
+            print_boldred("Failed to move {} to {}: {}".format(source,destination,e.strerror or str(e)))
+            return False
+    #source and destination are on different filesystems
+    try:
+        if os.path.isdir(source):
+            shutil.move(source,destination)
+            return True
+        fd,temp_path=tempfile.mkstemp(prefix="."+os.path.basename(destination)+"_",dir=os.path.dirname(os.path.abspath(destination)))
+        try:
+            with open(source,'rb') as fin, os.fdopen(fd,'wb') as fout:
+                shutil.copyfileobj(fin,fout,COPY_CHUNK_BYTES)
+            shutil.copystat(source,temp_path)
+            os.replace(temp_path,destination)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
+            raise
+        os.unlink(source)
+    except OSError as e:
+        print_boldred("Failed to move {} to {}: {}".format(source,destination,e.strerror or str(e)))
+        return False
+    return True
+
+
 def get_union(*args):
     """Return unioin of multiple input lists.
     """
@@ -51,6 +51,8 @@ class Trimgalore(RNASeqQC):
             
         #initialize the passed arguments
         self.passedArgumentDict=kwargs
+        #flags setting the number of threads; threads are taken from the thread budget if not set
+        self.thread_args=['--cores','-j']
         
         
             
@@ -158,21 +160,38 @@ class Trimgalore(RNASeqQC):
         :rtype: bool
         """
         
-        #override existing arguments
-        mergedArgsDict={**self.passedArgumentDict,**kwargs}
-        
-        #create command to run
-        trimgalore_cmd=['trim_galore']
-        trimgalore_cmd.extend(pu.parse_unix_args(self.valid_args,mergedArgsDict))
-        
+        trimgalore_cmd=self.get_trimgalore_cmd(**kwargs)
         
         #start ececution
-        status=pe.execute_command(trimgalore_cmd,verbose=verbose,quiet=quiet,logs=logs,objectid=objectid)
+        status=pe.execute_command(trimgalore_cmd,verbose=verbose,quiet=quiet,logs=logs,objectid=objectid,thread_flags=self.thread_args)
         if not status:
             pu.print_boldred("trimgalore failed")
         
         #return status
         return status
+    
+    async def run_trimgalore_async(self,verbose=False,quiet=False,logs=True,objectid="NA",**kwargs):
+        """Coroutine version of run_trimgalore. Parameters are same as run_trimgalore.
+        
+        :return: Status of trimgalore command
+        :rtype: bool
+        """
+        trimgalore_cmd=self.get_trimgalore_cmd(**kwargs)
+        status=await pe.execute_command_async(trimgalore_cmd,verbose=verbose,quiet=quiet,logs=logs,objectid=objectid,thread_flags=self.thread_args)
+        if not status:
+            pu.print_boldred("trimgalore failed")
+        return status
+    
+    def get_trimgalore_cmd(self,**kwargs):
+        """Return the trim_galore command with arguments in self.passedArgumentDict overridden by kwargs
+        """
+        #override existing arguments
+        mergedArgsDict={**self.passedArgumentDict,**kwargs}
+        
+        #create command to run
+        trimgalore_cmd=['trim_galore']
+        trimgalore_cmd.extend(pu.parse_unix_args(self.valid_args,mergedArgsDict))
+        return trimgalore_cmd
         
 
             
@@ -218,6 +237,8 @@ class BBmap(RNASeqQC):
                             'cardinalityout','loglogk','loglogbuckets','-Xmx','-eoom','-da']
         
         self.passedArgumentDict=kwargs
+        #flags setting the number of threads; threads are taken from the thread budget if not set
+        self.thread_args=['threads=']
             
             
             
@@ -298,6 +319,27 @@ class BBmap(RNASeqQC):
     def run_bbduk(self,verbose=False,quiet=False,logs=True,objectid="NA",**kwargs):
         """Wrapper to run bbduk.sh
         """
+        bbduk_cmd=self.get_bbduk_cmd(**kwargs)
+        
+        #start ececution
+        status=pe.execute_command(bbduk_cmd,verbose=verbose,quiet=quiet,logs=logs,objectid=objectid,thread_flags=self.thread_args)
+        if not status:
+            pu.print_boldred("bbduk failed")
+        #return status
+        return status
+    
+    async def run_bbduk_async(self,verbose=False,quiet=False,logs=True,objectid="NA",**kwargs):
+        """Coroutine version of run_bbduk
+        """
+        bbduk_cmd=self.get_bbduk_cmd(**kwargs)
+        status=await pe.execute_command_async(bbduk_cmd,verbose=verbose,quiet=quiet,logs=logs,objectid=objectid,thread_flags=self.thread_args)
+        if not status:
+            pu.print_boldred("bbduk failed")
+        return status
+    
+    def get_bbduk_cmd(self,**kwargs):
+        """Return the bbduk.sh command with arguments in self.passedArgumentDict overridden by kwargs
+        """
         #override existing arguments
         mergedArgsDict={**self.passedArgumentDict,**kwargs}
         
@@ -306,14 +348,7 @@ class BBmap(RNASeqQC):
         
         #bbduk.sh follows java style arguments
         bbduk_cmd.extend(pu.parse_java_args(self.valid_args,mergedArgsDict))
-        
-        
-        #start ececution
-        status=pe.execute_command(bbduk_cmd,verbose=verbose,quiet=quiet,logs=logs,objectid=objectid)
-        if not status:
-            pu.print_boldred("bbduk failed")
-        #return status
-        return status
+        return bbduk_cmd
     
  
     
@@ -433,7 +468,30 @@ class BBmap(RNASeqQC):
         :return: Status of bbsplit command
         :rtype: bool
         """
+        bbsp_cmd=self.get_bbsplit_cmd(**kwargs)
+        
+        #start ececution
+        status=pe.execute_command(bbsp_cmd,verbose=verbose,quiet=quiet,logs=logs,objectid=objectid,thread_flags=self.thread_args)
+        if not status:
+            pu.print_boldred("bbsplit failed")
+        #return status
+        return status
+    
+    async def run_bbsplit_async(self,verbose=False,quiet=False,logs=True,objectid="NA",**kwargs):
+        """Coroutine version of run_bbsplit
         
+        :return: Status of bbsplit command
+        :rtype: bool
+        """
+        bbsp_cmd=self.get_bbsplit_cmd(**kwargs)
+        status=await pe.execute_command_async(bbsp_cmd,verbose=verbose,quiet=quiet,logs=logs,objectid=objectid,thread_flags=self.thread_args)
+        if not status:
+            pu.print_boldred("bbsplit failed")
+        return status
+    
+    def get_bbsplit_cmd(self,**kwargs):
+        """Return the bbsplit.sh command with arguments in kwargs
+        """
         bbsplit_args=['ref','ref_x','build','path','in','in1','in2','outu','outu2','outu1','qin','interleaved',
                           'maxindel','minratio','minhits','ambiguous','ambiguous2',
                           'qtrim','untrim','out_','basename','bs','scafstats',
@@ -448,14 +506,7 @@ class BBmap(RNASeqQC):
         
         #bbduk.sh follows java style arguments
         bbsp_cmd.extend(pu.parse_java_args(bbsplit_args,mergedArgsDict))
-        
-        
-        #start ececution
-        status=pe.execute_command(bbsp_cmd,verbose=verbose,quiet=quiet,logs=logs,objectid=objectid)
-        if not status:
-            pu.print_boldred("bbsplit failed")
-        #return status
-        return status
+        return bbsp_cmd
     
     
     
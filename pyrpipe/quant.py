@@ -8,6 +8,7 @@ Created on Thu Jan  2 18:20:41 2020
 
 from pyrpipe import pyrpipe_utils as pu
 from pyrpipe import pyrpipe_engine as pe
+from pyrpipe import index_registry
 import os
 
 class Quant:
@@ -63,12 +64,14 @@ class Kallisto(Quant):
         self.validArgsh5dump=['-o','--output-dir']
         
         self.valid_args=pu.get_union(self.validArgsIndex,self.validArgsQuant,self.validArgsPseudo,self.validArgsh5dump)
+        #flags setting the number of threads of each subcommand; threads are taken from the thread budget if not set
+        self.thread_args={'quant':['-t','--threads'],'pseudo':['-t','--threads']}
         
         #initialize the passed arguments
         self.passedArgumentDict=kwargs
         
         #if index is passed, update the passed arguments
-        if len(kallisto_index)>0 and pu.check_files_exist(kallisto_index):
+        if len(kallisto_index)>0 and pu.check_kallistoindex(kallisto_index):
             print("kallisto index is: "+kallisto_index)
             self.kallisto_index=kallisto_index
             self.passedArgumentDict['-i']=self.kallisto_index
@@ -77,6 +80,7 @@ class Kallisto(Quant):
             
     def build_index(self,index_path,index_name,fasta,verbose=False,quiet=False,logs=True,objectid="NA",**kwargs):
         """Function to  build kallisto index
+        If the index registry is enabled (see index_registry), the index is saved there and linked as index_path/index_name.
         
         index_path: str
             path to the output directory
@@ -109,22 +113,25 @@ class Kallisto(Quant):
                 return False
             
         indexOut=os.path.join(index_path,index_name)
-        newOpts={"--":(fasta,),"-i":indexOut}
-        mergedOpts={**kwargs,**newOpts}
+        def build(build_path,build_name):
+            newOpts={"--":(fasta,),"-i":os.path.join(build_path,build_name)}
+            mergedOpts={**kwargs,**newOpts}
+            status=self.run_kallisto("index",verbose=verbose,quiet=quiet,logs=logs,objectid=objectid,**mergedOpts)
+            return status and pu.write_index_manifest('kallisto',os.path.join(build_path,build_name))
         
-        #call salmon
-        status=self.run_kallisto("index",verbose=verbose,quiet=quiet,logs=logs,objectid=objectid,**mergedOpts)
+        #only the index options change the index
+        params={k:v for k,v in {**self.passedArgumentDict,**kwargs}.items() if k in self.validArgsIndex and k not in ['-i','--index']}
+        status=index_registry.get_index("kallisto",[self.programName],[fasta],params,index_path,index_name,build)
         
         if status:
-            #check if sam file is present in the location directory of sra_object
-            if pu.check_files_exist(indexOut):
+            if pu.check_kallistoindex(indexOut):
                 self.kallisto_index=indexOut
                 self.passedArgumentDict['-i']=self.kallisto_index
                 pu.print_green("kallisto_index is:"+self.kallisto_index)
                 return True
-        else:
-            pu.print_boldred("Failed to create kallisto index")
-            return False
+        
+        pu.print_boldred("Failed to create kallisto index")
+        return False
     
     def perform_quant(self,sra_object,out_dir="",verbose=False,quiet=False,logs=True,objectid="NA",**kwargs):
         """Run kallisto quant
@@ -200,6 +207,29 @@ class Kallisto(Quant):
         :rtype: bool
         """
         
+        kallisto_Cmd=self.get_kallisto_cmd(subcommand,**kwargs)
+        
+        #start ececution
+        status=pe.execute_command(kallisto_Cmd,verbose=verbose,quiet=quiet,logs=logs,objectid=objectid,command_name=" ".join(kallisto_Cmd[0:2]),thread_flags=self.thread_args.get(subcommand))
+        if not status:
+            pu.print_boldred("kallisto failed")
+        return status       
+    
+    async def run_kallisto_async(self,subcommand,verbose=False,quiet=False,logs=True,objectid="NA",**kwargs):
+        """Coroutine version of run_kallisto. Parameters are same as run_kallisto.
+        
+        :return: Returns the status of kallisto. True is passed, False if failed.
+        :rtype: bool
+        """
+        kallisto_Cmd=self.get_kallisto_cmd(subcommand,**kwargs)
+        status=await pe.execute_command_async(kallisto_Cmd,verbose=verbose,quiet=quiet,logs=logs,objectid=objectid,command_name=" ".join(kallisto_Cmd[0:2]),thread_flags=self.thread_args.get(subcommand))
+        if not status:
+            pu.print_boldred("kallisto failed")
+        return status
+    
+    def get_kallisto_cmd(self,subcommand,**kwargs):
+        """Return the kallisto command with arguments in self.passedArgumentDict overridden by kwargs
+        """
         #check for a valid index
         if subcommand!="index":
             if not self.check_index():
@@ -210,18 +240,13 @@ class Kallisto(Quant):
             
         kallisto_Cmd=['kallisto',subcommand]
         kallisto_Cmd.extend(pu.parse_unix_args(self.valid_args,mergedArgsDict))
-        
-        #start ececution
-        status=pe.execute_command(kallisto_Cmd,verbose=verbose,quiet=quiet,logs=logs,objectid=objectid,command_name=" ".join(kallisto_Cmd[0:2]))
-        if not status:
-            pu.print_boldred("kallisto failed")
-        return status       
+        return kallisto_Cmd
     
     def check_index(self):
         """Check valid kallisto index
         """
         if hasattr(self,'kallisto_index'):
-            return(pu.check_files_exist(self.kallisto_index))
+            return(pu.check_kallistoindex(self.kallisto_index))
         return False
             
 
@@ -276,12 +301,14 @@ class Salmon(Quant):
         self.validArgsQuantMerge=['--quants','--names','-c','--column','-o','--output']
 
         self.valid_args=pu.get_union(self.validArgsIndex,self.validArgsQuantReads,self.validArgsQuantAlign,self.validArgsQuantMerge)
+        #flags setting the number of threads of each subcommand; threads are taken from the thread budget if not set
+        self.thread_args={'index':['-p','--threads'],'quant':['-p','--threads']}
         
         #initialize the passed arguments
         self.passedArgumentDict=kwargs
         
         #if index is passed, update the passed arguments
-        if len(salmon_index)>0 and pu.check_salmon_index(salmon_index):
+        if len(salmon_index)>0 and pu.check_salmonindex(salmon_index):
             print("salmon index is: "+salmon_index)
             self.salmon_index=salmon_index
             self.passedArgumentDict['-i']=self.salmon_index
@@ -293,6 +320,7 @@ class Salmon(Quant):
     def build_index(self,index_path,index_name,fasta,verbose=False,quiet=False,logs=True,objectid="NA",**kwargs):
         """
         build salmon index and store the path to index in self
+        If the index registry is enabled (see index_registry), the index is saved there and linked as index_path/index_name.
         
         index_path: str
             path to the output directory
@@ -323,16 +351,19 @@ class Salmon(Quant):
                 print("ERROR in building hisat2 index. Failed to create index directory.")
                 return False
         indexOut=os.path.join(index_path,index_name)
-        newOpts={"-t":fasta,"-i":indexOut}
-        mergedOpts={**kwargs,**newOpts}
+        def build(build_path,build_name):
+            newOpts={"-t":fasta,"-i":os.path.join(build_path,build_name)}
+            mergedOpts={**kwargs,**newOpts}
+            status=self.run_salmon("index",verbose=verbose,quiet=quiet,logs=logs,objectid=objectid,**mergedOpts)
+            return status and pu.write_index_manifest('salmon',os.path.join(build_path,build_name))
         
-        #call salmon
-        status=self.run_salmon("index",verbose=verbose,quiet=quiet,logs=logs,objectid=objectid,**mergedOpts)
+        #only the index options change the index; threads do not
+        params={k:v for k,v in {**self.passedArgumentDict,**kwargs}.items()
+                if k in self.validArgsIndex and k not in ['-i','--index','-t','--transcripts','-p','--threads']}
+        status=index_registry.get_index("salmon",[self.programName],[fasta],params,index_path,index_name,build)
         
         if status:
-            #check if sam file is present in the location directory of sra_object
-            #if check_files_exist(os.path.join(indexOut,"versionInfo.json")): #not sure if this is reliable
-            if pu.check_paths_exist(indexOut):
+            if pu.check_salmonindex(indexOut):
                 self.salmon_index=indexOut
                 self.passedArgumentDict['-i']=self.salmon_index
                 pu.print_green("salmon index is:"+self.salmon_index)
@@ -411,6 +442,29 @@ class Salmon(Quant):
         :rtype: bool
         """
         
+        salmon_Cmd=self.get_salmon_cmd(subcommand,**kwargs)
+        
+        #start ececution
+        status=pe.execute_command(salmon_Cmd,verbose=verbose,quiet=quiet,logs=logs,objectid=objectid,command_name=" ".join(salmon_Cmd[0:2]),thread_flags=self.thread_args.get(subcommand))
+        if not status:
+            pu.print_boldred("salmon failed")
+        return status 
+    
+    async def run_salmon_async(self,subcommand,verbose=False,quiet=False,logs=True,objectid="NA",**kwargs):
+        """Coroutine version of run_salmon. Parameters are same as run_salmon.
+        
+        :return: Returns the status of salmon. True is passed, False if failed.
+        :rtype: bool
+        """
+        salmon_Cmd=self.get_salmon_cmd(subcommand,**kwargs)
+        status=await pe.execute_command_async(salmon_Cmd,verbose=verbose,quiet=quiet,logs=logs,objectid=objectid,command_name=" ".join(salmon_Cmd[0:2]),thread_flags=self.thread_args.get(subcommand))
+        if not status:
+            pu.print_boldred("salmon failed")
+        return status
+    
+    def get_salmon_cmd(self,subcommand,**kwargs):
+        """Return the salmon command with arguments in self.passedArgumentDict overridden by kwargs
+        """
         #check for a valid index
         if subcommand!="index":
             if not self.check_index():
@@ -421,12 +475,7 @@ class Salmon(Quant):
             
         salmon_Cmd=['salmon',subcommand]
         salmon_Cmd.extend(pu.parse_unix_args(self.valid_args,mergedArgsDict))
-        
-        #start ececution
-        status=pe.execute_command(salmon_Cmd,verbose=verbose,quiet=quiet,logs=logs,objectid=objectid,command_name=" ".join(salmon_Cmd[0:2]))
-        if not status:
-            pu.print_boldred("salmon failed")
-        return status 
+        return salmon_Cmd
 
     def check_index(self):
         if hasattr(self,'salmon_index'):
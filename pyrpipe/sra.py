@@ -11,6 +11,271 @@ Created on Sat Nov 23 15:45:26 2019
 from pyrpipe import pyrpipe_utils as pu
 from pyrpipe import pyrpipe_engine as pe
 import os
+import queue
+import shutil
+import tempfile
+import threading
+import time
+import json
+import re
+from concurrent.futures import ThreadPoolExecutor
+from enum import Enum
+
+#max number of chunks waiting to be written to a FIFO
+FIFO_QUEUE_SIZE=256
+#reads are passed to the FIFO writers in chunks of this size
+FIFO_CHUNK_BYTES=256*1024
+#mate suffix of paired fastq files written by fasterq-dump e.g. SRR1_1.fastq
+MATE_FILE_RE=re.compile(r'(.*)_([12])\.fastq$')
+#mate suffix of read names e.g. @SRR1.1/1
+MATE_READ_RE=re.compile(r'/[12]$')
+#run accessions of SRA, ENA and DDBJ
+ACCESSION_RE=re.compile(r'[SED]RR\d+')
+#column names of run accessions in SRA run tables and ENA reports
+ACCESSION_COLUMNS=['run','run_accession','accession']
+#programs required by SRA objects
+SRA_DEPENDENCIES=['prefetch','fasterq-dump']
+
+
+def get_metadata_path(directory,accession):
+    """Return path to the metadata file of an accession
+    """
+    return os.path.join(directory,accession+".metadata.json")
+
+def read_metadata(metadata_path):
+    """Read the metadata saved for an accession
+    
+    :return: metadata or empty dict if not found
+    :rtype: dict
+    """
+    try:
+        with open(metadata_path) as f:
+            return json.load(f)
+    except (OSError,ValueError):
+        return {}
+
+def write_metadata(metadata_path,metadata):
+    """Save metadata of an accession. The file is replaced atomically.
+    
+    :return: True if saved
+    :rtype: bool
+    """
+    try:
+        fd,temp_path=tempfile.mkstemp(prefix=".metadata_",dir=os.path.dirname(metadata_path) or ".")
+        with os.fdopen(fd,'w') as f:
+            json.dump(metadata,f)
+        os.replace(temp_path,metadata_path)
+        return True
+    except OSError as e:
+        pu.print_boldred("Failed to save metadata {}: {}".format(metadata_path,str(e)))
+        return False
+
+def read_fastq_name(fastq_file):
+    """Return the name of the first read in a fastq file without the mate suffix and description
+    
+    :return: read name or None if the file could not be read
+    :rtype: string
+    """
+    try:
+        with open(fastq_file,errors="replace") as f:
+            header=f.readline()
+    except OSError:
+        return None
+    if not header.startswith("@"):
+        return None
+    name=header[1:].split()[0] if header[1:].strip() else ""
+    return MATE_READ_RE.sub("",name)
+
+def get_read_name(header):
+    """Return the read name of a fastq header line (bytes) without the mate suffix and description
+    """
+    fields=header[1:].split(None,1)
+    if not fields:
+        return ""
+    return MATE_READ_RE.sub("",fields[0].decode(errors="replace"))
+
+def get_fastq_layout(fq_files,accession=None):
+    """Determine layout from fastq file names and headers, without running any program.
+    Files named <prefix>_1.fastq and <prefix>_2.fastq, or two files whose first reads have the same name, are paired.
+    A single file is single end. Any other two files are taken as paired, as in earlier versions, with a warning.
+    
+    Parameters
+    ----------
+    
+    fq_files: list
+        paths to fastq files
+    accession: string
+        if there are multiple candidates, use the files named <accession>_1.fastq and <accession>_2.fastq or <accession>.fastq
+    
+    :return: layout (SINGLE or PAIRED) and the fastq files. None and empty list if the layout can not be determined.
+    :rtype: tuple
+    """
+    fq_files=sorted(fq_files)
+    #pair by file name; fasterq-dump may also write unpaired reads to <prefix>.fastq
+    mates={}
+    for f in fq_files:
+        match=MATE_FILE_RE.match(f)
+        if match:
+            mates.setdefault(match.group(1),{})[match.group(2)]=f
+    pairs=[m for m in mates.values() if len(m)==2]
+    if len(pairs)>1 and accession:
+        pairs=[m for m in pairs if os.path.basename(MATE_FILE_RE.match(m['1']).group(1))==accession]
+    if len(pairs)==1:
+        return "PAIRED",[pairs[0]['1'],pairs[0]['2']]
+    if len(fq_files)>1 and accession:
+        single=[f for f in fq_files if os.path.basename(f)==accession+".fastq"]
+        if single and not pairs:
+            return "SINGLE",single
+    if len(fq_files)==1:
+        return "SINGLE",fq_files
+    if len(fq_files)==2:
+        name1=read_fastq_name(fq_files[0])
+        if not name1 or name1!=read_fastq_name(fq_files[1]):
+            pu.print_yellow("Could not match the reads of {} and {}; assuming they are paired".format(*fq_files))
+        return "PAIRED",fq_files
+    return None,[]
+
+
+class Layout(str,Enum):
+    """Layout of the reads of an accession. Compares equal to the strings SINGLE and PAIRED.
+    """
+    SINGLE="SINGLE"
+    PAIRED="PAIRED"
+    
+    def __str__(self):
+        return self.value
+
+
+class FastqStream:
+    """Feed the stdout of fasterq-dump --stdout into named pipes (FIFOs).
+    For paired-end data the reads of a spot are written alternately to the two FIFOs. The stream fails if
+    two reads of a spot do not have the same name, e.g. if a mate is missing from the output.
+    Each FIFO is written by its own thread from a bounded queue so that a consumer 
+    reading one mate ahead of the other does not block the stream.
+    fasterq-dump is started only when a consumer opens a FIFO, so nothing is downloaded if the consumer is
+    skipped (e.g. its outputs are up to date).
+    
+    Parameters
+    ----------
+    
+    fifo_paths: list
+        paths to the FIFOs. One for single-end and two for paired-end data.
+    """
+    def __init__(self,fifo_paths):
+        self.fifo_paths=fifo_paths
+        self.queues=[queue.Queue(maxsize=FIFO_QUEUE_SIZE) for p in fifo_paths]
+        self.writers=[threading.Thread(target=self.write_fifo,args=(p,q),daemon=True) for p,q in zip(fifo_paths,self.queues)]
+        #set if a consumer closed a FIFO before all reads were written
+        self.broken=False
+        #FIFOs opened by a consumer
+        self.opened=set()
+        #set when a FIFO is opened or the stream is closed
+        self.consumer_ready=threading.Event()
+        self.closing=False
+        self.consumed=False
+        self.status=False
+        #writers wait for a consumer to open their FIFO
+        for w in self.writers:
+            w.start()
+        
+    def write_fifo(self,fifo_path,chunk_queue):
+        """Write chunks from chunk_queue to fifo_path until None is received
+        """
+        try:
+            with open(fifo_path,'wb') as f:
+                #close() opens the FIFOs to release the writers; that is not a consumer
+                if not self.closing:
+                    self.opened.add(fifo_path)
+                self.consumer_ready.set()
+                while True:
+                    chunk=chunk_queue.get()
+                    if chunk is None:
+                        return
+                    f.write(chunk)
+        except OSError:
+            self.broken=True
+            #keep draining so that the reader of fasterq-dump never blocks
+            while chunk_queue.get() is not None:
+                pass
+            
+    def consume(self,stdout):
+        """Read fastq records from stdout and pass them to the FIFO writers.
+        """
+        self.consumed=True
+        try:
+            if len(self.queues)==1:
+                while not self.broken:
+                    chunk=stdout.read1(FIFO_CHUNK_BYTES)
+                    if not chunk:
+                        break
+                    self.queues[0].put(chunk)
+                return
+            
+            chunks=[bytearray() for q in self.queues]
+            mate=0
+            nlines=0
+            spot=None
+            for line in stdout:
+                if nlines==0:
+                    #reads of a spot must have the same name
+                    name=get_read_name(line)
+                    if mate==0:
+                        spot=name
+                    elif name!=spot:
+                        pu.print_boldred("Mates do not match in fasterq-dump output: {} and {}".format(spot,name))
+                        self.broken=True
+                        return
+                chunks[mate]+=line
+                nlines+=1
+                if nlines<4:
+                    continue
+                #end of a fastq record
+                nlines=0
+                if len(chunks[mate])>=FIFO_CHUNK_BYTES:
+                    if self.broken:
+                        return
+                    self.queues[mate].put(bytes(chunks[mate]))
+                    chunks[mate]=bytearray()
+                mate=(mate+1)%len(chunks)
+            for q,c in zip(self.queues,chunks):
+                if c:
+                    q.put(bytes(c))
+        finally:
+            for q in self.queues:
+                q.put(None)
+    
+    def run(self,cmd,verbose=False,quiet=False,logs=True,objectid="NA"):
+        """Wait for a consumer to open a FIFO, then execute fasterq-dump and stream its output to the FIFOs.
+        If the stream is closed before any FIFO is opened fasterq-dump is not executed.
+        """
+        self.consumer_ready.wait()
+        if self.opened:
+            self.status=pe.execute_command(cmd,verbose=verbose,quiet=quiet,logs=logs,objectid=objectid,command_name="fasterq-dump",stdout_consumer=self.consume)
+        else:
+            self.status=True
+        #release the writers if fasterq-dump was not executed or could not start
+        if not self.consumed:
+            for q in self.queues:
+                q.put(None)
+    
+    def close(self):
+        """Wait for the FIFO writers to exit. Writers still waiting for a reader are released.
+        """
+        self.closing=True
+        #a FIFO never opened by a consumer was not read, unless the consumer opened none and the stream never started
+        if self.opened and len(self.opened)<len(self.fifo_paths):
+            self.broken=True
+        self.consumer_ready.set()
+        while any(w.is_alive() for w in self.writers):
+            #opening the FIFO for reading unblocks a writer waiting for a consumer
+            for p in self.fifo_paths:
+                try:
+                    fd=os.open(p,os.O_RDONLY|os.O_NONBLOCK)
+                    os.close(fd)
+                except OSError:
+                    pass
+            for w in self.writers:
+                w.join(0.1)
 
 
 class SRA:
@@ -29,13 +294,33 @@ class SRA:
             
         scan_path: string
             If RNA-Seq data already exists locally, provide the scan path to scan a directory and create an SRA object.
+        snapshot: DirectorySnapshot
+            cached directory listings used to look for existing files. Share one snapshot when creating many SRA objects.
+        check_dependencies: bool
+            check that prefetch and fasterq-dump are installed. create_sra_objects checks once for all the objects.
+        probe_layout: bool
+            if layout can not be determined from fastq files, run fastq-dump on the .sra file to determine it.
+            If False the layout is left unset; create_sra_objects probes the layouts in parallel.
         
         Attributes
         -----------
         
+        The state of the object is kept in fixed fields (__slots__). Fields that are not known are None.
+        to_dict() and from_dict() convert the object to and from a dict that can be saved as JSON.
         """
-    def __init__(self,srr_accession=None, location=None):
+    __slots__=('_srr_accession','_location','_layout','localSRAFilePath','sraFileSize',
+               'localfastqPath','localfastq1Path','localfastq2Path',
+               'localRawfastqPath','localRawfastq1Path','localRawfastq2Path',
+               'QCObject','fastqStream','streamThread','fifoDir')
+    #fields saved by to_dict
+    FIELDS=('srr_accession','location','layout','localSRAFilePath','sraFileSize',
+            'localfastqPath','localfastq1Path','localfastq2Path',
+            'localRawfastqPath','localRawfastq1Path','localRawfastq2Path')
+    dep_list=SRA_DEPENDENCIES
+    
+    def __init__(self,srr_accession=None, location=None, snapshot=None, check_dependencies=True, probe_layout=True):
         
+        self.init_fields()
         if location is None and srr_accession is None:
             #pu.print_boldred("Please provide a valid srr accession or location, or both")
             raise Exception("Please provide a valid srr accession or location, or both")
@@ -43,10 +328,75 @@ class SRA:
             #self.init_from_path(scan_path)
         #else:
             #use the provided srr_accession
-        self.init_from_accession(srr_accession,location)
+        self.init_from_accession(srr_accession,location,snapshot,check_dependencies,probe_layout)
         
         ##check if sra, fastq files already exists
     
+    def init_fields(self):
+        """Set all fields to None
+        """
+        for name in SRA.__slots__:
+            object.__setattr__(self,name,None)
+    
+    @property
+    def srr_accession(self):
+        return self._srr_accession
+    
+    @srr_accession.setter
+    def srr_accession(self,value):
+        """srr accession can be set only once
+        """
+        if self._srr_accession is not None:
+            raise Exception("Can not modify srr_accession")
+        self._srr_accession=value
+    
+    @property
+    def location(self):
+        return self._location
+    
+    @location.setter
+    def location(self,value):
+        """location can be set only once
+        """
+        if self._location is not None:
+            raise Exception("Can not modify location")
+        self._location=value
+    
+    @property
+    def layout(self):
+        return self._layout
+    
+    @layout.setter
+    def layout(self,value):
+        self._layout=None if value is None else Layout(value)
+    
+    def to_dict(self):
+        """Return the fields of this object as a dict. Streams and QC objects are not included.
+        
+        :return: dict with the fields in SRA.FIELDS; layout is saved as string
+        :rtype: dict
+        """
+        d={name:getattr(self,name) for name in SRA.FIELDS}
+        if d['layout'] is not None:
+            d['layout']=d['layout'].value
+        return d
+    
+    @classmethod
+    def from_dict(cls,d):
+        """Create an SRA object from a dict returned by to_dict().
+        Dependencies are not checked and the disk is not searched for files.
+        
+        :return: SRA object
+        :rtype: SRA
+        """
+        ob=cls.__new__(cls)
+        ob.init_fields()
+        for name in SRA.FIELDS:
+            value=d.get(name)
+            if value is not None:
+                setattr(ob,name,value)
+        return ob
+    
     def init_from_path(self,path):
         if not pu.check_paths_exist(path):
             raise Exception("Please provide a valid path to scan for RNA-Seq data")
@@ -58,13 +408,13 @@ class SRA:
         if not (self.fastqFilesExistsLocally() or self.sraFileExistsLocally()):
                 raise Exception("No files found at:"+ path+ "Please provide a valid path to scan for RNA-Seq data")
     
-    def search_sra(self,path):
+    def search_sra(self,path,snapshot=None):
         """Search .sra file under a dir
         Return True if found otherwise False
         """
         #search files under the path
         
-        sra_files=pe.find_files(path,"*.sra")
+        sra_files=pe.find_files(path,"*.sra",snapshot=snapshot)
         
         if len(sra_files)<1:
             return False
@@ -77,37 +427,34 @@ class SRA:
         self.localSRAFilePath=sra_path
         self.sraFileSize=pu.get_file_size(self.localSRAFilePath)
         #test if file is paired or single end
-        if pe.is_paired(self.localSRAFilePath):
-            self.layout="PAIRED"
-        else:
-            self.layout="SINGLE"
+        self.layout=self.get_sra_layout()
         
         pu.print_green("Found .sra "+self.localSRAFilePath)
         return True
         
-    def search_fastq(self,path):
+    def search_fastq(self,path,snapshot=None):
         """Search .fastq file under a dir and create SRA object
         Return True if found otherwise False
         """
         #search files under the path
-        fq_files=pe.find_files(path,"*.fastq")
+        fq_files=pe.find_files(path,"*.fastq",snapshot=snapshot)
         
         if len(fq_files)<1:
             return False
         
-        if len(fq_files)>2:
+        layout,fq_files=get_fastq_layout(fq_files,self.srr_accession)
+        if layout is None:
             pu.print_boldred("Can not determine .fastq. Exiting...")
             return False
         
-        fq_files.sort()
         #case with single fastq
-        if len(fq_files)==1:
+        if layout=="SINGLE":
             self.localfastqPath=fq_files[0]
             pu.print_green("Found .fastq "+self.localfastqPath)
             self.layout="SINGLE"
         
         #case with paired fastq
-        if len(fq_files)==2:
+        if layout=="PAIRED":
             self.localfastq1Path=fq_files[0]
             self.localfastq2Path=fq_files[1]
             pu.print_green("Found .fastq "+self.localfastq1Path+" "+self.localfastq2Path)
@@ -118,11 +465,10 @@ class SRA:
         return True
         
     
-    def init_from_accession(self,srr_accession,location):
+    def init_from_accession(self,srr_accession,location,snapshot=None,check_dependencies=True,probe_layout=True):
         """Create SRA object using provided srr accession and location to save the data
         """
-        self.dep_list=['prefetch',"fasterq-dump"]
-        if not pe.check_dependencies(self.dep_list):
+        if check_dependencies and not pe.check_dependencies(self.dep_list):
             raise Exception("ERROR: Please install missing programs.")
         
         if srr_accession is None:
@@ -141,33 +487,22 @@ class SRA:
         #self.search_sra(self.location)
         
         
+        #check fastq file; layout is determined from the fastq names and headers
+        self.search_fastq(self.location,snapshot)
+        
         #check SRA file
-        if pu.check_files_exist(os.path.join(self.location,self.srr_accession+".sra")):
+        sra_path=os.path.join(self.location,self.srr_accession+".sra")
+        if snapshot is not None:
+            sra_exists=snapshot.is_file(sra_path)
+        else:
+            sra_exists=pu.check_files_exist(sra_path)
+        if sra_exists:
             pu.print_green(self.srr_accession+".sra exists.")
             self.localSRAFilePath=os.path.join(self.location,self.srr_accession+".sra")
             self.sraFileSize=pu.get_file_size(self.localSRAFilePath)
             #test if file is paired or single end
-            if pe.is_paired(self.localSRAFilePath):
-                self.layout="PAIRED"
-            else:
-                self.layout="SINGLE"
-        
-        #check fastq file
-        self.search_fastq(self.location)
-        
-        
-        
-        
-    def __setattr__(self, name, value):
-        """Make srr accession immutable
-        """
-        immutableFields=['srr_accession','location']
-        
-        if (name in immutableFields and name in self.__dict__):
-            raise Exception("Can not modify "+name)
-        else:
-            self.__dict__[name] = value
-                
+            if probe_layout and self.layout is None:
+                self.layout=self.get_sra_layout()
     
     def download_fastq(self,verbose=False,quiet=False,logs=True,procs=2,**kwargs):
         """Function to download fastq files
@@ -196,18 +531,16 @@ class SRA:
             fstrqd_Cmd.append(self.srr_accession)
         
         #execute command
-        cmdStatus=pe.execute_command(fstrqd_Cmd,objectid=self.srr_accession)
+        cmdStatus=pe.execute_command(fstrqd_Cmd,verbose=verbose,quiet=quiet,logs=logs,objectid=self.srr_accession)
         if not cmdStatus:
             print("fasterqdump failed for:"+self.srr_accession)
             return False        
         
         
-        if not hasattr(self,'layout'):
+        if self.layout is None:
             fq_files=pe.find_files(self.location,self.srr_accession+"*.fastq")
-            if len(fq_files)==1:
-                self.layout='SINGLE'
-            else:
-                self.layout='PAIRED'
+            layout,fq_files=get_fastq_layout(fq_files,self.srr_accession)
+            self.layout=layout if layout else 'PAIRED'
         
         #check if fastq files are downloaded        
         if(self.layout=="SINGLE"):
@@ -262,10 +595,7 @@ class SRA:
             #save file .sra file size
             self.sraFileSize=pu.get_file_size(self.localSRAFilePath)
             #test if file is paired or single end
-            if pe.is_paired(self.localSRAFilePath):
-                self.layout="PAIRED"
-            else:
-                self.layout="SINGLE"
+            self.layout=self.get_sra_layout()
             return True
             
         
@@ -291,7 +621,7 @@ class SRA:
         prefetch_Cmd.extend(['-O',self.location])
         prefetch_Cmd.append(self.srr_accession)
                 
-        cmdStatus=pe.execute_command(prefetch_Cmd,objectid=self.srr_accession)
+        cmdStatus=pe.execute_command(prefetch_Cmd,verbose=verbose,quiet=quiet,logs=logs,objectid=self.srr_accession)
         if not cmdStatus:
             pu.print_boldred("prefetch failed for:"+self.srr_accession)
             return False
@@ -306,52 +636,158 @@ class SRA:
         #save file .sra file size
         self.sraFileSize=pu.get_file_size(self.localSRAFilePath)
         #test if file is paired or single end
+        self.layout=self.get_sra_layout()
+        
+        return True
+    
+    def get_sra_layout(self):
+        """Return layout of the .sra file, SINGLE or PAIRED. 
+        The layout is saved in <accession>.metadata.json next to the .sra file and fastq-dump is run only
+        if the .sra file changed since the layout was saved.
+        
+        :return: layout
+        :rtype: string
+        """
+        metadata_path=get_metadata_path(os.path.dirname(self.localSRAFilePath),self.srr_accession)
+        metadata=read_metadata(metadata_path)
+        fingerprint=pe.get_fingerprint(self.localSRAFilePath)
+        if metadata.get('layout') and metadata.get('sra_fingerprint')==fingerprint:
+            return metadata['layout']
         if pe.is_paired(self.localSRAFilePath):
-            self.layout="PAIRED"
+            layout="PAIRED"
         else:
-            self.layout="SINGLE"
-            
+            layout="SINGLE"
+        metadata.update({'accession':self.srr_accession,'layout':layout,'sra_fingerprint':fingerprint})
+        write_metadata(metadata_path,metadata)
+        return layout
+    
+    
+           
+    
+    def stream_fastq(self,layout=None,verbose=False,quiet=False,logs=True,**kwargs):
+        """Start fasterq-dump in the background and make its reads available through named pipes (FIFOs).
+        localfastqPath or localfastq1Path and localfastq2Path point to the FIFOs so that perform_qc() 
+        or perform_alignment() can read the fastq while fasterq-dump produces it. No fastq file is written to disk.
+        The consumer must read each fastq file exactly once (e.g. trim_galore --fastqc can not be used).
+        perform_qc() and perform_alignment() call close_stream() when they finish; otherwise call it explicitly.
+        fasterq-dump starts when the consumer opens a FIFO, so it is not run if the consumer is skipped because its
+        outputs are up to date.
+        
+        Parameters
+        ----------
+        
+        layout: string
+            PAIRED or SINGLE. Required if the layout is not known i.e. the .sra file was not downloaded.
+        verbose: bool
+            Print stdout and std error
+        quiet: bool
+            Print nothing
+        logs: bool
+            Log this command to pyrpipe logs
+        kwargs: dict
+            A dict containing fasterq-dump arguments
+        
+        :return: Return True if the stream was started
+        :rtype: bool
+        """
+        if self.fastqFilesExistsLocally():
+            pu.print_green("Fastq files exist already")
+            return True
+        if self.is_streaming():
+            pu.print_boldred("Fastq is already being streamed for "+self.srr_accession)
+            return False
+        if layout:
+            self.layout=layout
+        if self.layout is None:
+            pu.print_boldred("Layout of "+self.srr_accession+" is unknown. Please run download_sra() or provide the layout.")
+            return False
         
+        fasterqdumpArgsList=['-t','-N','-X','-a','-p','-c','-h','-V',
+                             '-L','-v','-q','-b','-m','-e','-x','-M',
+                             '-B','--option-file','--strict','--table','--include-technical',
+                             '--skip-technical']
+        fstrqd_Cmd=['fasterq-dump']
+        fstrqd_Cmd.extend(pu.parse_unix_args(fasterqdumpArgsList,kwargs))
+        #write each read of a spot as a separate record to stdout
+        fstrqd_Cmd.extend(['--stdout','--split-spot'])
+        if self.sraFileExistsLocally():
+            fstrqd_Cmd.append(self.localSRAFilePath)
+        else:
+            fstrqd_Cmd.append(self.srr_accession)
+        
+        #create FIFOs named as the fastq files fasterq-dump would write.
+        #the paths are fixed so that checkpoints of the consumers match across runs
+        if not pu.check_paths_exist(self.location):
+            pu.mkdir(self.location)
+        self.fifoDir=os.path.join(self.location,"fifo")
+        #FIFOs left by an interrupted run
+        shutil.rmtree(self.fifoDir,ignore_errors=True)
+        os.mkdir(self.fifoDir)
+        if self.layout=='PAIRED':
+            self.localfastq1Path=os.path.join(self.fifoDir,self.srr_accession+"_1.fastq")
+            self.localfastq2Path=os.path.join(self.fifoDir,self.srr_accession+"_2.fastq")
+            fifo_paths=[self.localfastq1Path,self.localfastq2Path]
+        else:
+            self.localfastqPath=os.path.join(self.fifoDir,self.srr_accession+".fastq")
+            fifo_paths=[self.localfastqPath]
+        for p in fifo_paths:
+            os.mkfifo(p)
+        
+        self.fastqStream=FastqStream(fifo_paths)
+        self.streamThread=threading.Thread(target=self.fastqStream.run,args=(fstrqd_Cmd,verbose,quiet,logs,self.srr_accession),daemon=True)
+        self.streamThread.start()
         return True
     
+    def is_streaming(self):
+        """Function to check if fastq is being streamed through FIFOs
+        """
+        return self.fastqStream is not None
     
-           
+    def close_stream(self):
+        """Wait for fasterq-dump to finish and remove the FIFOs created by stream_fastq()
+        
+        :return: Return True if fasterq-dump succeeded and all reads were consumed
+        :rtype: bool
+        """
+        if not self.is_streaming():
+            return True
+        self.fastqStream.close()
+        self.streamThread.join()
+        status=self.fastqStream.status and not self.fastqStream.broken
+        shutil.rmtree(self.fifoDir,ignore_errors=True)
+        if self.layout=='PAIRED':
+            self.localfastq1Path=None
+            self.localfastq2Path=None
+        else:
+            self.localfastqPath=None
+        self.fastqStream=None
+        self.streamThread=None
+        self.fifoDir=None
+        if not status:
+            pu.print_boldred("Streaming fastq failed for:"+self.srr_accession)
+        return status
     
     def sraFileExistsLocally(self):
         """Function to check if sra file is present on disk
         """
-        if hasattr(self,'localSRAFilePath'):
-            return(os.path.isfile(self.localSRAFilePath))
-        else:
+        if self.localSRAFilePath is None:
             return False
+        return os.path.isfile(self.localSRAFilePath)
         
     def fastqFilesExistsLocally(self):
         """Function to check if fastq file is present on disk
         """
-        
-        if not hasattr(self,'layout'):
+        if self.layout is None or self.is_streaming():
             return False
         
         if self.layout=='PAIRED':
-            if hasattr(self,'localfastq1Path'):
-                if not pu.check_files_exist(self.localfastq1Path):
-                    return False
-            else:
-                return False
-            
-            if hasattr(self,'localfastq2Path'):
-                if not pu.check_files_exist(self.localfastq2Path):
-                    return False
-            else:
-                return False
-            
-            return True
-            
-        else:
-            if hasattr(self,'localfastqPath'):
-                return pu.check_files_exist(self.localfastqPath)
-            else:            
+            if self.localfastq1Path is None or self.localfastq2Path is None:
                 return False
+            return os.path.isfile(self.localfastq1Path) and os.path.isfile(self.localfastq2Path)
+        
+        if self.localfastqPath is None:
+            return False
+        return os.path.isfile(self.localfastqPath)
     
     def run_fasterqdump(self,delete_sra=False,verbose=False,quiet=False,logs=True,**kwargs):
         """Execute fasterq-dump to convert .sra file to fastq files.
@@ -420,7 +856,7 @@ class SRA:
         fstrqd_Cmd.append(self.localSRAFilePath)
         
         #execute command
-        cmdStatus=pe.execute_command(fstrqd_Cmd,objectid=self.srr_accession)
+        cmdStatus=pe.execute_command(fstrqd_Cmd,verbose=verbose,quiet=quiet,logs=logs,objectid=self.srr_accession)
         if not cmdStatus:
             print("fasterqdump failed for:"+self.srr_accession)
             return False
@@ -455,6 +891,7 @@ class SRA:
         By default the trimmed/qc fastq files will be generated in the same directory as the original fastq files.
         After QC, this SRA object will update the localfastqPath or localfastq1Path and localfastq2Path variables to store the new fastq files.
         New variables localRawfastqPath or localRawfastq1Path and localRawfastq2Path will be created to store the paths of original fastq files.
+        If the fastq was streamed (see stream_fastq()), these are the paths of the FIFOs, which are removed after QC.
       
         Parameters
         ----------
@@ -484,6 +921,17 @@ class SRA:
         #each qcObject has a function run() to execute their method
         qcStatus=qcObject.perform_qc(self,objectid=self.srr_accession)
         
+        #streamed raw reads were never written to disk
+        streaming=self.is_streaming()
+        if streaming:
+            #paths of the raw reads as read by the qc program; close_stream() removes the FIFOs
+            if self.layout=='PAIRED':
+                streamedPaths=(self.localfastq1Path,self.localfastq2Path)
+            else:
+                streamedPaths=(self.localfastqPath,)
+            if not self.close_stream():
+                qcStatus=("",)
+        
         #if job failed
         if not qcStatus[0]:
             print ("Error performing QC for "+self.srr_accession)
@@ -492,7 +940,10 @@ class SRA:
         if self.layout=='PAIRED':
             
             #delete old fastq files if specified
-            if deleteRawFastq:
+            if streaming:
+                if not deleteRawFastq:
+                    self.localRawfastq1Path,self.localRawfastq2Path=streamedPaths
+            elif deleteRawFastq:
                 self.delete_fastq()
             
             else:
@@ -504,7 +955,10 @@ class SRA:
             self.localfastq1Path=qcStatus[0]    
             self.localfastq2Path=qcStatus[1]
         else:
-            if deleteRawFastq:
+            if streaming:
+                if not deleteRawFastq:
+                    self.localRawfastqPath=streamedPaths[0]
+            elif deleteRawFastq:
                 self.delete_fastq()
             else:
                 self.localRawfastqPath=self.localfastqPath
@@ -521,12 +975,12 @@ class SRA:
         """
         if self.layout=='PAIRED':
             if pe.deleteMultipleFilesFromDisk(self.localfastq1Path,self.localfastq2Path):
-                del self.localfastq1Path
-                del self.localfastq2Path
+                self.localfastq1Path=None
+                self.localfastq2Path=None
                 return True
         else:
             if pe.deleteFileFromDisk(self.localfastqPath):
-                del self.localfastqPath
+                self.localfastqPath=None
                 return True
         return False
         
@@ -535,9 +989,289 @@ class SRA:
         """Delete the downloaded SRA files.
         """
         if(pe.deleteFileFromDisk(self.localSRAFilePath)):
-            del self.localSRAFilePath
+            self.localSRAFilePath=None
             return True
         return False
     
     
     
+
+
+
+class BatchDownloader:
+    """Download and convert many SRA accessions.
+    Downloads (prefetch) and conversions to fastq (fasterq-dump) are throttled separately so that
+    network bound downloads of some accessions overlap with CPU bound conversion of others.
+    Failed downloads and conversions are retried with exponential backoff.
+    
+    Parameters
+    ----------
+    
+    accessions: list
+        SRR accessions
+    location: string
+        directory to save the data. Data of each accession is saved in location/<accession>
+    max_downloads: int
+        max number of prefetch commands running at the same time
+    max_conversions: int
+        max number of fasterq-dump commands running at the same time. None to only download .sra files.
+    fasterqdump_threads: int
+        threads used by each fasterq-dump
+    retries: int
+        number of times a failed prefetch or fasterq-dump is retried
+    backoff: float
+        seconds to wait before the first retry. The wait is doubled for each further retry.
+    delete_sra: bool
+        delete the .sra file after conversion to fastq
+    progress: function
+        called with (accession, status) whenever the status of an accession changes
+    
+    Examples
+    --------
+    >>> bd=BatchDownloader(srr_list,workingDir,max_downloads=8,max_conversions=4)
+    >>> sra_objects=bd.run()
+    """
+    def __init__(self,accessions,location=None,max_downloads=4,max_conversions=2,fasterqdump_threads=2,retries=3,backoff=10,delete_sra=False,progress=None,verbose=False,quiet=True,logs=True):
+        self.accessions=list(dict.fromkeys(accessions))
+        if location is None:
+            location=os.getcwd()
+        self.location=location
+        self.max_downloads=max(1,max_downloads)
+        self.max_conversions=max_conversions
+        self.fasterqdump_threads=fasterqdump_threads
+        self.retries=retries
+        self.backoff=backoff
+        self.delete_sra=delete_sra
+        self.progress=progress
+        self.verbose=verbose
+        self.quiet=quiet
+        self.logs=logs
+        #status of each accession: queued, downloading, downloaded, converting, done or failed
+        self.status={a:"queued" for a in self.accessions}
+        self.lock=threading.Lock()
+    
+    def set_status(self,accession,status,attempt=0):
+        with self.lock:
+            self.status[accession]=status
+            finished=sum(1 for v in self.status.values() if v in ("done","failed"))
+        message="[{}/{}] {} {}".format(finished,len(self.accessions),accession,status)
+        if attempt>0:
+            message+=" (retry {})".format(attempt)
+        if status=="failed":
+            pu.print_boldred(message)
+        elif status=="done":
+            pu.print_green(message)
+        else:
+            pu.print_info(message)
+        if self.progress:
+            self.progress(accession,status)
+    
+    def retry(self,accession,status,function,**kwargs):
+        """Call function until it returns True, at most retries+1 times
+        
+        :return: True if function succeeded
+        :rtype: bool
+        """
+        for attempt in range(self.retries+1):
+            if attempt>0:
+                time.sleep(self.backoff*2**(attempt-1))
+            self.set_status(accession,status,attempt)
+            try:
+                if function(verbose=self.verbose,quiet=self.quiet,logs=self.logs,**kwargs):
+                    return True
+            except Exception as e:
+                pu.print_boldred("{} failed for {}: {}".format(status,accession,str(e)))
+        return False
+    
+    def download(self,accession,convert_pool,conversions):
+        try:
+            sra_ob=SRA(accession,self.location)
+        except Exception as e:
+            pu.print_boldred("Failed to create SRA object for {}: {}".format(accession,str(e)))
+            self.set_status(accession,"failed")
+            return None
+        if not self.retry(accession,"downloading",sra_ob.download_sra):
+            self.set_status(accession,"failed")
+            return None
+        if convert_pool is None:
+            self.set_status(accession,"done")
+            return sra_ob
+        self.set_status(accession,"downloaded")
+        with self.lock:
+            conversions[accession]=convert_pool.submit(pe.bind_job_context(self.convert),accession,sra_ob)
+        return sra_ob
+    
+    def convert(self,accession,sra_ob):
+        if not self.retry(accession,"converting",sra_ob.run_fasterqdump,delete_sra=self.delete_sra,**{'-e':str(self.fasterqdump_threads)}):
+            self.set_status(accession,"failed")
+            return None
+        self.set_status(accession,"done")
+        return sra_ob
+    
+    def run(self):
+        """Download (and convert) all the accessions
+        
+        :return: dict with accessions as keys and SRA objects as values; None for failed accessions
+        :rtype: dict
+        """
+        conversions={}
+        results={}
+        convert_pool=None
+        if self.max_conversions:
+            convert_pool=ThreadPoolExecutor(max_workers=self.max_conversions)
+        try:
+            with ThreadPoolExecutor(max_workers=self.max_downloads) as download_pool:
+                download=pe.bind_job_context(self.download)
+                downloads={a:download_pool.submit(download,a,convert_pool,conversions) for a in self.accessions}
+            for a in self.accessions:
+                results[a]=downloads[a].result()
+                if a in conversions:
+                    results[a]=conversions[a].result()
+        finally:
+            if convert_pool is not None:
+                convert_pool.shutdown()
+        return results
+
+
+def read_accessions(accession_file):
+    """Read run accessions from a table, e.g. SraRunTable.txt or an ENA report.
+    The table may be tab or comma separated. If it has a header, the column named Run, run_accession or
+    Accession is used, otherwise the first column. Blank lines and lines starting with # are skipped.
+    
+    :return: list of accessions, in the order of the table
+    :rtype: list
+    """
+    accessions=[]
+    column=None
+    with open(accession_file) as f:
+        for line in f:
+            line=line.strip()
+            if not line or line.startswith("#"):
+                continue
+            delimiter="\t" if "\t" in line else ","
+            fields=[v.strip().strip('"') for v in line.split(delimiter)]
+            if column is None:
+                header=[v.lower() for v in fields]
+                column=0
+                if not any(ACCESSION_RE.fullmatch(v) for v in fields):
+                    #header line
+                    for name in ACCESSION_COLUMNS:
+                        if name in header:
+                            column=header.index(name)
+                            break
+                    continue
+            if column<len(fields) and fields[column]:
+                accessions.append(fields[column])
+    return accessions
+
+def find_accessions(location,snapshot=None):
+    """Find accessions with data under location, i.e. directories location/<accession> containing
+    <accession>.sra or fastq files
+    
+    :return: sorted list of accessions
+    :rtype: list
+    """
+    if snapshot is None:
+        snapshot=pe.DirectorySnapshot(location)
+    entries=snapshot.listdir(location)
+    if not entries:
+        return []
+    accessions=[]
+    for name,kind in sorted(entries.items()):
+        if kind!='d':
+            continue
+        files=snapshot.listdir(os.path.join(location,name)) or {}
+        if name+".sra" in files or any(f.endswith(".fastq") for f in files):
+            accessions.append(name)
+    return accessions
+
+def create_sra_objects(accessions=None,location=None,threads=4):
+    """Create SRA objects for many accessions.
+    Dependencies are checked once, location is read once into a shared DirectorySnapshot and
+    layouts that can not be determined from fastq files are probed in parallel.
+    
+    Parameters
+    ----------
+    
+    accessions: list or string
+        list of accessions or path to a table of accessions (see read_accessions). 
+        If None, all accessions with data under location are used (see find_accessions).
+    location: string
+        directory containing data of each accession in location/<accession>. Default is the current directory.
+    threads: int
+        number of layout probes to run in parallel
+    
+    :return: dict with accessions as keys and SRA objects as values; None if the object could not be created
+    :rtype: dict
+    
+    Examples
+    --------
+    >>> sra_objects=create_sra_objects("SraRunTable.txt",workingDir)
+    """
+    if not pe.check_dependencies(SRA_DEPENDENCIES):
+        raise Exception("ERROR: Please install missing programs.")
+    if location is None:
+        location=os.getcwd()
+    snapshot=pe.DirectorySnapshot(location)
+    if accessions is None:
+        accessions=find_accessions(location,snapshot)
+    elif isinstance(accessions,str):
+        accessions=read_accessions(accessions)
+    
+    sra_objects={}
+    for accession in dict.fromkeys(accessions):
+        try:
+            sra_objects[accession]=SRA(accession,location,snapshot=snapshot,check_dependencies=False,probe_layout=False)
+        except Exception as e:
+            pu.print_boldred("Failed to create SRA object for {}: {}".format(accession,str(e)))
+            sra_objects[accession]=None
+    
+    #.sra files without fastq
+    to_probe=[ob for ob in sra_objects.values() if ob is not None and ob.layout is None and ob.localSRAFilePath is not None]
+    if to_probe:
+        with ThreadPoolExecutor(max_workers=max(1,threads)) as pool:
+            for ob,layout in zip(to_probe,pool.map(pe.bind_job_context(lambda ob: ob.get_sra_layout()),to_probe)):
+                ob.layout=layout
+    return sra_objects
+
+def save_sra_objects(sra_objects,out_file):
+    """Save SRA objects to a file, one JSON record (see SRA.to_dict) per line.
+    
+    Parameters
+    ----------
+    
+    sra_objects: list or dict
+        SRA objects, or dict with SRA objects as values e.g. returned by create_sra_objects. None values are skipped.
+    out_file: string
+        path to the output file. The file is replaced atomically.
+    
+    :return: True if saved
+    :rtype: bool
+    """
+    if isinstance(sra_objects,dict):
+        sra_objects=sra_objects.values()
+    try:
+        fd,temp_path=tempfile.mkstemp(prefix=".sra_objects_",dir=os.path.dirname(os.path.abspath(out_file)))
+        with os.fdopen(fd,'w') as f:
+            for ob in sra_objects:
+                if ob is not None:
+                    f.write(json.dumps(ob.to_dict())+"\n")
+        os.replace(temp_path,out_file)
+        return True
+    except OSError as e:
+        pu.print_boldred("Failed to save SRA objects to {}: {}".format(out_file,str(e)))
+        return False
+
+def load_sra_objects(in_file):
+    """Load SRA objects saved by save_sra_objects
+    
+    :return: dict with accessions as keys and SRA objects as values
+    :rtype: dict
+    """
+    sra_objects={}
+    with open(in_file) as f:
+        for line in f:
+            if line.strip():
+                ob=SRA.from_dict(json.loads(line))
+                sra_objects[ob.srr_accession]=ob
+    return sra_objects
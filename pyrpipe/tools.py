@@ -8,6 +8,143 @@ Created on Wed Dec  4 14:54:22 2019
 from pyrpipe import pyrpipe_utils as pu
 from pyrpipe import pyrpipe_engine as pe
 import os
+import threading
+import uuid
+
+#fraction of the available memory used by samtools sort, shared by its threads
+SORT_MEMORY_FRACTION=0.5
+#fraction of the threads of an aligner | samtools sort pipeline given to sort; sort is mostly idle until the aligner finishes
+SORT_THREAD_FRACTION=0.25
+#limits of the memory per sort thread in MB. samtools uses 768M by default
+SORT_MIN_MEMORY_MB=64
+SORT_MAX_MEMORY_MB=4096
+
+scratch_dir_path=None
+#number of samtools sort commands running in this process; they share SORT_MEMORY_FRACTION of the memory
+active_sorts=0
+active_sorts_lock=threading.Lock()
+
+
+def set_scratch_dir(scratch_dir):
+    """Set the directory where samtools sort writes its temporary files.
+    
+    Parameters
+    ----------
+    
+    scratch_dir: str
+        path to a fast local disk. None to use $PYRPIPE_SCRATCH_DIR or, if not set, the directory of the output.
+    """
+    global scratch_dir_path
+    scratch_dir_path=scratch_dir
+
+def get_scratch_dir():
+    """Return the directory for temporary files of samtools sort
+    
+    The directory is created if it does not exist.
+
+    :return: path or None to write temporary files next to the output
+    :rtype: string
+    """
+    scratch_dir=scratch_dir_path or os.environ.get('PYRPIPE_SCRATCH_DIR')
+    if not scratch_dir:
+        return None
+    if not pu.check_paths_exist(scratch_dir):
+        pu.mkdir(scratch_dir)
+    return scratch_dir
+
+def start_sort():
+    """Count a samtools sort as running. Call end_sort() when it finishes.
+    """
+    global active_sorts
+    with active_sorts_lock:
+        active_sorts+=1
+
+def end_sort():
+    """Count a samtools sort started with start_sort() as finished.
+    """
+    global active_sorts
+    with active_sorts_lock:
+        active_sorts=max(0,active_sorts-1)
+
+def split_pipeline_threads(threads):
+    """Split the threads granted to an aligner | samtools sort pipeline between the aligner and samtools sort -@.
+    sort gets SORT_THREAD_FRACTION of the threads; with few threads it gets none (no -@) and sorts in its main thread.
+    
+    :return: threads of the aligner and of samtools sort
+    :rtype: tuple
+    """
+    sort_threads=int(threads*SORT_THREAD_FRACTION)
+    return max(1,threads-sort_threads),sort_threads
+
+def get_sort_memory(threads,available=None,sorts=None):
+    """Return the memory per thread for samtools sort -m. samtools uses up to -m for each thread, so the memory is
+    divided among the threads and the sorts running at the same time; together they use SORT_MEMORY_FRACTION of the available memory.
+    
+    Parameters
+    ----------
+    
+    threads: int
+        number of sort threads
+    available: int
+        available memory in bytes. Default: pu.get_available_memory()
+    sorts: int
+        number of sorts sharing the memory. Default: sorts counted by start_sort(), at least 1
+    
+    :return: memory per thread e.g. 1024M
+    :rtype: string
+    """
+    if available is None:
+        available=pu.get_available_memory()
+    if not available:
+        #let samtools use its default
+        return ""
+    if sorts is None:
+        sorts=active_sorts
+    memory_mb=int(available*SORT_MEMORY_FRACTION/max(1,threads)/max(1,sorts)/(1024*1024))
+    return str(max(SORT_MIN_MEMORY_MB,min(SORT_MAX_MEMORY_MB,memory_mb)))+"M"
+
+def get_sort_cmds(in_file,out_bam,view_args=None,sort_args=None,threads=None,memory_per_thread=None,scratch_dir=None):
+    """Return the commands to sort in_file into out_bam in one pass.
+    If view_args is given the input is streamed through samtools view -u (uncompressed BAM) into samtools sort,
+    so view parses the input while sort sorts and compresses. Else in_file is sorted directly.
+    The options set by threads, memory_per_thread and scratch_dir change the speed of the sort but not its output;
+    the commands without them can be used as checkpoint.
+    
+    Parameters
+    ----------
+    
+    in_file: string
+        SAM/BAM file or - to read stdin
+    out_bam: string
+        path to the sorted bam file
+    view_args: list
+        options for samtools view e.g. ['-q','10']. None to sort in_file without samtools view.
+    sort_args: list
+        other options for samtools sort
+    threads: int
+        samtools sort -@
+    memory_per_thread: string
+        samtools sort -m
+    scratch_dir: string
+        directory of the temporary files of samtools sort (-T). Not used if sort_args has -T.
+    
+    :return: list of commands
+    :rtype: list
+    """
+    sort_cmd=['samtools','sort']
+    if threads:
+        sort_cmd.extend(['-@',str(threads)])
+    if memory_per_thread:
+        sort_cmd.extend(['-m',memory_per_thread])
+    if scratch_dir and '-T' not in (sort_args or []):
+        #unique prefix so that concurrent sorts do not share temporary files
+        prefix=os.path.basename(out_bam)+"."+uuid.uuid4().hex[:8]
+        sort_cmd.extend(['-T',os.path.join(scratch_dir,prefix)])
+    sort_cmd.extend((sort_args or [])+['-o',out_bam])
+    if view_args is None:
+        return [sort_cmd+[in_file]]
+    view_cmd=['samtools','view','-u']+view_args+[in_file]
+    return [view_cmd,sort_cmd+['-']]
 
 class RNASeqTools:
     def __init__(self):
@@ -25,6 +162,8 @@ class Samtools(RNASeqTools):
                             '-R','-q','-l','-m','-f','-F','-G','-s','-M','-x','-B','-?','-S','-O','-T','-@']
         
         self.passedArgumentDict=kwargs
+        #flags setting the number of threads of each sub_command; threads are taken from the thread budget if not set
+        self.thread_args={c:['-@','--threads'] for c in ['view','sort','merge','index','fixmate','markdup','fastq','fasta']}
         
         
         
@@ -86,8 +225,9 @@ class Samtools(RNASeqTools):
         
         
     #sort bam file.output will be bam_file_sorted.bam
-    def sort_bam(self,bam_file,out_dir="",out_suffix="",delete_bam=False,verbose=False,quiet=False,logs=True,objectid="NA",**kwargs):
+    def sort_bam(self,bam_file,out_dir="",out_suffix="",delete_bam=False,verbose=False,quiet=False,logs=True,objectid="NA",index=False,**kwargs):
         """Sorts an input bam file. Outpufile will end in _sorted.bam
+        Threads, memory per thread and temporary files of samtools sort are set as in sort_to_bam.
         
         verbose: bool
             Print stdout and std error
@@ -97,46 +237,167 @@ class Samtools(RNASeqTools):
             Log this command to pyrpipe logs
         objectid: str
             Provide an id to attach with this command e.g. the SRR accession. This is useful for debugging, benchmarking and reports.
+        index: bool
+            index the sorted bam file
         kwargs: dict
-            Options to pass to samtools. This will override the existing options 
+            Options to pass to samtools sort. This will override the existing options 
 
         :return: Returns path to the sorted bam file. Returns empty string if operation failed.
         :rtype: string
         
+        """
+        outSortedbam_file=self.sort_to_bam(bam_file,out_dir,out_suffix+'_sorted',index=index,delete_input=delete_bam,
+                                           verbose=verbose,quiet=quiet,logs=logs,objectid=objectid,**kwargs)
+        if not outSortedbam_file:
+            print("Bam sort failed for:"+bam_file)
+        return outSortedbam_file
+    
+    def sam_sorted_bam(self,sam_file,out_dir="",out_suffix="",delete_sam=False,delete_bam=True,verbose=False,quiet=False,logs=True,objectid="NA",index=False,**kwargs):
+        """Convert sam file to bam and sort the bam file.
+        By default the sam file is streamed through samtools view into samtools sort and no unsorted bam is written.
+        
+        delete_sam: bool
+            delete the sam file after conversion
+        delete_bam: bool
+            If False, the unsorted bam file is written next to the sam file and kept, and then sorted.
+        verbose: bool
+            Print stdout and std error
+        quiet: bool
+            Print nothing
+        logs: bool
+            Log this command to pyrpipe logs
+        objectid: str
+            Provide an id to attach with this command e.g. the SRR accession. This is useful for debugging, benchmarking and reports.
+        index: bool
+            index the sorted bam file
+        kwargs: dict
+            Options to pass to samtools sort. This will override the existing options 
+
+        :return: Returns path to the sorted bam file. Returns empty string if operation failed.
+        :rtype: string
+        """
+        
+        if not delete_bam:
+            sam2bam_file=self.sam_to_bam(sam_file,delete_sam=delete_sam,verbose=verbose,quiet=quiet,logs=logs,objectid=objectid)
+            if not sam2bam_file:
+                return ""
+            return self.sort_bam(sam2bam_file,out_dir,out_suffix,delete_bam=False,verbose=verbose,quiet=quiet,logs=logs,objectid=objectid,index=index,**kwargs)
+        
+        return self.sort_to_bam(sam_file,out_dir,out_suffix+'_sorted',view_args={},index=index,delete_input=delete_sam,
+                                verbose=verbose,quiet=quiet,logs=logs,objectid=objectid,**kwargs)
+    
+    def sort_to_bam(self,in_file,out_dir="",out_suffix="_sorted",view_args=None,index=True,threads=None,memory_per_thread=None,scratch_dir=None,
+                    delete_input=False,verbose=False,quiet=False,logs=True,objectid="NA",force=False,**kwargs):
+        """Sort a sam or bam file into a bam file in one pass and index the sorted bam.
+        If view_args is given, the input is streamed through samtools view into samtools sort.
+        Sorting is skipped if the output is up to date with in_file (see pyrpipe_engine.set_checkpoint_file).
+        
+        Parameters
+        ----------
+        
+        in_file: string
+            path to the sam or bam file
+        out_dir: string
+            directory of the output. Default: directory of in_file
+        out_suffix: string
+            output is out_dir/<in_file name><out_suffix>.bam
+        view_args: dict
+            options to pass to samtools view e.g. {"-q":"10"}. Use {} to stream the input through samtools view without options.
+            If None, in_file is sorted directly.
+        index: bool
+            index the sorted bam file
+        threads: int
+            threads of samtools sort and index. Default: taken from the thread budget (see pyrpipe_engine.ThreadBudget)
+        memory_per_thread: string
+            memory per thread of samtools sort e.g. 2G. Default: SORT_MEMORY_FRACTION of the available memory divided among the threads
+            and the sorts running at the same time (see get_sort_memory)
+        scratch_dir: string
+            directory for temporary files of samtools sort. Default: get_scratch_dir(). Not used if -T is passed in kwargs.
+        delete_input: bool
+            delete in_file after sorting
+        verbose: bool
+            Print stdout and std error
+        quiet: bool
+            Print nothing
+        logs: bool
+            Log this command to pyrpipe logs
+        objectid: str
+            Provide an id to attach with this command e.g. the SRR accession. This is useful for debugging, benchmarking and reports.
+        force: bool
+            sort even if the output is up to date
+        kwargs: dict
+            Options to pass to samtools sort. This will override the existing options 
+
+        :return: Returns path to the sorted bam file. Returns empty string if operation failed.
+        :rtype: string
         """
         if not out_dir:
-            out_dir=pu.get_file_directory(bam_file)
+            out_dir=pu.get_file_directory(in_file)
         else:
             if not pu.check_paths_exist(out_dir):
                 pu.mkdir(out_dir)
-                
-        fname=pu.get_file_basename(bam_file)
-        #output will be out_bam
-        outSortedbam_file=os.path.join(out_dir,fname+out_suffix+'_sorted.bam')
-        
-        newOpts={"--":(bam_file,),"-o":outSortedbam_file}
-        mergedOpts={**kwargs,**newOpts}
+        out_bam=os.path.join(out_dir,pu.get_file_basename(in_file)+out_suffix+'.bam')
         
-        status=self.run_samtools("sort",verbose=verbose,quiet=quiet,logs=logs,objectid=objectid,**mergedOpts)
+        mergedArgsDict={**self.passedArgumentDict,**kwargs}
+        #options set by the user override the automatic settings
+        if threads is None and '-@' in mergedArgsDict:
+            threads=int(mergedArgsDict.pop('-@'))
+        if memory_per_thread is None and '-m' in mergedArgsDict:
+            memory_per_thread=mergedArgsDict.pop('-m')
+        if '-T' in mergedArgsDict:
+            scratch_dir=None
+        elif scratch_dir is None:
+            scratch_dir=get_scratch_dir()
+        elif not pu.check_paths_exist(scratch_dir):
+            pu.mkdir(scratch_dir)
+        for k in ['-@','-m','-o','--']:
+            mergedArgsDict.pop(k,None)
+        sort_args=pu.parse_unix_args(self.valid_args,mergedArgsDict)
+        if view_args is not None:
+            view_args=pu.parse_unix_args(self.valid_args,view_args)
+        
+        granted=0
+        if threads is None:
+            threads,granted=pe.acquire_threads([],['-@'])
+        start_sort()
+        try:
+            if memory_per_thread is None:
+                memory_per_thread=get_sort_memory(threads)
+            cmds=get_sort_cmds(in_file,out_bam,view_args,sort_args,threads,memory_per_thread,scratch_dir)
+            #threads, memory and temporary files do not change the output
+            checkpoint=" | ".join([" ".join(c) for c in get_sort_cmds(in_file,out_bam,view_args,sort_args)])
+            status=pe.execute_pipeline(cmds,verbose=verbose,quiet=quiet,logs=logs,objectid=objectid,inputs=[in_file],outputs=[out_bam],
+                                       force=force,checkpoint_message=checkpoint)
+            if status and index:
+                status=bool(self.index_bam(out_bam,threads=threads,verbose=verbose,quiet=quiet,logs=logs,objectid=objectid,force=force))
+        finally:
+            end_sort()
+            pe.thread_budget.release(granted)
         
         if not status:
-            print("Bam sort failed for:"+bam_file)
+            pu.print_boldred("samtools sort failed for:"+in_file)
             return ""
         
         #check if bam file exists
-        if not pu.check_files_exist(outSortedbam_file):
+        if not pu.check_files_exist(out_bam):
             return ""
-
-        if delete_bam:
-            if not pe.deleteFileFromDisk(bam_file):
-                print("Error deleting sam file:"+bam_file)
-                
-        #return path to file
-        return outSortedbam_file
+        
+        if delete_input:
+            if not pe.deleteFileFromDisk(in_file):
+                print("Error deleting file:"+in_file)
+        
+        return out_bam
     
-    def sam_sorted_bam(self,sam_file,out_dir="",out_suffix="",delete_sam=False,delete_bam=False,verbose=False,quiet=False,logs=True,objectid="NA",**kwargs):
-        """Convert sam file to bam and sort the bam file.
+    def index_bam(self,bam_file,threads=None,verbose=False,quiet=False,logs=True,objectid="NA",force=False,**kwargs):
+        """Index a sorted bam file. Indexing is skipped if the index is up to date with bam_file.
         
+        Parameters
+        ----------
+        
+        bam_file: string
+            path to the sorted bam file
+        threads: int
+            threads of samtools index. Default: taken from the thread budget
         verbose: bool
             Print stdout and std error
         quiet: bool
@@ -145,25 +406,25 @@ class Samtools(RNASeqTools):
             Log this command to pyrpipe logs
         objectid: str
             Provide an id to attach with this command e.g. the SRR accession. This is useful for debugging, benchmarking and reports.
+        force: bool
+            index even if the index is up to date
         kwargs: dict
-            Options to pass to samtools. This will override the existing options 
+            Options to pass to samtools index e.g. {"-c":""} to write a csi index.
 
-        :return: Returns path to the sorted bam file. Returns empty string if operation failed.
+        :return: Returns path to the index. Returns empty string if operation failed.
         :rtype: string
         """
-        
-        sam2bam_file=self.sam_to_bam(sam_file,delete_sam=delete_sam,verbose=verbose,quiet=quiet,logs=logs,objectid=objectid,**kwargs)
-        
-        if not sam2bam_file:
+        index_cmd=['samtools','index']+pu.parse_unix_args(['-b','-c','-m'],kwargs)+[bam_file]
+        index_file=bam_file+(".csi" if '-c' in kwargs else ".bai")
+        checkpoint=" ".join(index_cmd)
+        if threads:
+            index_cmd=pe.add_thread_arg(index_cmd,'-@',threads)
+        status=pe.execute_command(index_cmd,verbose=verbose,quiet=quiet,logs=logs,objectid=objectid,inputs=[bam_file],outputs=[index_file],
+                                  force=force,thread_flags=self.thread_args['index'],checkpoint_message=checkpoint)
+        if not status or not pu.check_files_exist(index_file):
+            pu.print_boldred("samtools index failed for:"+bam_file)
             return ""
-            
-
-        bamSorted=self.sort_bam(sam2bam_file,out_dir, out_suffix,delete_bam,verbose=verbose,quiet=quiet,logs=logs,objectid=objectid,**kwargs)
-        
-        if not bamSorted:
-            return ""
-        
-        return bamSorted
+        return index_file
     
     
     def merge_bam(self,*args,out_file="merged",out_dir="",delete_bams=False,verbose=False,quiet=False,logs=True,objectid="NA",**kwargs):
@@ -221,9 +482,8 @@ class Samtools(RNASeqTools):
         
 
         if delete_bams:
-            for bam_file in args:
-                if not pe.deleteFileFromDisk(bam_file):
-                    print("Error deleting sam file:"+bam_file)
+            if not pe.deleteMultipleFilesFromDisk(*args):
+                print("Error deleting bam files")
                     
         return outMergedFile
         
@@ -254,20 +514,38 @@ class Samtools(RNASeqTools):
         :rtype: bool
         """
             
-        #override existing arguments
-        mergedArgsDict={**self.passedArgumentDict,**kwargs}
-       
-        samtools_cmd=['samtools',sub_command]
-        #add options
-        samtools_cmd.extend(pu.parse_unix_args(self.valid_args,mergedArgsDict))
+        samtools_cmd=self.get_samtools_cmd(sub_command,**kwargs)
                 
         #start ececution
-        status=pe.execute_command(samtools_cmd,verbose=verbose,quiet=quiet,logs=logs,objectid=objectid)
+        status=pe.execute_command(samtools_cmd,verbose=verbose,quiet=quiet,logs=logs,objectid=objectid,thread_flags=self.thread_args.get(sub_command))
         if not status:
             pu.print_boldred("samtools failed")
         
         #return status
         return status
+    
+    async def run_samtools_async(self,sub_command,verbose=False,quiet=False,logs=True,objectid="NA",**kwargs):
+        """Coroutine version of run_samtools. Parameters are same as run_samtools.
+        
+        :return: Returns the status of samtools. True is passed, False if failed.
+        :rtype: bool
+        """
+        samtools_cmd=self.get_samtools_cmd(sub_command,**kwargs)
+        status=await pe.execute_command_async(samtools_cmd,verbose=verbose,quiet=quiet,logs=logs,objectid=objectid,thread_flags=self.thread_args.get(sub_command))
+        if not status:
+            pu.print_boldred("samtools failed")
+        return status
+    
+    def get_samtools_cmd(self,sub_command,**kwargs):
+        """Return the samtools command with the stored arguments overridden by kwargs
+        """
+        #override existing arguments
+        mergedArgsDict={**self.passedArgumentDict,**kwargs}
+       
+        samtools_cmd=['samtools',sub_command]
+        #add options
+        samtools_cmd.extend(pu.parse_unix_args(self.valid_args,mergedArgsDict))
+        return samtools_cmd
         
         
         
@@ -288,6 +566,8 @@ class Portcullis(RNASeqTools):
                             '--save_bad']
         
         self.passedArgumentDict=kwargs
+        #flags setting the number of threads of each sub_command; threads are taken from the thread budget if not set
+        self.thread_args={c:['-t','--threads'] for c in ['full','prep','junc','filter']}
         
         
     def run_portcullisFull(self,reference_fasta,bam_file,out_dir="",delete_bam=False,verbose=False,quiet=False,logs=True,objectid="NA",**kwargs):
@@ -371,23 +651,41 @@ class Portcullis(RNASeqTools):
         """
         
         
-        #override existing arguments
-        mergedArgsDict={**self.passedArgumentDict,**kwargs}
-       
-        portcullis_cmd=['portcullis',sub_command]
-        #add options
-        portcullis_cmd.extend(pu.parse_unix_args(self.valid_args,mergedArgsDict))
+        portcullis_cmd=self.get_portcullis_cmd(sub_command,**kwargs)
                 
         print("Executing:"+" ".join(portcullis_cmd))
         
         
         #start ececution
-        status=pe.execute_command(portcullis_cmd,verbose=verbose,quiet=quiet,logs=logs,objectid=objectid)
+        status=pe.execute_command(portcullis_cmd,verbose=verbose,quiet=quiet,logs=logs,objectid=objectid,thread_flags=self.thread_args.get(sub_command))
         if not status:
             pu.print_boldred("portcullis failed")
                 
         #return status
         return status
+    
+    async def run_portcullis_async(self,sub_command,verbose=False,quiet=False,logs=True,objectid="NA",**kwargs):
+        """Coroutine version of run_portcullis. Parameters are same as run_portcullis.
+        
+        :return: Returns the status of portcullis. True is passed, False if failed.
+        :rtype: bool
+        """
+        portcullis_cmd=self.get_portcullis_cmd(sub_command,**kwargs)
+        status=await pe.execute_command_async(portcullis_cmd,verbose=verbose,quiet=quiet,logs=logs,objectid=objectid,thread_flags=self.thread_args.get(sub_command))
+        if not status:
+            pu.print_boldred("portcullis failed")
+        return status
+    
+    def get_portcullis_cmd(self,sub_command,**kwargs):
+        """Return the portcullis command with the stored arguments overridden by kwargs
+        """
+        #override existing arguments
+        mergedArgsDict={**self.passedArgumentDict,**kwargs}
+       
+        portcullis_cmd=['portcullis',sub_command]
+        #add options
+        portcullis_cmd.extend(pu.parse_unix_args(self.valid_args,mergedArgsDict))
+        return portcullis_cmd
         
         
         
@@ -10,6 +10,7 @@ import sys
 import os
 import argparse
 import json
+import shutil
 from pyrpipe import pyrpipe_utils as pu
 from jinja2 import Environment, BaseLoader
 from weasyprint import HTML,CSS
@@ -17,6 +18,7 @@ from html import escape
 import datetime as dt
 import multiqc as mc
 from pyrpipe import benchmark as bm
+from pyrpipe import log_reader
 
 
 try:
@@ -130,7 +132,7 @@ def generateHTMLReport(templateFile,cmdLog,envLog,coverage='f'):
     sysInfo,progList=parseEnvLog(envLog)
     
     #get starttime #end time is calculated from log below
-    startTime=dt.datetime.strptime(sysInfo['now'],"%y-%m-%d %H:%M:%S")
+    startTime=pu.parse_time(sysInfo['now'])
     #total progs used
     progNames=progList.keys()
     numPrograms=len(progNames)
@@ -152,15 +154,12 @@ def generateHTMLReport(templateFile,cmdLog,envLog,coverage='f'):
         
         example record:{'cmd':logMessage,
                  'exitcode':str(exitCode),
-                 'runtime':str(dt.timedelta(seconds=timeDiff)),
+                 'runtime':timeDiff,
                  'starttime':str(strStartTime),
                  'stdout':stdout,
                  'stderr':stderr                 
                 }
     """
-    with open(cmdLog) as f:
-        data=f.read().splitlines()
-    
     #read head.html
     headHTML=pkg_resources.read_text(report_templates, 'head.html')
     #add file name
@@ -171,53 +170,40 @@ def generateHTMLReport(templateFile,cmdLog,envLog,coverage='f'):
     fullHTML="\n<h2> Details </h2>"
     failColor="rgb(208,28,139)"
     passColor="rgb(77,172,38)" 
-    for l in data:
-        if not l.startswith("#"):
-            thisDict=json.loads(l)
-            numCommands+=1
-            #add color to table
-            if int(thisDict['exitcode'])==0:
-                thisDict['statuscolor']=passColor
-                passedCommands+=1
-            else:
-                thisDict['statuscolor']=failColor
-                failedCommands+=1
-            
-            #program name
-            programname=thisDict['commandname']
-            #if programname == "":
-            #    programname=thisDict['cmd'].split(" ")[0]
-            #add program version info
-            newDict={**thisDict,**progList[programname]}
-            
-            #skip passed
-            if coverage=='i' and int(thisDict['exitcode'])==0:
-                continue
-            #skip failed
-            if coverage=='p' and int(thisDict['exitcode'])!=0:
-                continue
-            
-            #escape all special html charecters
-            for k, v in newDict.items():
-                newDict[k] = escape(str(v))
-            fullHTML=fullHTML+"\n"+template.render(newDict)
-            
+    lastDict=None
+    for thisDict in log_reader.read_log(cmdLog):
+        lastDict=thisDict
+        numCommands+=1
+        #add color to table
+        if thisDict['exitcode']==0:
+            thisDict['statuscolor']=passColor
+            passedCommands+=1
+        else:
+            thisDict['statuscolor']=failColor
+            failedCommands+=1
+        
+        #program name
+        programname=thisDict['commandname']
+        #if programname == "":
+        #    programname=thisDict['cmd'].split(" ")[0]
+        #add program version info
+        newDict={**thisDict,**progList[programname]}
+        
+        #skip passed
+        if coverage=='i' and thisDict['exitcode']==0:
+            continue
+        #skip failed
+        if coverage=='p' and thisDict['exitcode']!=0:
+            continue
+        
+        #escape all special html charecters
+        for k, v in newDict.items():
+            newDict[k] = escape(str(v))
+        fullHTML=fullHTML+"\n"+template.render(newDict)
+        
     #get start and runtime of last command
-    lastDict=json.loads(data[-1])
-    lastST=dt.datetime.strptime(lastDict['starttime'],"%y-%m-%d %H:%M:%S")
-    try:
-        lastruntime= dt.datetime.strptime(lastDict['runtime'],"%H:%M:%S")
-        deltaTime = dt.timedelta(days=0,hours=lastruntime.hour, minutes=lastruntime.minute, seconds=lastruntime.second)
-    except ValueError:
-        #try days format
-        timeString=lastDict['runtime'].split(",")
-        days=int(timeString[0].split(" ")[0].strip())
-        rest=timeString[1].strip()
-        #hours=int(days)*24
-        lastruntime= dt.datetime.strptime(rest,"%H:%M:%S")
-        #one day less
-        #lastruntime=lastruntime+dt.timedelta(days=days-1)
-        deltaTime = dt.timedelta(days=days,hours=lastruntime.hour, minutes=lastruntime.minute, seconds=lastruntime.second)
+    lastST=pu.parse_time(lastDict['starttime'])
+    deltaTime=dt.timedelta(seconds=pu.parse_runtime(lastDict['runtime']))
     
     endTime=lastST+deltaTime
     #remove one extra day
@@ -285,67 +271,60 @@ def writeHtmlToMarkdown(htmlText,outFile):
     """
     
 
+def get_passed_filter(coverage):
+    """Return the read_log passed filter for coverage: a (all), p (passed) or i (failed)
+    """
+    if coverage=='p':
+        return True
+    if coverage=='i':
+        return False
+    return None
+
 def getCommandsFromLog(inFile,filterList,coverage):
-    with open(inFile) as f:
-        data=f.read().splitlines()
     commands=[]
-    for l in data:
-        if not l.startswith("#"):
-            thisLog=json.loads(l)
-            thisName=thisLog["cmd"].split(' ')[0]
-            if filterList and thisName in filterList:
-                continue
-            status=int(thisLog['exitcode'])
-            #skip passed
-            if coverage=='i' and status==0:
-                continue
-            #skip failed
-            if coverage=='p' and status!=0:
-                continue
-            
-            commands.append(thisLog["cmd"])
-            
+    for thisLog in log_reader.read_log(inFile,fields=['cmd'],passed=get_passed_filter(coverage)):
+        thisName=thisLog["cmd"].split(' ')[0]
+        if filterList and thisName in filterList:
+            continue
+        
+        commands.append(thisLog["cmd"])
+        
     return commands
 
 def getStdoutFromLog(inFile,filterList,coverage):
-    """Return a dict with objid_program as key and stdout
+    """Generator of (key,stdout,stdout_file) with objid_program as key, reading the log one command at a time.
+    For streamed commands stdout_file is the spooled file with the full output and stdout is None; otherwise stdout_file is None.
     """
-    with open(inFile) as f:
-        data=f.read().splitlines()
-    stdout={}
+    keys=set()
     duplicate_ctr={}
-    for l in data:
-        if not l.startswith("#"):
-            thisLog=json.loads(l)
-            thisObj=thisLog['objectid']
-            thisProgram=thisLog['commandname']
-            #filter program
-            thisName=thisLog["stdout"].split(' ')[0]
-            if filterList and thisName in filterList:
-                continue
-            status=int(thisLog['exitcode'])
-            #skip passed
-            if coverage=='i' and status==0:
-                continue
-            #skip failed
-            if coverage=='p' and status!=0:
-                continue
-            
-            key=thisObj+"_"+thisProgram
-            #handle duplicate
-            if key in stdout:
-                
-                if key in duplicate_ctr:
-                    duplicate_ctr[key]+=1
-                else:
-                    duplicate_ctr[key]=1
-                #new key    
-                suffix=duplicate_ctr[key]
-                key=key+"_"+str(suffix)
-                
-            stdout[key]=thisLog["stdout"]
+    fields=['cmd','exitcode','objectid','commandname','stdout','stdout_file']
+    for thisLog in log_reader.read_log(inFile,fields=fields,passed=get_passed_filter(coverage)):
+        thisObj=thisLog['objectid']
+        thisProgram=thisLog['commandname']
+        #filter program
+        thisName=thisLog["cmd"].split(' ')[0]
+        if filterList and thisName in filterList:
+            continue
+        
+        key=thisObj+"_"+thisProgram
+        #handle duplicate
+        if key in keys:
             
-    return stdout
+            if key in duplicate_ctr:
+                duplicate_ctr[key]+=1
+            else:
+                duplicate_ctr[key]=1
+            #new key    
+            suffix=duplicate_ctr[key]
+            key=key+"_"+str(suffix)
+        keys.add(key)
+        
+        #streamed commands keep only a tail in the log; the full output is in the spooled file
+        stdout_file=thisLog.get('stdout_file',"")
+        if stdout_file and pu.check_files_exist(stdout_file):
+            yield key,None,stdout_file
+        else:
+            yield key,thisLog["stdout"],None
 
 
 
@@ -364,9 +343,8 @@ def generateBashScript(logFile,outFile,filterList,coverage='a'):
 
 def checkEnvLog(logFile):
     #check all logs exist
-    logFileDir=pu.get_file_directory(logFile)
-    basename=pu.get_file_basename(logFile)
-    envLog=os.path.join(logFileDir,basename+"ENV.log")
+    logFile=log_reader.get_log_base(logFile)
+    envLog=log_reader.get_env_log(logFile)
     if not pu.check_files_exist(logFile,envLog):
         print("Please check missing log files. Exiting.")
         sys.exit(1)
@@ -377,14 +355,16 @@ def generateMultiqcReport(logFile,filterList,tempDir,outDir="",coverage='a',verb
     stdout=getStdoutFromLog(logFile,filterList,coverage)
     
     flist=[]
-    for o in stdout:
+    for o,thisStdout,stdoutFile in stdout:
         thisName=o+".txt"
         tempFile=os.path.join(tempDir,thisName)
-#        print("opening:"+tempFile)
-        f=open(tempFile,"w")
-        f.write(stdout[o])
-        #rint(stdout[o])
-        f.close()
+        if stdoutFile:
+            #copy spooled output without loading it into memory
+            shutil.copyfile(stdoutFile,tempFile)
+        else:
+            f=open(tempFile,"w")
+            f.write(thisStdout)
+            f.close()
         flist.append(tempFile)
     
     #run multiqc
@@ -406,6 +386,7 @@ def generateBenchmarkReport(logFile,envLog,filterList,tempDir,outFile="",verbose
     #generate benchmarks
     ob.plot_time_perobject()
     ob.plot_time_perprogram()
+    ob.plot_resources_perprogram()
     
     pu.print_green("Benchmark report saved to:"+tempDir+"/benchmark_reports")
 
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Tests for benchmark reports using a generated log
+"""
+
+from pyrpipe import benchmark
+import json
+import time
+
+
+def write_log(log_file,num_objects,programs):
+    with open(log_file,'w') as f:
+        f.write("#pyrpipe log\n")
+        for i in range(num_objects):
+            for j,p in enumerate(programs):
+                record={'cmd':p,'exitcode':0,'runtime':float(j+1),'starttime':"2020-01-22T18:14:47.000",
+                        'stdout':"",'stderr':"",'objectid':"SRR"+str(i),'commandname':p}
+                f.write(json.dumps(record)+"\n")
+            #failed commands are ignored
+            record['exitcode']=1
+            f.write(json.dumps(record)+"\n")
+
+def test_benchmark(tmp_path):
+    log_file=str(tmp_path/"test_pyrpipe.log")
+    env_log=str(tmp_path/"test_pyrpipeENV.log")
+    open(env_log,'w').close()
+    write_log(log_file,3,['prefetch','hisat2','stringtie'])
+    bm=benchmark.Benchmark(log_file,env_log,out_dir=str(tmp_path))
+    
+    perprog=bm.get_time_perprogram()
+    assert list(perprog['program'])==['prefetch','hisat2','stringtie'], "Failed program order"
+    assert list(perprog['total'])==[3,6,9], "Failed total runtime"
+    assert list(perprog['average'])==[1,2,3], "Failed average runtime"
+    
+    perob=bm.get_time_perobject()
+    assert list(perob['id'])==['SRR0','SRR1','SRR2'], "Failed objects"
+    assert list(perob['total'])==[6,6,6], "Failed total runtime per object"
+    assert list(perob.columns)==['prefetch','hisat2','stringtie','id','total'], "Failed columns"
+    
+    box=bm.get_programtime_boxdata()
+    assert box.shape[0]==9, "Failed box data"
+    assert list(box['name'][:3])==['prefetch']*3, "Failed box data order"
+    
+    assert bm.runtimes_by_prog['hisat2']==[2,2,2], "Failed runtimes_by_prog"
+    assert bm.runtimes_by_object['SRR1']=={'prefetch':[1],'hisat2':[2],'stringtie':[3]}, "Failed runtimes_by_object"
+    
+def test_benchmark_scaling(tmp_path):
+    log_file=str(tmp_path/"test_pyrpipe.log")
+    env_log=str(tmp_path/"test_pyrpipeENV.log")
+    open(env_log,'w').close()
+    #~100k commands
+    write_log(log_file,20000,['prefetch','fasterq-dump','hisat2','samtools','stringtie'])
+    start=time.perf_counter()
+    bm=benchmark.Benchmark(log_file,env_log,out_dir=str(tmp_path))
+    bm.get_time_perobject()
+    bm.get_time_perprogram()
+    bm.get_programtime_boxdata()
+    elapsed=time.perf_counter()-start
+    print("benchmark time: {:.3f}s".format(elapsed))
+    assert elapsed<20, "Benchmark aggregation too slow"
@@ -0,0 +1,448 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Tests for pyrpipe_engine. These use only standard unix programs.
+"""
+
+from pyrpipe import pyrpipe_engine as pe
+from pyrpipe import pyrpipe_utils as pu
+import json
+import sys
+import os
+import threading
+import subprocess
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+def get_last_log():
+    with open(pe.get_logger().log_path) as f:
+        lines=f.read().splitlines()
+    return json.loads(lines[-1])
+
+def test_execute_command():
+    st=pe.execute_command(['echo','pyrpipe'],objectid="testob")
+    assert st==True, "Failed execute_command"
+    log=get_last_log()
+    assert log['objectid']=="testob", "Failed objectid in log"
+    assert log['stdout'].strip()=="pyrpipe", "Failed stdout in log"
+    st=pe.execute_command(['false'],objectid="testob")
+    assert st==False, "Failed execute_command exit status"
+
+def test_stream_output():
+    #write ~1MB to stdout
+    cmd=[sys.executable,'-c',"import sys\nfor i in range(20000): sys.stdout.write('line'+str(i)+' '*40+'\\n')"]
+    st=pe.execute_command(cmd,objectid="streamtest",command_name="streamer",stream_output=True)
+    assert st==True, "Failed streaming execute_command"
+    log=get_last_log()
+    assert pu.check_files_exist(log['stdout_file']), "Failed to spool stdout"
+    with open(log['stdout_file']) as f:
+        full=f.read()
+    assert full.count("\n")==20000, "Spooled stdout incomplete"
+    assert len(log['stdout'])<=pe.STREAM_TAIL_BYTES, "stdout tail not bounded"
+    assert log['stdout'].endswith("line19999"+' '*40+"\n"), "Failed stdout tail"
+    assert log['stdout'].startswith("line"), "Tail does not start at a line"
+
+def test_execute_pipeline():
+    st=pe.execute_pipeline([['printf','b\na\nc\n'],['sort'],['head','-n','2']],objectid="pipetest")
+    assert st==True, "Failed execute_pipeline"
+    log=get_last_log()
+    assert log['stdout']=="a\nb\n", "Failed pipeline stdout"
+    assert log['exitcodes']==[0,0,0], "Failed pipeline exitcodes"
+    assert log['commandname']=="printf|sort|head", "Failed pipeline command name"
+    assert log['cmd'].count(" | ")==2, "Failed composite command"
+    #failure in a middle stage fails the pipeline
+    st=pe.execute_pipeline([['echo','x'],['false'],['cat']],quiet=True)
+    assert st==False, "Failed execute_pipeline exit status"
+    log=get_last_log()
+    assert log['exitcodes'][1:]==[1,0], "Failed pipeline exitcodes"
+    #missing program
+    st=pe.execute_pipeline([['echo','x'],['pyrpipe_no_such_program']],quiet=True)
+    assert st==False, "Failed execute_pipeline with missing program"
+    assert get_last_log()['exitcode']==-1, "Failed pipeline error log"
+
+def test_execute_command_async():
+    async def run():
+        time_start=time.monotonic()
+        status=await asyncio.gather(*[pe.execute_command_async(['sleep','1'],objectid="async"+str(i),quiet=True) for i in range(20)])
+        assert all(status), "Failed execute_command_async"
+        assert time.monotonic()-time_start<10, "Failed to run commands concurrently"
+        assert await pe.execute_command_async(['echo','pyrpipe'],objectid="testob")==True, "Failed execute_command_async"
+        log=get_last_log()
+        assert log['objectid']=="testob" and log['stdout'].strip()=="pyrpipe", "Failed async log"
+        assert await pe.execute_command_async(['false'],quiet=True)==False, "Failed execute_command_async exit status"
+        assert get_last_log()['exitcode']==1, "Failed async exitcode"
+        assert await pe.execute_command_async(['pyrpipe_no_such_program'],quiet=True)==False, "Failed async missing program"
+        assert get_last_log()['exitcode']=="-1", "Failed async error log"
+        #cancelled commands are killed and logged
+        task=asyncio.ensure_future(pe.execute_command_async(['sleep','30'],quiet=True))
+        await asyncio.sleep(0.5)
+        task.cancel()
+        try:
+            await task
+            assert False, "Failed to cancel"
+        except asyncio.CancelledError:
+            pass
+        log=get_last_log()
+        assert log['cmd']=="sleep 30" and log['stderr']=="Cancelled", "Failed to log cancelled command"
+        
+        assert await pe.execute_pipeline_async([['printf','b\na\nc\n'],['sort'],['head','-n','2']],quiet=True)==True, "Failed execute_pipeline_async"
+        log=get_last_log()
+        assert log['stdout']=="a\nb\n" and log['exitcodes']==[0,0,0], "Failed async pipeline"
+        assert await pe.execute_pipeline_async([['echo','x'],['false'],['cat']],quiet=True)==False, "Failed async pipeline exit status"
+        assert get_last_log()['exitcodes']==[0,1,0], "Failed async pipeline exitcodes"
+        
+        #threads and checkpoint keys are handled as in execute_command
+        assert await pe.execute_command_async(['echo','x'],quiet=True,thread_flags=['-p'])==True, "Failed async thread flags"
+        assert get_last_log()['cmd'].startswith("echo x -p "), "Failed to add threads to async command"
+        assert pe.thread_budget.free==pe.thread_budget.max_threads, "Failed to release async threads"
+    loop=asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(run())
+    finally:
+        loop.close()
+
+def test_scheduler():
+    running=[0]
+    peak=[0]
+    lock=threading.Lock()
+    def job(name):
+        with lock:
+            running[0]+=1
+            peak[0]=max(peak[0],running[0])
+        #objectid is taken from the job
+        st=pe.execute_command(['sleep','0.2'],quiet=True)
+        with lock:
+            running[0]-=1
+        return name+str(pe.get_job_threads())
+    
+    sc=pe.Scheduler(max_cpus=4)
+    for i in range(6):
+        sc.add_job(job,"job"+str(i),threads=2,objectid="schedjob"+str(i))
+    results=sc.run()
+    assert results==["job"+str(i)+"2" for i in range(6)], "Failed scheduler results"
+    assert peak[0]==2, "Failed to respect CPU budget"
+    assert sc.get_failed()==[], "Failed scheduler jobs"
+    
+    with open(pe.get_logger().log_path) as f:
+        logs=[json.loads(l) for l in f.read().splitlines() if not l.startswith("#")]
+    objectids=[l['objectid'] for l in logs if l['commandname']=='sleep']
+    assert sorted(objectids[-6:])==["schedjob"+str(i) for i in range(6)], "Failed objectid tagging"
+
+def test_scheduler_worker_threads():
+    #threads started by a job do not wait for the CPUs held by the job
+    def job():
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            unbound=pool.submit(pe.execute_command,['echo','x'],quiet=True,thread_flags=['-p']).result()
+            bound=pool.submit(pe.bind_job_context(lambda: (pe.get_job_objectid(),pe.get_job_threads()))).result()
+        return unbound,bound
+    pe.set_thread_budget(4)
+    try:
+        sc=pe.Scheduler()
+        sc.add_job(job,threads=4,objectid="workerjob")
+        results=[]
+        t=threading.Thread(target=lambda: results.append(sc.run()),daemon=True)
+        t.start()
+        t.join(30)
+        assert not t.is_alive(), "Worker thread of a job waited for the CPUs of the job"
+        assert results==[[(True,("workerjob",4))]], "Failed to pass job context to worker threads"
+        assert pe.get_job_context()=={}, "Job context left in the calling thread"
+    finally:
+        pe.set_thread_budget()
+
+def test_program_version_cache(tmp_path,monkeypatch):
+    #a fake program that counts how many times it is executed
+    counter=tmp_path/"count"
+    prog=tmp_path/"faketool"
+    prog.write_text("#!/bin/sh\necho x >> {}\necho faketool 1.0\n".format(counter))
+    prog.chmod(0o755)
+    monkeypatch.setenv("PATH",str(tmp_path)+os.pathsep+os.environ["PATH"])
+    monkeypatch.setenv("PYRPIPE_CACHE_DIR",str(tmp_path/"cache"))
+    
+    assert pe.check_dependencies(["faketool"])==True, "Failed to find program"
+    assert pe.getProgramPath("faketool")==str(prog), "Failed program path"
+    assert pe.getProgramVersion("faketool").strip()=="faketool 1.0", "Failed program version"
+    assert pe.getProgramVersion("faketool").strip()=="faketool 1.0", "Failed cached program version"
+    assert counter.read_text().count("x")==1, "Version probed more than once"
+    #new session uses the disk cache
+    pe.program_versions.clear()
+    monkeypatch.setattr(pe,"program_versions_loaded",False)
+    assert pe.getProgramVersion("faketool").strip()=="faketool 1.0", "Failed disk cached program version"
+    assert counter.read_text().count("x")==1, "Disk cache not used"
+    #modified binary is probed again
+    prog.write_text("#!/bin/sh\necho x >> {}\necho faketool 2.0\n".format(counter))
+    assert pe.getProgramVersion("faketool").strip()=="faketool 2.0", "Failed to detect new version"
+    assert pe.check_dependencies(["notarealtool_xyz"])==False, "Failed missing dependency"
+
+#seconds allowed to import all the pyrpipe modules in a new interpreter; generous to avoid failures on slow machines
+IMPORT_TIME_BUDGET=10
+
+def test_import(tmp_path):
+    code=("import time\n"
+          "time_start=time.perf_counter()\n"
+          "from pyrpipe import pyrpipe_engine as pe,sra,mapping,qc,quant,assembly,tools\n"
+          "elapsed=time.perf_counter()-time_start\n"
+          "assert pe.pyrpipeLoggerObject is None\n"
+          "print(elapsed)\n")
+    out=subprocess.check_output([sys.executable,'-c',code],cwd=str(tmp_path),universal_newlines=True)
+    assert float(out.strip().split("\n")[-1])<IMPORT_TIME_BUDGET, "Import time over budget"
+    assert not os.path.exists(str(tmp_path/"pyrpipe_logs")), "Logs created at import"
+
+def test_logs_dir(tmp_path):
+    code=("from pyrpipe import pyrpipe_engine as pe\n"
+          "pe.execute_command(['true'],logs=False)\n"
+          "import os\n"
+          "assert not os.path.exists('pyrpipe_logs')\n"
+          "pe.set_logs_dir('mylogs')\n"
+          "pe.execute_command(['true'],objectid='logtest')\n"
+          "assert pe.pyrpipeLoggerObject is pe.get_logger()\n"
+          "print(pe.get_logger().log_path)\n")
+    out=subprocess.check_output([sys.executable,'-c',code],cwd=str(tmp_path),universal_newlines=True)
+    log_path=out.strip().split("\n")[-1]
+    assert log_path.startswith(str(tmp_path/"mylogs")), "Failed to set logs dir"
+    with open(log_path) as f:
+        assert "logtest" in f.read(), "Failed to log command"
+    assert not os.path.exists(str(tmp_path/"pyrpipe_logs")), "Logs created in default dir"
+
+def test_checkpoints(tmp_path):
+    pe.set_checkpoint_file(str(tmp_path/"checkpoints.jsonl"))
+    try:
+        src=tmp_path/"in.txt"
+        dst=tmp_path/"out.txt"
+        src.write_text("data1")
+        cmd=['cp',str(src),str(dst)]
+        assert pe.execute_command(cmd,inputs=[str(src)],outputs=[str(dst)])==True, "Failed execute_command"
+        assert 'cache' not in get_last_log(), "First run logged as cache hit"
+        #rerun is skipped
+        assert pe.execute_command(cmd,inputs=[str(src)],outputs=[str(dst)])==True, "Failed cached execute_command"
+        assert get_last_log()['cache']=="hit", "Failed to skip completed command"
+        #checkpoints are read from disk by a new session
+        pe.set_checkpoint_file(str(tmp_path/"checkpoints.jsonl"))
+        assert pe.execute_command(cmd,inputs=[str(src)],outputs=[str(dst)])==True, "Failed cached execute_command"
+        assert get_last_log()['cache']=="hit", "Failed to read checkpoints"
+        #changed input
+        src.write_text("data2!")
+        assert pe.execute_command(cmd,inputs=[str(src)],outputs=[str(dst)])==True, "Failed execute_command"
+        assert 'cache' not in get_last_log(), "Changed input not detected"
+        assert dst.read_text()=="data2!", "Failed to rerun command"
+        #removed output
+        dst.unlink()
+        assert pe.execute_command(cmd,inputs=[str(src)],outputs=[str(dst)])==True, "Failed execute_command"
+        assert 'cache' not in get_last_log(), "Missing output not detected"
+        #forced run
+        assert pe.execute_command(cmd,inputs=[str(src)],outputs=[str(dst)],force=True)==True, "Failed execute_command"
+        assert 'cache' not in get_last_log(), "Failed to force execution"
+        #failed commands are not checkpointed
+        bad=['sh','-c','touch '+str(tmp_path/"bad.txt")+'; exit 1']
+        assert pe.execute_command(bad,outputs=[str(tmp_path/"bad.txt")])==False, "Failed exit status"
+        assert pe.execute_command(bad,outputs=[str(tmp_path/"bad.txt")])==False, "Failed command was checkpointed"
+    finally:
+        #do not leave checkpoints on for the other tests
+        pe.set_checkpoint_file(None)
+
+def test_resource_usage(tmp_path):
+    #use ~1s of cpu and ~100MB of memory
+    cmd=[sys.executable,'-c',"import time\nx=bytearray(100*1024*1024)\nt=time.process_time()\nwhile time.process_time()-t<1: pass"]
+    st=pe.execute_command(cmd,command_name="burner",quiet=True)
+    assert st==True, "Failed execute_command"
+    log=get_last_log()
+    for k in pe.RUSAGE_FIELDS:
+        assert k in log, "Missing resource usage "+k
+    assert log['utime']+log['stime']>=0.9, "Failed cpu time"
+    assert log['maxrss']>=100*1024, "Failed max rss"
+    #pipelines log the combined usage
+    st=pe.execute_pipeline([cmd,['cat']],command_name="burnpipe",quiet=True)
+    assert st==True, "Failed execute_pipeline"
+    log=get_last_log()
+    assert log['utime']+log['stime']>=0.9, "Failed pipeline cpu time"
+    
+    from pyrpipe import benchmark
+    lg=pe.get_logger()
+    bm=benchmark.Benchmark(lg.log_path,lg.envlog_path,out_dir=str(tmp_path))
+    res=bm.get_resources_perprogram()
+    row=res[res['program']=='burner'].iloc[0]
+    assert row['total_cpu']>=0.9, "Failed benchmark cpu time"
+    assert row['max_rss_mb']>=100, "Failed benchmark max rss"
+
+def test_runtime():
+    st=pe.execute_command(['sleep','0.25'],quiet=True)
+    assert st==True, "Failed execute_command"
+    log=get_last_log()
+    assert isinstance(log['runtime'],float), "Runtime is not numeric"
+    assert 0.2<=log['runtime']<2, "Failed sub-second runtime"
+    assert pu.parse_time(log['starttime']).year>=2020, "Failed ISO starttime"
+    #older logs
+    assert pu.parse_runtime("0:00:05")==5, "Failed to parse runtime"
+    assert pu.parse_runtime("2 days, 1:00:01")==2*86400+3601, "Failed to parse runtime in days"
+    assert pu.parse_runtime("0:00:01.500000")==1.5, "Failed to parse runtime"
+    assert pu.parse_runtime(1.25)==1.25, "Failed to parse runtime"
+    assert pu.parse_runtime(None) is None, "Failed to parse null runtime"
+    assert pu.parse_time("2020-01-22T18:14:47").second==47, "Failed ISO time without milliseconds"
+    assert pu.parse_time("20-01-22 18:14:47").hour==18, "Failed to parse old starttime"
+
+def test_find_files(tmp_path):
+    for d in ["a","a/b","c"]:
+        (tmp_path/d).mkdir()
+    for f in ["x.fastq","y.FASTQ","a/z.fastq","a/b/w.fastq","c/v.sra"]:
+        (tmp_path/f).write_text("")
+    os.symlink(str(tmp_path/"x.fastq"),str(tmp_path/"link.fastq"))
+    root=str(tmp_path)
+    assert pe.find_files(root,"*.fastq")==[os.path.join(root,"x.fastq")], "Failed find_files"
+    expected=sorted(os.path.join(root,f) for f in ["x.fastq","a/z.fastq","a/b/w.fastq"])
+    assert sorted(pe.find_files(root,"*.fastq",recursive=True))==expected, "Failed recursive find_files"
+    assert pe.find_files(os.path.join(root,"missing"),"*")==[], "Failed find_files on missing dir"
+    
+    snapshot=pe.DirectorySnapshot(root)
+    assert sorted(pe.iter_files(root,"*.fastq",recursive=True,snapshot=snapshot))==expected, "Failed snapshot"
+    assert snapshot.is_file(os.path.join(root,"c","v.sra")) and snapshot.is_file(os.path.join(root,"link.fastq")), "Failed snapshot is_file"
+    assert not snapshot.is_file(os.path.join(root,"c","missing","v.sra")), "Failed snapshot is_file"
+    #the snapshot is not updated until invalidated
+    (tmp_path/"c"/"u.sra").write_text("")
+    assert pe.find_files(os.path.join(root,"c"),"*.sra",snapshot=snapshot)==[os.path.join(root,"c","v.sra")], "Failed snapshot"
+    snapshot.invalidate(os.path.join(root,"c"))
+    assert len(pe.find_files(os.path.join(root,"c"),"*.sra",snapshot=snapshot))==2, "Failed snapshot invalidate"
+
+def test_file_operations(tmp_path,monkeypatch):
+    files=[str(tmp_path/("f"+str(i))) for i in range(5)]
+    for f in files:
+        with open(f,'w') as fh:
+            fh.write("data")
+    (tmp_path/"d").mkdir()
+    errors=pu.delete_files(*files,str(tmp_path/"missing"),str(tmp_path/"d"))
+    assert list(errors.keys())==[str(tmp_path/"d")], "Failed to report delete errors"
+    assert not any(os.path.exists(f) for f in files), "Failed to delete files"
+    assert pe.deleteMultipleFilesFromDisk(str(tmp_path/"missing"))==True, "Failed to ignore missing file"
+    assert pe.deleteFileFromDisk(str(tmp_path/"d"))==False, "Failed to report delete error"
+    
+    src=tmp_path/"src.txt"
+    src.write_text("pyrpipe")
+    assert pe.move_file(str(src),str(tmp_path/"dst.txt"))==True, "Failed move_file"
+    assert (tmp_path/"dst.txt").read_text()=="pyrpipe" and not src.exists(), "Failed move_file"
+    assert pe.move_file(str(tmp_path/"dst.txt"),str(tmp_path/"d"))==True, "Failed to move into directory"
+    assert (tmp_path/"d"/"dst.txt").exists(), "Failed to move into directory"
+    assert pe.move_file(str(tmp_path/"missing"),str(tmp_path/"dst.txt"))==False, "Failed to report move error"
+    
+    #move across filesystems
+    replace=os.replace
+    def cross_device_replace(source,destination):
+        if source==str(tmp_path/"d"/"dst.txt"):
+            raise OSError(18,"Invalid cross-device link")
+        return replace(source,destination)
+    monkeypatch.setattr(os,"replace",cross_device_replace)
+    monkeypatch.setattr(pu,"COPY_CHUNK_BYTES",2)
+    assert pe.move_file(str(tmp_path/"d"/"dst.txt"),str(tmp_path/"copied.txt"))==True, "Failed to copy across filesystems"
+    assert (tmp_path/"copied.txt").read_text()=="pyrpipe" and not (tmp_path/"d"/"dst.txt").exists(), "Failed to copy across filesystems"
+    assert sorted(os.listdir(str(tmp_path)))==["copied.txt","d"], "Temporary file left after copy"
+
+def test_index_validation(tmp_path,monkeypatch):
+    index=str(tmp_path/"hs")
+    for i in range(1,8):
+        with open(index+".{}.ht2".format(i),'w') as f:
+            f.write("index")
+    assert pu.check_hisatindex(index)==False, "Failed to detect missing shard"
+    with open(index+".8.ht2",'w') as f:
+        f.write("")
+    assert pu.check_hisatindex(index)==False, "Failed to detect empty shard"
+    with open(index+".8.ht2",'w') as f:
+        f.write("index")
+    assert pu.check_hisatindex(index)==True, "Failed hisat2 index check"
+    #verdict is cached until the directory changes
+    calls=[]
+    check_index_files=pu.check_index_files
+    monkeypatch.setattr(pu,"check_index_files",lambda *args: calls.append(args) or check_index_files(*args))
+    assert pu.check_hisatindex(index)==True and calls==[], "Failed to cache verdict"
+    assert pu.write_index_manifest('hisat2',index)==True, "Failed to write manifest"
+    assert pu.check_hisatindex(index)==True and len(calls)==1, "Failed to check index after change"
+    #manifest records sizes
+    with open(index+".3.ht2",'w') as f:
+        f.write("half")
+    os.utime(str(tmp_path),ns=(0,0))
+    assert pu.check_hisatindex(index)==False, "Failed to detect truncated shard"
+    #only the index files are checkpoint inputs of the aligner
+    (tmp_path/"reads.fastq").write_text("reads")
+    assert pu.get_index_inputs('hisat2',index)==[index+".{}.ht2".format(i) for i in range(1,9)], "Failed index inputs"
+    
+    star_dir=tmp_path/"star"
+    star_dir.mkdir()
+    for f in pu.INDEX_FILES['star'][0]:
+        (star_dir/f).write_text("index")
+    assert pu.check_starindex(str(star_dir))==True, "Failed star index check"
+    (star_dir/"exonInfo.tab").write_text("exons")
+    assert pu.write_index_manifest('star',str(star_dir))==True, "Failed to write manifest"
+    (star_dir/"exonInfo.tab").unlink()
+    assert pu.check_starindex(str(star_dir))==False, "Failed to detect missing file"
+    assert pu.check_salmonindex(str(tmp_path/"salmon"))==False and pu.check_kallistoindex("")==False, "Failed missing index check"
+    #a salmon index needs more than versionInfo.json; the older index layout is also accepted
+    salmon_dir=tmp_path/"salmon"
+    salmon_dir.mkdir()
+    (salmon_dir/"versionInfo.json").write_text("{}")
+    assert pu.check_salmonindex(str(salmon_dir))==False, "Failed to detect partial salmon index"
+    for f in pu.INDEX_FILES['salmon'][2]:
+        (salmon_dir/f).write_text("index")
+    assert pu.check_salmonindex(str(salmon_dir))==True, "Failed salmon index check"
+
+def test_thread_budget(tmp_path):
+    budget=pe.ThreadBudget(4)
+    #a tool alone gets all the threads
+    assert budget.acquire()==4, "Failed default grant"
+    budget.release(4)
+    #tools declared to run together split the threads and do not wait for each other
+    with budget.share(2):
+        assert [budget.acquire(),budget.acquire()]==[2,2], "Failed shared grant"
+    budget.release(2)
+    #a waiting request is counted when sizing the grant of a new request
+    granted=[]
+    t=threading.Thread(target=lambda: granted.append(budget.acquire(3,minimum=3)))
+    t.start()
+    time.sleep(0.1)
+    assert budget.acquire()==1, "Failed to share with a waiting request"
+    budget.release(1)
+    budget.release(2)
+    t.join()
+    assert granted==[3], "Failed to grant waiting request"
+    budget.release(3)
+    budget=pe.ThreadBudget(4,default_threads=3)
+    assert budget.acquire()==3, "Failed default grant"
+    budget.release(3)
+    #grants shrink as the budget fills up
+    assert budget.acquire(3)==3
+    assert budget.acquire(3)==1, "Failed to shrink grant"
+    granted=[]
+    t=threading.Thread(target=lambda: granted.append(budget.acquire(2,minimum=2)))
+    t.start()
+    time.sleep(0.1)
+    assert granted==[], "Failed to wait for threads"
+    budget.release(3)
+    t.join()
+    assert granted==[2], "Failed to grant released threads"
+    
+    assert pe.add_thread_arg(['samtools','sort','-o','a.bam','b.bam'],'-@',2)==['samtools','sort','-@','2','-o','a.bam','b.bam']
+    assert pe.add_thread_arg(['bbduk.sh','in=a.fq'],'threads=',2)==['bbduk.sh','threads=2','in=a.fq']
+    assert pe.add_thread_arg(['samtools','index','a.bam'],'-@',2)==['samtools','index','-@','2','a.bam']
+    assert pe.has_thread_arg(['bbduk.sh','threads=8'],['threads='])
+    assert not pe.has_thread_arg(['hisat2','-x','idx'],['-p','--threads'])
+    
+    #threads are passed to the tool but not saved in the checkpoint
+    pe.set_checkpoint_file(str(tmp_path/"checkpoints.jsonl"))
+    pe.set_thread_budget(3,default_threads=3)
+    try:
+        stub=tmp_path/"tool"
+        out=str(tmp_path/"out.txt")
+        #version probes are ignored
+        stub.write_text('#!/bin/sh\n[ "$1" = "--version" ] && exit 0\necho "$@" > {}\n'.format(out))
+        stub.chmod(0o755)
+        cmd=[str(stub),out]
+        assert pe.execute_command(cmd,outputs=[out],thread_flags=['-p'])==True, "Failed execute_command"
+        with open(out) as f:
+            assert f.read().split()[1:]==['-p','3'], "Failed to pass threads"
+        assert pe.thread_budget.free==3, "Failed to release threads"
+        assert pe.execute_command(cmd,outputs=[out],thread_flags=['-p'])==True
+        assert get_last_log()['cache']=="hit", "Failed to checkpoint without threads"
+        #threads set by the user are kept
+        assert pe.execute_command(cmd+['-p','1'],thread_flags=['-p'])==True
+        with open(out) as f:
+            assert f.read().split()[1:]==['-p','1'], "Failed to keep user threads"
+    finally:
+        pe.set_thread_budget()
+        pe.set_checkpoint_file(None)
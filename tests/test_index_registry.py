@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Tests for the index registry
+"""
+
+from pyrpipe import index_registry
+import os
+import threading
+import time
+
+
+def test_get_index(tmp_path,monkeypatch):
+    monkeypatch.setattr(index_registry,"registry_dir_path",str(tmp_path/"registry"))
+    ref=tmp_path/"genome.fa"
+    ref.write_text(">chr1\nACGT\n")
+    builds=[]
+    def build(path,name):
+        builds.append(path)
+        time.sleep(0.2)
+        for suffix in [".1.ht2",".2.ht2"]:
+            with open(os.path.join(path,name+suffix),'w') as f:
+                f.write("index")
+        return True
+
+    #concurrent builds of the same index build it once
+    results=[]
+    threads=[threading.Thread(target=lambda p: results.append(index_registry.get_index("hisat2",[],[str(ref)],{"--seed":"1"},p,"hs",build)),
+                              args=(str(tmp_path/("project"+str(i))),)) for i in range(2)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert results==[True,True] and len(builds)==1, "Failed to reuse index"
+    for i in range(2):
+        link=tmp_path/("project"+str(i))/"hs.1.ht2"
+        assert os.path.islink(str(link)) and link.read_text()=="index", "Failed to link index"
+
+    #key depends on contents of references and on parameters
+    ref2=tmp_path/"copy.fa"
+    ref2.write_text(">chr1\nACGT\n")
+    assert index_registry.get_index("hisat2",[],[str(ref2)],{"--seed":"1"},str(tmp_path/"project2"),"hs",build)==True
+    assert len(builds)==1, "Failed to reuse index of identical reference"
+    assert index_registry.get_index("hisat2",[],[str(ref)],{"--seed":"2"},str(tmp_path/"project2"),"hs",build)==True
+    assert len(builds)==2, "Failed to build index with new parameters"
+    ref.write_text(">chr1\nACGTT\n")
+    assert index_registry.get_index("hisat2",[],[str(ref)],{"--seed":"1"},str(tmp_path/"project2"),"hs",build)==True
+    assert len(builds)==3, "Failed to build index of modified reference"
+    assert index_registry.get_index("hisat2",[],[str(ref)],{"--seed":"1"},str(tmp_path/"project2"),"hs",build,overwrite=True)==True
+    assert len(builds)==4, "Failed to overwrite index"
+
+    #a failed build is not registered
+    assert index_registry.get_index("star",[],[str(ref)],{},str(tmp_path/"star"),None,lambda p,n: False)==False, "Failed build"
+    def build_star(path,name):
+        assert name is None
+        with open(os.path.join(path,"Genome"),'w') as f:
+            f.write("genome")
+        return True
+    assert index_registry.get_index("star",[],[str(ref)],{},str(tmp_path/"star"),None,build_star)==True
+    assert (tmp_path/"star"/"Genome").read_text()=="genome", "Failed to link index directory"
+
+    #index directories built before the registry was used are kept and the index files are linked into them
+    def build_salmon(path,name):
+        os.makedirs(os.path.join(path,name))
+        with open(os.path.join(path,name,"pos.bin"),'w') as f:
+            f.write("index")
+        return True
+    old_index=tmp_path/"salmon"/"sal"
+    old_index.mkdir(parents=True)
+    (old_index/"pos.bin").write_text("old")
+    assert index_registry.get_index("salmon",[],[str(ref)],{},str(tmp_path/"salmon"),"sal",build_salmon)==True, "Failed to link into existing index"
+    assert os.path.islink(str(old_index/"pos.bin")) and (old_index/"pos.bin").read_text()=="index", "Failed to link into existing index"
+
+    #registry is off by default
+    monkeypatch.setattr(index_registry,"registry_dir_path",None)
+    monkeypatch.delenv("PYRPIPE_INDEX_REGISTRY",raising=False)
+    assert index_registry.get_registry_dir() is None, "Registry is on by default"
+    monkeypatch.setenv("PYRPIPE_INDEX_REGISTRY",str(tmp_path/"registry"))
+    assert index_registry.get_registry_dir()==str(tmp_path/"registry"), "Failed to enable registry from environment"
+    monkeypatch.setattr(index_registry,"registry_dir_path",False)
+    assert index_registry.get_registry_dir() is None
+    assert index_registry.get_index("hisat2",[],[str(ref)],{},str(tmp_path/"project3"),"hs",lambda p,n: builds.append(p) or True)==True
+    assert builds[-1]==str(tmp_path/"project3"), "Failed to build without registry"
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Tests for the streaming log reader
+"""
+
+from pyrpipe import log_reader
+import gzip
+import json
+import os
+
+oldLog="tests/test_files/pyrpipe_logs/2020-01-22-18_14_47_pyrpipe.log"
+
+def test_read_log():
+    with open(oldLog) as f:
+        expected=[json.loads(l) for l in f if not l.startswith("#")]
+    records=list(log_reader.read_log(oldLog))
+    assert len(records)==len(expected), "Failed to read all records"
+    assert records[0]['cmd']==expected[0]['cmd'], "Failed to read record"
+    assert all(isinstance(r['exitcode'],int) for r in records), "Failed to convert exitcode"
+    assert all(isinstance(r['runtime'],float) for r in records), "Failed to convert runtime"
+    
+    projected=list(log_reader.read_log(oldLog,fields=['commandname','exitcode','runtime']))
+    assert len(projected)==len(expected), "Failed projection"
+    for p,r in zip(projected,records):
+        assert set(p.keys())=={'commandname','exitcode','runtime'}, "Failed to project fields"
+        assert p['commandname']==r['commandname'] and p['runtime']==r['runtime'], "Projected values differ"
+
+def test_read_log_projection(tmp_path):
+    log_file=str(tmp_path/"test.log")
+    stdout='tricky "quotes" \\ backslash \\" {braces}, [brackets] and unicode é中\n'*1000
+    records=[{'cmd':"echo a",'exitcode':"0",'runtime':"0:00:02",'stdout':stdout,'samples':[[1,2],[3,4]],'objectid':"SRR1"},
+             {'stdout':"",'cmd':"false",'exitcode':1,'runtime':0.125,'objectid':"SRR2",'nested':{'a':"}"}}]
+    with open(log_file,'w') as f:
+        f.write("#START\n")
+        for r in records:
+            f.write(json.dumps(r)+"\n")
+            f.write(json.dumps(r,ensure_ascii=False)+"\n")
+        #incomplete last record
+        f.write(json.dumps(records[0])[:100])
+    result=list(log_reader.read_log(log_file,fields=['objectid','exitcode','runtime']))
+    assert result==[{'objectid':"SRR1",'exitcode':0,'runtime':2.0}]*2+[{'objectid':"SRR2",'exitcode':1,'runtime':0.125}]*2, "Failed projection"
+    full=list(log_reader.read_log(log_file))
+    assert full[0]['stdout']==stdout and full[1]['stdout']==stdout, "Failed to read full record"
+    assert len(full)==4, "Failed to skip incomplete record"
+    assert log_reader.normalize_record({'exitcode':"0",'runtime':None})=={'exitcode':0,'runtime':None}, "Failed null runtime"
+
+def test_read_log_index(tmp_path):
+    from pyrpipe import pyrpipe_engine as pe
+    log_file=str(tmp_path/"indexed.log")
+    logger=pe.get_logger()
+    handler=pe.IndexedFileHandler(log_file)
+    logger.cmd_logger.addHandler(handler)
+    try:
+        for i in range(20):
+            logger.log_command({'cmd':"prog{} run".format(i%3),'exitcode':str(i%4),'runtime':0.5,'objectid':"SRR{}".format(i%5),
+                                'commandname':"prog{}".format(i%3),'stdout':"out\n"*i})
+    finally:
+        logger.cmd_logger.removeHandler(handler)
+        handler.close()
+    assert len(log_reader.read_index(log_file+".idx"))==20, "Failed to write index"
+    full=list(log_reader.read_log(log_file))
+    #a record appended without an index entry
+    with open(log_file,'a') as f:
+        f.write(json.dumps({'cmd':"prog1",'exitcode':0,'runtime':1,'objectid':"SRR1",'commandname':"prog1",'stdout':""})+"\n")
+    full.append(list(log_reader.read_log(log_file))[-1])
+    
+    indexed=list(log_reader.read_log(log_file,objectid="SRR1",commandname="prog1"))
+    assert indexed==[r for r in full if r['objectid']=="SRR1" and r['commandname']=="prog1"], "Failed indexed lookup"
+    assert len(indexed)==3, "Failed indexed lookup"
+    failed=list(log_reader.read_log(log_file,fields=['cmd'],passed=False))
+    assert failed==[{'cmd':r['cmd']} for r in full if r['exitcode']!=0], "Failed status lookup"
+    #without an index the log is scanned
+    os.remove(log_file+".idx")
+    assert list(log_reader.read_log(log_file,objectid="SRR1",commandname="prog1"))==indexed, "Failed scan lookup"
+
+def test_read_log_segments(tmp_path):
+    from pyrpipe import pyrpipe_engine as pe
+    log_file=str(tmp_path/"rotated.log")
+    logger=pe.get_logger()
+    handler=pe.IndexedFileHandler(log_file,max_bytes=2000,compression='gzip')
+    logger.cmd_logger.addHandler(handler)
+    try:
+        for i in range(30):
+            logger.log_command({'cmd':"prog run",'exitcode':i%2,'runtime':0.5,'objectid':"SRR{}".format(i%3),
+                                'commandname':"prog",'stdout':"out {}\n".format(i)*20})
+    finally:
+        logger.cmd_logger.removeHandler(handler)
+        handler.close()
+    segments=log_reader.get_log_segments(log_file)
+    assert len(segments)>2 and segments[-1]==log_file, "Failed to rotate log"
+    assert all(s.endswith(".gz") for s in segments[:-1]), "Failed to compress segments"
+    assert all(os.path.getsize(s)<2000 for s in segments), "Failed to limit segment size"
+    assert log_reader.get_log_base(segments[0])==log_file, "Failed to get log from segment"
+    
+    records=list(log_reader.read_log(segments[0]))
+    assert [r['stdout'] for r in records]==["out {}\n".format(i)*20 for i in range(30)], "Failed to read segments"
+    indexed=list(log_reader.read_log(log_file,fields=['stdout'],objectid="SRR1",passed=True))
+    assert indexed==[{'stdout':r['stdout']} for r in records if r['objectid']=="SRR1" and r['exitcode']==0], "Failed indexed lookup across segments"
+    
+    #segments left uncompressed by an interrupted process are compressed when the log is opened
+    with gzip.open(segments[0]) as f:
+        data=f.read()
+    os.remove(segments[0])
+    with open(segments[0][:-3],'wb') as f:
+        f.write(data)
+    pe.IndexedFileHandler(log_file,max_bytes=2000,compression='gzip').close()
+    assert log_reader.get_log_segments(log_file)==segments, "Failed to compress segments of an interrupted log"
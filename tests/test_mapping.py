@@ -7,6 +7,7 @@ Created on Thu Dec 26 23:32:09 2019
 """
 
 from pyrpipe import mapping
+from pyrpipe import pyrpipe_engine as pe
 from pyrpipe import pyrpipe_utils as pu
 from testingEnvironment import testSpecs
 import os
@@ -63,3 +64,114 @@ def test_bowtie():
     st=bt.run_bowtie2(**opts)
     assert st==True, "Failed to run bowtie2"
 
+
+def test_star_batch_alignment(tmp_path,monkeypatch):
+    bin_dir=tmp_path/"bin"
+    bin_dir.mkdir()
+    calls=tmp_path/"star.calls"
+    #records the arguments of each call; fails to align SRR000002
+    (bin_dir/"STAR").write_text("#!/bin/sh\necho \"$@\" >> {}\ncase \"$*\" in *SRR000002*) exit 1;; esac\n".format(calls))
+    (bin_dir/"STAR").chmod(0o755)
+    monkeypatch.setenv("PATH",str(bin_dir)+os.pathsep+os.environ["PATH"])
+    index=tmp_path/"index"
+    index.mkdir()
+    for f in ['chrLength.txt','chrNameLength.txt','chrName.txt','chrStart.txt','genomeParameters.txt','Genome','SA','SAindex']:
+        (index/f).write_text("index")
+    
+    class Sample:
+        def __init__(self,accession):
+            self.srr_accession=accession
+            self.location=str(tmp_path/accession)
+            self.layout="SINGLE"
+            self.localfastqPath=os.path.join(self.location,accession+".fastq")
+    samples=[Sample("SRR000001"),Sample("SRR000002"),Sample("SRR000003")]
+    
+    star=mapping.Star(star_index=str(index))
+    out_dir=str(tmp_path/"out")
+    results=star.perform_batch_alignment(samples,out_dir=out_dir,jobs=2,logs=False)
+    assert results=={"SRR000001":os.path.join(out_dir,"SRR000001"),"SRR000002":"","SRR000003":os.path.join(out_dir,"SRR000003")}, "Failed batch alignment"
+    lines=calls.read_text().splitlines()
+    assert "--genomeLoad LoadAndExit" in lines[0] and "--genomeLoad Remove" in lines[-1], "Failed to load and remove genome"
+    assert len(lines)==5 and all("--genomeLoad LoadAndKeep" in l for l in lines[1:-1]), "Failed to use shared genome"
+    
+    #genome is removed if alignment raises
+    calls.unlink()
+    def fail(*args,**kwargs):
+        raise RuntimeError("failed")
+    monkeypatch.setattr(star,"perform_alignment",fail)
+    try:
+        star.perform_batch_alignment(samples,logs=False)
+        assert False, "Failed to raise"
+    except RuntimeError:
+        pass
+    assert "--genomeLoad Remove" in calls.read_text().splitlines()[-1], "Failed to remove genome after failure"
+    #genome is not removed if it was not loaded
+    calls.unlink()
+    monkeypatch.setattr(star,"load_genome",lambda **kwargs: False)
+    assert star.perform_batch_alignment(samples,logs=False)=={s.srr_accession:"" for s in samples}, "Failed batch alignment after failed load"
+    assert not calls.exists(), "Removed a genome that was not loaded"
+    #sorted BAM needs limitBAMsortRAM
+    assert star.perform_batch_alignment(samples,logs=False,**{"--outSAMtype":"BAM SortedByCoordinate"})["SRR000001"]=="", "Failed to check limitBAMsortRAM"
+
+def test_piped_to_bam_threads(tmp_path,monkeypatch):
+    bin_dir=tmp_path/"bin"
+    bin_dir.mkdir()
+    calls=tmp_path/"calls"
+    #hisat2 writes a SAM header; samtools view and sort copy their input to -o or stdout
+    (bin_dir/"hisat2").write_text('#!/bin/sh\n[ "$1" = "--version" ] && exit 0\necho "$0 $@" >> {}\nprintf "@HD\\tVN:1.6\\n"\n'.format(calls))
+    (bin_dir/"samtools").write_text("""#!/bin/sh
+[ "$1" = "--version" ] && exit 0
+echo "$@" >> {}
+out=/dev/stdout
+while [ $# -gt 1 ]; do [ "$1" = "-o" ] && out=$2; shift; done
+cat > "$out"
+""".format(calls))
+    for f in ["hisat2","samtools"]:
+        (bin_dir/f).chmod(0o755)
+    monkeypatch.setenv("PATH",str(bin_dir)+os.pathsep+os.environ["PATH"])
+    get_args=lambda prog: [l.split() for l in calls.read_text().splitlines() if l.split()[0].endswith(prog)][-1]
+    
+    pe.set_thread_budget(8)
+    try:
+        hs=mapping.Hisat2()
+        out_bam=str(tmp_path/"out.bam")
+        assert hs.run_piped_to_bam(['hisat2','-x','idx','-U','r.fq'],out_bam,logs=False)==True, "Failed piped alignment"
+        #aligner and sort split one grant
+        hisat2_args=get_args("hisat2")
+        assert hisat2_args[hisat2_args.index("-p")+1]=="6", "Failed to give threads to the aligner"
+        assert get_args("sort")[1:3]==["-@","2"], "Failed to split threads with sort"
+        assert pe.thread_budget.free==8, "Failed to release threads"
+        #sort gets its share of the threads set by the user
+        assert hs.run_piped_to_bam(['hisat2','-p','4','-x','idx','-U','r.fq'],str(tmp_path/"out2.bam"),logs=False)==True
+        assert get_args("sort")[1:3]==["-@","1"], "Failed to use user threads for sort"
+        #with few threads sort runs in its main thread
+        pe.set_thread_budget(3)
+        assert hs.run_piped_to_bam(['hisat2','-x','idx','-U','r.fq'],str(tmp_path/"out3.bam"),logs=False)==True
+        assert "-@" not in get_args("sort") and get_args("hisat2")[1:3]==["-p","3"], "Failed to split few threads"
+    finally:
+        pe.set_thread_budget()
+
+def test_hisat2_build_checkpoint(tmp_path,monkeypatch):
+    bin_dir=tmp_path/"bin"
+    bin_dir.mkdir()
+    runs=tmp_path/"hisat2-build.runs"
+    #hisat2-build writes the 8 index files of its last argument
+    (bin_dir/"hisat2-build").write_text('#!/bin/sh\n[ "$1" = "--version" ] && exit 0\necho run >> {}\n'
+                                        'for a; do last=$a; done\nfor i in 1 2 3 4 5 6 7 8; do echo index > "$last.$i.ht2"; done\n'.format(runs))
+    (bin_dir/"hisat2").write_text('#!/bin/sh\nexit 0\n')
+    for f in ["hisat2-build","hisat2"]:
+        (bin_dir/f).chmod(0o755)
+    monkeypatch.setenv("PATH",str(bin_dir)+os.pathsep+os.environ["PATH"])
+    monkeypatch.delenv("PYRPIPE_INDEX_REGISTRY",raising=False)
+    ref=tmp_path/"genome.fa"
+    ref.write_text(">chr1\nACGT\n")
+    pe.set_checkpoint_file(str(tmp_path/"checkpoints.jsonl"))
+    try:
+        hs=mapping.Hisat2()
+        index_dir=str(tmp_path/"index")
+        assert hs.build_index(index_dir,"hs",str(ref),logs=False)==True, "Failed hisat2 build"
+        #the manifest written after the build does not invalidate the checkpoint
+        assert hs.build_index(index_dir,"hs",str(ref),logs=False)==True, "Failed hisat2 build"
+        assert len(runs.read_text().splitlines())==1, "Rebuilt an up to date index"
+    finally:
+        pe.set_checkpoint_file(None)
@@ -8,7 +8,10 @@ Created on Sun Nov 24 16:24:44 2019
 
 from pyrpipe import sra
 from testingEnvironment import testSpecs
+import io
 import os
+import time
+import json
 
 testVars=testSpecs()
 
@@ -25,4 +28,225 @@ def test_sra():
     assert newOb.fastqFilesExistsLocally()==True, "Failed to locate .fastq files on disk"
     assert newOb.sraFileExistsLocally()!=True, "Failed to delete .sra files from disk"
     #delete downloaded files
-    assert newOb.delete_fastq()==True, "Failed to delete .fastq files from disk"
\ No newline at end of file
+    assert newOb.delete_fastq()==True, "Failed to delete .fastq files from disk"
+
+def test_stream_fastq(tmp_path,monkeypatch):
+    #fake sra-tools writing 1000 paired spots to stdout
+    fqd=tmp_path/"fasterq-dump"
+    runs=tmp_path/"fasterq-dump.runs"
+    fqd.write_text("#!/bin/sh\n"
+                   "[ \"$1\" = \"--version\" ] && echo fasterq-dump 2.10 && exit 0\n"
+                   "echo run >> "+str(runs)+"\n"
+                   "i=0\n"
+                   "while [ $i -lt 1000 ]; do\n"
+                   "printf '@r%s/1\\nACGT\\n+\\nIIII\\n@r%s/2\\nTTTT\\n+\\nIIII\\n' $i $i\n"
+                   "i=$((i+1))\n"
+                   "done\n")
+    fqd.chmod(0o755)
+    prefetch=tmp_path/"prefetch"
+    prefetch.write_text("#!/bin/sh\necho prefetch\n")
+    prefetch.chmod(0o755)
+    monkeypatch.setenv("PATH",str(tmp_path)+os.pathsep+os.environ["PATH"])
+    
+    ob=sra.SRA("SRR000001",str(tmp_path))
+    assert ob.stream_fastq()==False, "Streamed without layout"
+    assert ob.stream_fastq(layout="PAIRED")==True, "Failed to start stream"
+    assert ob.is_streaming()==True, "Failed stream status"
+    assert ob.fastqFilesExistsLocally()==False, "FIFOs reported as fastq files"
+    #read one mate completely before the other
+    with open(ob.localfastq1Path) as f:
+        fq1=f.read().splitlines()
+    with open(ob.localfastq2Path) as f:
+        fq2=f.read().splitlines()
+    assert len(fq1)==len(fq2)==4000, "Failed to stream all reads"
+    assert fq1[0]=="@r0/1" and fq2[-4]=="@r999/2", "Failed to split mates"
+    fifo_dir=os.path.dirname(ob.localfastq1Path)
+    assert ob.close_stream()==True, "Failed to close stream"
+    assert not os.path.exists(fifo_dir), "Failed to remove FIFOs"
+    assert ob.is_streaming()==False, "Failed stream status"
+    
+    #consumer that is skipped; fasterq-dump is not executed
+    assert ob.stream_fastq()==True, "Failed to start stream"
+    assert ob.localfastq1Path==os.path.join(fifo_dir,"SRR000001_1.fastq"), "Failed to reuse FIFO paths"
+    assert ob.close_stream()==True, "Failed to close unopened stream"
+    assert len(runs.read_text().splitlines())==1, "fasterq-dump executed without a consumer"
+    
+    #consumer that reads only one mate
+    assert ob.stream_fastq()==True, "Failed to start stream"
+    with open(ob.localfastq1Path) as f:
+        f.readline()
+    assert ob.close_stream()==False, "Unread stream reported success"
+    
+    #a missing mate fails the stream instead of shifting the later reads to the wrong mate
+    paths=[str(tmp_path/"m1.fastq"),str(tmp_path/"m2.fastq")]
+    stream=sra.FastqStream(paths)
+    stream.consume(io.BytesIO(b"@r0/1\nA\n+\nI\n@r0/2\nT\n+\nI\n@r1/1\nA\n+\nI\n@r2/1\nA\n+\nI\n@r2/2\nT\n+\nI\n"))
+    stream.close()
+    assert stream.broken==True, "Failed to detect unpaired mates"
+    with open(paths[1]) as f:
+        assert "@r2" not in f.read(), "Wrote reads after unpaired mates"
+
+def test_batch_downloader(tmp_path,monkeypatch):
+    bin_dir=tmp_path/"bin"
+    bin_dir.mkdir()
+    #fake prefetch writing <-O dir>/<accession>.sra; fails the first attempt for SRR000002
+    prefetch=bin_dir/"prefetch"
+    prefetch.write_text("#!/bin/sh\n"
+                        "[ \"$1\" = \"--version\" ] && echo prefetch 2.10 && exit 0\n"
+                        "while [ $# -gt 1 ]; do [ \"$1\" = \"-O\" ] && out=$2; shift; done\n"
+                        "sleep 0.5\n"
+                        "if [ \"$1\" = \"SRR000002\" ] && [ ! -e \"$out.failed\" ]; then touch \"$out.failed\"; exit 1; fi\n"
+                        "mkdir -p \"$out\" && echo sra > \"$out/$1.sra\"\n")
+    fqd=bin_dir/"fasterq-dump"
+    fqd.write_text("#!/bin/sh\n"
+                   "[ \"$1\" = \"--version\" ] && echo fasterq-dump 2.10 && exit 0\n"
+                   "while [ $# -gt 0 ]; do [ \"$1\" = \"-O\" ] && out=$2; [ \"$1\" = \"-o\" ] && name=$2; shift; done\n"
+                   "sleep 0.5\n"
+                   "printf '@r1\\nACGT\\n+\\nIIII\\n' > \"$out/$name\"\n")
+    fastqdump=bin_dir/"fastq-dump"
+    fastqdump.write_text("#!/bin/sh\nprintf '@r1\\nACGT\\n+\\nIIII\\n'\n")
+    for f in [prefetch,fqd,fastqdump]:
+        f.chmod(0o755)
+    monkeypatch.setenv("PATH",str(bin_dir)+os.pathsep+os.environ["PATH"])
+    
+    accessions=["SRR00000"+str(i) for i in range(1,7)]
+    progress=[]
+    bd=sra.BatchDownloader(accessions,str(tmp_path),max_downloads=6,max_conversions=2,retries=2,backoff=0.1,
+                           delete_sra=True,progress=lambda a,s:progress.append((a,s)))
+    time_start=time.monotonic()
+    result=bd.run()
+    #6 concurrent downloads, one retry and 3 rounds of 2 conversions
+    assert time.monotonic()-time_start<6, "Failed to run downloads concurrently"
+    assert list(result.keys())==accessions, "Failed batch download"
+    for a in accessions:
+        ob=result[a]
+        assert ob is not None and ob.fastqFilesExistsLocally(), "Failed to download "+a
+        assert not ob.sraFileExistsLocally(), "Failed to delete .sra"
+        assert bd.status[a]=="done", "Failed status"
+    assert progress.count(("SRR000002","downloading"))==2, "Failed to retry download"
+    assert progress[-1][1]=="done", "Failed progress"
+    
+    #permanent failure
+    bd=sra.BatchDownloader(["SRR000002"],str(tmp_path/"fail"),retries=0,backoff=0)
+    assert bd.run()=={"SRR000002":None}, "Failed to report failed download"
+    assert bd.status["SRR000002"]=="failed", "Failed status"
+
+def test_layout_detection(tmp_path,monkeypatch):
+    bin_dir=tmp_path/"bin"
+    bin_dir.mkdir()
+    calls=tmp_path/"fastq-dump.calls"
+    for prog in ["prefetch","fasterq-dump"]:
+        (bin_dir/prog).write_text("#!/bin/sh\necho {} 2.10\n".format(prog))
+    #paired spot; each call is recorded
+    (bin_dir/"fastq-dump").write_text("#!/bin/sh\necho call >> {}\nprintf '@r1/1\\nA\\n+\\nI\\n@r1/2\\nA\\n+\\nI\\n'\n".format(calls))
+    for f in bin_dir.iterdir():
+        f.chmod(0o755)
+    monkeypatch.setenv("PATH",str(bin_dir)+os.pathsep+os.environ["PATH"])
+    def num_calls():
+        return len(calls.read_text().splitlines()) if calls.exists() else 0
+    
+    #layout from fastq names
+    srr_dir=tmp_path/"SRR000001"
+    srr_dir.mkdir()
+    for mate in ["1","2"]:
+        (srr_dir/("SRR000001_"+mate+".fastq")).write_text("@r1/"+mate+"\nA\n+\nI\n")
+    (srr_dir/"SRR000001.fastq").write_text("@u1\nA\n+\nI\n")
+    (srr_dir/"SRR000001.sra").write_text("sra")
+    ob=sra.SRA("SRR000001",str(tmp_path))
+    assert ob.layout=="PAIRED" and ob.localfastq2Path.endswith("SRR000001_2.fastq"), "Failed layout from fastq names"
+    assert num_calls()==0, "Ran fastq-dump with fastq present"
+    
+    #layout from .sra is saved in the metadata
+    srr_dir=tmp_path/"SRR000002"
+    srr_dir.mkdir()
+    (srr_dir/"SRR000002.sra").write_text("sra")
+    assert sra.SRA("SRR000002",str(tmp_path)).layout=="PAIRED", "Failed layout from .sra"
+    assert num_calls()==1, "Failed to run fastq-dump"
+    assert sra.SRA("SRR000002",str(tmp_path)).layout=="PAIRED", "Failed layout from metadata"
+    assert num_calls()==1, "Failed to use saved layout"
+    (srr_dir/"SRR000002.sra").write_text("new sra")
+    sra.SRA("SRR000002",str(tmp_path))
+    assert num_calls()==2, "Used layout of a modified .sra"
+    
+    #layout from read names
+    fq1=tmp_path/"a.fastq"
+    fq2=tmp_path/"b.fastq"
+    fq1.write_text("@SRR1.1 1 length=4\nACGT\n+\nIIII\n")
+    fq2.write_text("@SRR1.1 1 length=4\nACGT\n+\nIIII\n")
+    assert sra.get_fastq_layout([str(fq2),str(fq1)])==("PAIRED",[str(fq1),str(fq2)]), "Failed layout from read names"
+    fq2.write_text("@SRR1.2 2 length=4\nACGT\n+\nIIII\n")
+    #two files are paired even if the read names do not match
+    assert sra.get_fastq_layout([str(fq1),str(fq2)])==("PAIRED",[str(fq1),str(fq2)]), "Failed two file layout"
+    assert sra.get_fastq_layout([str(fq1),str(fq2),str(tmp_path/"c.fastq")])==(None,[]), "Failed ambiguous layout"
+    assert sra.get_fastq_layout([str(fq1)])==("SINGLE",[str(fq1)]), "Failed single layout"
+
+def test_create_sra_objects(tmp_path,monkeypatch):
+    bin_dir=tmp_path/"bin"
+    bin_dir.mkdir()
+    calls=tmp_path/"fastq-dump.calls"
+    for prog in ["prefetch","fasterq-dump"]:
+        (bin_dir/prog).write_text("#!/bin/sh\necho {} 2.10\n".format(prog))
+    #single end spot
+    (bin_dir/"fastq-dump").write_text("#!/bin/sh\necho call >> {}\nprintf '@r1\\nA\\n+\\nI\\n'\n".format(calls))
+    for f in bin_dir.iterdir():
+        f.chmod(0o755)
+    monkeypatch.setenv("PATH",str(bin_dir)+os.pathsep+os.environ["PATH"])
+    
+    data=tmp_path/"data"
+    for i in range(1,5):
+        (data/("SRR00000"+str(i))).mkdir(parents=True)
+    (data/"SRR000001"/"SRR000001.fastq").write_text("@u1\nA\n+\nI\n")
+    for mate in ["1","2"]:
+        (data/"SRR000002"/("SRR000002_"+mate+".fastq")).write_text("@r1/"+mate+"\nA\n+\nI\n")
+    (data/"SRR000003"/"SRR000003.sra").write_text("sra")
+    (data/"SRR000004"/"SRR000004.sra").write_text("sra")
+    (data/"notes").mkdir()
+    
+    assert sra.find_accessions(str(data))==["SRR000001","SRR000002","SRR000003","SRR000004"], "Failed to find accessions"
+    obs=sra.create_sra_objects(location=str(data))
+    assert [obs[a].layout for a in sorted(obs)]==["SINGLE","PAIRED","SINGLE","SINGLE"], "Failed to create SRA objects"
+    assert len(calls.read_text().splitlines())==2, "Failed to probe layouts"
+    
+    table=tmp_path/"SraRunTable.txt"
+    table.write_text("BioSample,Run,Layout\nS1,SRR000002,PAIRED\nS2,SRR000005,SINGLE\n")
+    assert sra.read_accessions(str(table))==["SRR000002","SRR000005"], "Failed to read accessions"
+    table.write_text("SRR000003\n#comment\n\nSRR000002\n")
+    assert sra.read_accessions(str(table))==["SRR000003","SRR000002"], "Failed to read accessions"
+    obs=sra.create_sra_objects(str(table),str(data))
+    assert list(obs)==["SRR000003","SRR000002"] and obs["SRR000003"].layout=="SINGLE", "Failed to create SRA objects from table"
+    assert len(calls.read_text().splitlines())==2, "Failed to use saved layouts"
+
+def test_sra_serialization(tmp_path,monkeypatch):
+    bin_dir=tmp_path/"bin"
+    bin_dir.mkdir()
+    for prog in ["prefetch","fasterq-dump"]:
+        (bin_dir/prog).write_text("#!/bin/sh\necho {} 2.10\n".format(prog))
+        (bin_dir/prog).chmod(0o755)
+    monkeypatch.setenv("PATH",str(bin_dir)+os.pathsep+os.environ["PATH"])
+    srr_dir=tmp_path/"SRR000001"
+    srr_dir.mkdir()
+    for mate in ["1","2"]:
+        (srr_dir/("SRR000001_"+mate+".fastq")).write_text("@r1/"+mate+"\nA\n+\nI\n")
+    
+    ob=sra.SRA("SRR000001",str(tmp_path))
+    assert ob.layout is sra.Layout.PAIRED and ob.layout=="PAIRED", "Failed layout"
+    assert ob.localSRAFilePath is None and not ob.sraFileExistsLocally(), "Failed default fields"
+    assert ob.fastqFilesExistsLocally()==True, "Failed to locate .fastq files"
+    assert not hasattr(ob,'__dict__'), "SRA object has a __dict__"
+    try:
+        ob.location=str(tmp_path)
+        assert False, "Modified location"
+    except Exception as e:
+        assert str(e)=="Can not modify location"
+    
+    d=ob.to_dict()
+    assert d['layout']=="PAIRED" and d['srr_accession']=="SRR000001" and d['localfastq2Path']==str(srr_dir/"SRR000001_2.fastq"), "Failed to_dict"
+    copy=sra.SRA.from_dict(json.loads(json.dumps(d)))
+    assert copy.to_dict()==d and copy.layout is sra.Layout.PAIRED, "Failed from_dict"
+    assert copy.fastqFilesExistsLocally()==True and copy.is_streaming()==False, "Failed from_dict"
+    
+    out_file=str(tmp_path/"cohort.jsonl")
+    assert sra.save_sra_objects({"SRR000001":ob,"SRR000002":None},out_file)==True, "Failed to save SRA objects"
+    loaded=sra.load_sra_objects(out_file)
+    assert list(loaded)==["SRR000001"] and loaded["SRR000001"].to_dict()==d, "Failed to load SRA objects"
+    assert ob.delete_fastq()==True and ob.localfastq1Path is None and ob.fastqFilesExistsLocally()==False, "Failed to delete fastq"
@@ -8,8 +8,9 @@ Created on Sun Dec 29 16:40:00 2019
 
 from pyrpipe import tools
 from pyrpipe import pyrpipe_utils as pu
+from pyrpipe import pyrpipe_engine as pe
 from testingEnvironment import testSpecs
-#import os
+import os
 
 testVars=testSpecs()
 
@@ -45,4 +46,64 @@ def test_mikado():
     
     listfile=mk.createMikadoGTFlist("mikadolist",out_dir,gtfdir)
     st=pu.check_files_exist(listfile)
-    assert st==True, "Mikado list failed" 
\ No newline at end of file
+    assert st==True, "Mikado list failed" 
+
+def test_samtools_sort_to_bam(tmp_path,monkeypatch):
+    bin_dir=tmp_path/"bin"
+    bin_dir.mkdir()
+    calls=tmp_path/"samtools.calls"
+    #records the arguments of each call; view and sort copy their input to -o or stdout
+    (bin_dir/"samtools").write_text("""#!/bin/sh
+echo "$@" >> {}
+cmd=$1
+for a; do last=$a; done
+out=/dev/stdout
+while [ $# -gt 0 ]; do [ "$1" = "-o" ] && out=$2; shift; done
+case $cmd in
+  view) cat "$last" > "$out";;
+  sort) if [ "$last" = "-" ]; then cat > "$out"; else cat "$last" > "$out"; fi;;
+  index) touch "$last.bai";;
+esac
+""".format(calls))
+    (bin_dir/"samtools").chmod(0o755)
+    monkeypatch.setenv("PATH",str(bin_dir)+os.pathsep+os.environ["PATH"])
+    sam=tmp_path/"reads.sam"
+    sam.write_text("@HD\tVN:1.6\n")
+    scratch=str(tmp_path/"scratch")
+    tools.set_scratch_dir(scratch)
+    pe.set_checkpoint_file(str(tmp_path/"checkpoints.jsonl"))
+    try:
+        check_sort_to_bam(tmp_path,sam,calls,scratch)
+    finally:
+        tools.set_scratch_dir(None)
+        pe.set_checkpoint_file(None)
+    
+    assert tools.get_sort_memory(4,available=8*1024**3)=="1024M"
+    assert tools.get_sort_memory(4,available=8*1024**3,sorts=2)=="512M", "Failed to share memory among sorts"
+    assert tools.get_sort_memory(1,available=64*1024**3)==str(tools.SORT_MAX_MEMORY_MB)+"M"
+
+def check_sort_to_bam(tmp_path,sam,calls,scratch):
+    sm=tools.Samtools()
+    out_bam=sm.sort_to_bam(str(sam),view_args={"-q":"10"},threads=2,logs=False)
+    assert out_bam==str(tmp_path/"reads_sorted.bam") and pu.check_files_exist(out_bam,out_bam+".bai"), "Failed sort_to_bam"
+    #version calls are made by the checkpoints
+    get_calls=lambda: [l for l in calls.read_text().splitlines() if l!="--version"]
+    #view and sort run at the same time and may record their calls in any order
+    lines=sorted(get_calls()[:2])+get_calls()[2:]
+    assert lines[1]=="view -u -q 10 "+str(sam), "Failed to stream through view"
+    sort_args=lines[0].split()
+    assert sort_args[:3]==["sort","-@","2"] and sort_args[3]=="-m" and sort_args[-1]=="-", "Failed to set sort threads and memory"
+    assert sort_args[sort_args.index("-T")+1].startswith(os.path.join(scratch,"reads_sorted.bam.")), "Failed to use scratch dir"
+    assert lines[2]=="index -@ 2 "+out_bam, "Failed to index"
+    #sort is skipped when the output is up to date, even if the memory settings change
+    assert sm.sort_to_bam(str(sam),view_args={"-q":"10"},threads=1,logs=False)==out_bam
+    assert len(get_calls())==3, "Failed to skip sort"
+    
+    #-T set by the user replaces the scratch dir
+    out_bam=sm.sort_to_bam(str(sam),out_suffix="_tmp",index=False,threads=1,scratch_dir=scratch,logs=False,**{"-T":str(tmp_path/"mytmp")})
+    sort_args=get_calls()[-1].split()
+    assert sort_args.count("-T")==1 and sort_args[sort_args.index("-T")+1]==str(tmp_path/"mytmp"), "Failed to keep user -T"
+    
+    #the unsorted bam is kept if delete_bam is False
+    assert sm.sam_sorted_bam(str(sam),delete_bam=False,logs=False)==str(tmp_path/"reads_sorted.bam")
+    assert get_calls()[-2].startswith("view ") and "-o "+str(tmp_path/"reads.bam") in get_calls()[-2], "Failed to keep unsorted bam"